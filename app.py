@@ -1,21 +1,42 @@
 # app.py
 # === Atlas Vadi Fatura — Böl & Alt Yazı & Apsiyon & WhatsApp (Drive entegrasyonlu) ===
-import io, os, re, zipfile, unicodedata, json, uuid, time, sqlite3
+#
+# Soğuk başlangıç: ağır modüller (pandas, pypdf, reportlab, requests, Google API,
+# python-docx) modül yüklenirken değil, onlara ihtiyaç duyan fonksiyon/aksiyon
+# ilk çalıştığında import edilir. Fontlar ilk overlay render'ında kaydedilir.
+from __future__ import annotations
+
+import time
+_APP_IMPORT_T0 = time.perf_counter()
+
+import io, os, re, sys, zipfile, unicodedata, json, uuid, sqlite3, threading, tempfile, hashlib, weakref
+import importlib.util
+import logging
+from collections import OrderedDict, deque
 from datetime import datetime
-from typing import List, Dict, Tuple, Optional
+from functools import lru_cache
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator, TYPE_CHECKING
 from urllib.parse import quote_plus
 import streamlit as st
-import pandas as pd
-import requests
+
+if TYPE_CHECKING:  # yalnız tip ipuçları için; çalışma anında yüklenmez
+    import pandas as pd
+    from pypdf import PdfWriter
+
+
+_log = logging.getLogger(__name__)
+
+
+def _module_available(name: str) -> bool:
+    """Modülü import etmeden kurulu olup olmadığını kontrol eder."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
 
 # ---------------- GOOGLE DRIVE: Secrets ile bağlan & yardımcılar ----------------
-try:
-    from google.oauth2 import service_account
-    from googleapiclient.discovery import build
-    from googleapiclient.errors import HttpError
-    _GDRIVE_OK = True
-except Exception:
-    _GDRIVE_OK = False
+_GDRIVE_OK = _module_available("googleapiclient") and _module_available("google.oauth2")
 
 
 @st.cache_resource(show_spinner=False)
@@ -23,6 +44,8 @@ def get_drive_service_from_secrets():
     """
     Streamlit Secrets'taki [gdrive_service_account] ile Drive service oluşturur.
     """
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
     info = st.secrets.get("gdrive_service_account")
     if not info:
         raise RuntimeError("Streamlit Secrets içinde [gdrive_service_account] yok.")
@@ -59,6 +82,7 @@ def ensure_anyone_with_link_permission(service, file_id: str):
     """
     Dosyayı 'linke sahip olan görüntüleyebilir' yapar (sadece dosya bazında).
     """
+    from googleapiclient.errors import HttpError
     try:
         service.permissions().create(
             fileId=file_id,
@@ -82,34 +106,27 @@ def build_direct_file_link(file_id: str, mode: str = "download") -> str:
         return f"https://drive.google.com/uc?export=download&id={file_id}"
 
 
-# PDF
-from pypdf import PdfReader, PdfWriter
-
-# ReportLab (alt yazı)
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+# PDF (pypdf) ve ReportLab (alt yazı) kullanan fonksiyonların içinde import edilir.
 
-# (opsiyonel) .docx
-try:
-    import docx  # python-docx
-    HAS_DOCX = True
-except Exception:
-    HAS_DOCX = False
+# (opsiyonel) .docx — python-docx, Tab A'da .docx yüklenince import edilir
+HAS_DOCX = _module_available("docx")
 
 # -----------------------------------------------------------------------------
-# Streamlit Page
+# Fontlar (ilk overlay render'ında bir kez yükle; yoksa sessiz geçsin)
 # -----------------------------------------------------------------------------
-st.set_page_config(page_title="Fatura • Atlas Vadi", page_icon="🧾", layout="wide")
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
 
-# -----------------------------------------------------------------------------
-# Fontlar (varsa yükle; yoksa sessiz geçsin)
-# -----------------------------------------------------------------------------
-try:
-    pdfmetrics.registerFont(TTFont("NotoSans-Regular", "fonts/NotoSans-Regular.ttf"))
-    pdfmetrics.registerFont(TTFont("NotoSans-Bold",    "fonts/NotoSans-Bold.ttf"))
-except Exception:
-    pass
+
+@lru_cache(maxsize=None)
+def _ensure_fonts() -> bool:
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    try:
+        pdfmetrics.registerFont(TTFont("NotoSans-Regular", os.path.join(FONT_DIR, "NotoSans-Regular.ttf")))
+        pdfmetrics.registerFont(TTFont("NotoSans-Bold",    os.path.join(FONT_DIR, "NotoSans-Bold.ttf")))
+        return True
+    except Exception:
+        return False
 
 # -----------------------------------------------------------------------------
 # Yardımcılar (genel)
@@ -154,35 +171,118 @@ def _norm_colname(s: str) -> str:
 # -----------------------------------------------------------------------------
 # Alt Yazı (wrap & overlay)
 # -----------------------------------------------------------------------------
-def wrap_by_width(text: str, font_name: str, font_size: float, max_width: float) -> List[str]:
+DEFAULT_FOOTER_TEXT = (
+    "SON ÖDEME TARİHİ     24.10.2025\n\n"
+    "Manas paylaşımlarında oturumda olup (0) gelen dairelerin önceki ödediği paylaşım tutarları baz alınarak "
+    "bedel yansıtılması; ayrıca İSKİ su sayacının okuduğu harcama tutarı ile site içerisindeki harcama tutarı "
+    "arasındaki farkın İSKİ faturasının ödenebilmesi için 152 daireye eşit olarak yansıtılması oya sunuldu. "
+    "Oybirliği ile kabul edildi.\n\n"
+    "28.02.2017 TARİHLİ TEMSİLCİLER OLAĞAN TOPLANTISINDA ALINAN KARARA İSTİNADEN\n"
+    "AÇIKLAMA\n"
+    "İski saatinden okunan m3 = 1.319  M3\n"
+    "Manas okuması m3= 1.202,5 M3\n"
+    "Ortak alan tüketimler m3= 32  M3 \n"
+    "Açıkta kalan:  84,5 m3     \n"
+    "Su m3 fiyatı 82,09   TL    84,5*82,9 = 7.005,05 TL / 152 = 46,08 TL."
+)
+
+
+class _GlyphWidths(dict):
+    """
+    Font başına karakter genişlik tablosu (1000 birim; punto ile ölçeklenir).
+    Karakterler ilk görüldüklerinde bir kez ölçülür. TTF fontlarda değerler
+    ReportLab'ın kendi tablosundan gelir; toplamları stringWidth ile birebir aynıdır.
+    """
+
+    def __init__(self, font_name: str):
+        from reportlab.pdfbase import pdfmetrics
+        super().__init__()
+        face = getattr(pdfmetrics.getFont(font_name), "face", None)
+        char_widths = getattr(face, "charWidths", None)
+        if char_widths is not None:
+            default_w = face.defaultWidth
+            self._measure = lambda ch: char_widths.get(ord(ch), default_w)
+        else:
+            self._measure = lambda ch: pdfmetrics.stringWidth(ch, font_name, 1000)
+
+    def __missing__(self, ch: str) -> float:
+        w = self[ch] = self._measure(ch)
+        return w
+
+
+_GLYPH_WIDTHS: Dict[str, _GlyphWidths] = {}
+
+
+def _glyph_widths(font_name: str) -> _GlyphWidths:
+    table = _GLYPH_WIDTHS.get(font_name)
+    if table is None:
+        _ensure_fonts()
+        table = _GLYPH_WIDTHS[font_name] = _GlyphWidths(font_name)
+    return table
+
+
+def text_width(text: str, font_name: str, font_size: float) -> float:
+    """pdfmetrics.stringWidth eşdeğeri; genişlik tablosunu kullanır."""
+    widths = _glyph_widths(font_name)
+    total = 0
+    for ch in text:
+        total += widths[ch]
+    return 0.001 * font_size * total
+
+
+@lru_cache(maxsize=256)
+def _wrap_by_width_cached(text: str, font_name: str, font_size: float, max_width: float) -> Tuple[str, ...]:
+    widths = _glyph_widths(font_name)
+    scale = 0.001 * font_size
+    space_w = widths[" "]
     lines = []
     for raw in text.replace("\r\n", "\n").replace("\r", "\n").split("\n"):
         if not raw.strip():
             lines.append("")
             continue
-        words = raw.split()
-        current = ""
-        for w in words:
-            trial = (current + " " + w).strip()
-            width = pdfmetrics.stringWidth(trial, font_name, font_size)
-            if width <= max_width:
-                current = trial
+        current, current_w = "", 0
+        for w in raw.split():
+            # kelime genişliği (soldan sağa toplanır => stringWidth ile aynı sonuç)
+            word_w = 0
+            for ch in w:
+                word_w += widths[ch]
+            if current:
+                trial_w = current_w + space_w
+                for ch in w:
+                    trial_w += widths[ch]
             else:
-                if current:
-                    lines.append(current)
-                if pdfmetrics.stringWidth(w, font_name, font_size) > max_width:
-                    piece = ""
-                    for ch in w:
-                        if pdfmetrics.stringWidth(piece + ch, font_name, font_size) <= max_width:
-                            piece += ch
-                        else:
-                            lines.append(piece)
-                            piece = ch
-                    current = piece
-                else:
-                    current = w
+                trial_w = word_w
+
+            if scale * trial_w <= max_width:
+                current = f"{current} {w}" if current else w
+                current_w = trial_w
+                continue
+
+            if current:
+                lines.append(current)
+            if scale * word_w > max_width:
+                piece, piece_w = "", 0
+                for ch in w:
+                    ch_w = widths[ch]
+                    if scale * (piece_w + ch_w) <= max_width:
+                        piece += ch
+                        piece_w += ch_w
+                    else:
+                        lines.append(piece)
+                        piece, piece_w = ch, ch_w
+                current, current_w = piece, piece_w
+            else:
+                current, current_w = w, word_w
         lines.append(current)
-    return lines
+    return tuple(lines)
+
+
+def wrap_by_width(text: str, font_name: str, font_size: float, max_width: float) -> List[str]:
+    """
+    Metni max_width'e göre satırlara böler. Satır genişliği karakter tablosundan
+    artımlı hesaplanır (doğrusal süre); sonuç (text, font, punto, genişlik) ile memoize edilir.
+    """
+    return list(_wrap_by_width_cached(text, font_name, font_size, max_width))
 
 
 def build_footer_overlay(
@@ -196,6 +296,8 @@ def build_footer_overlay(
     box_height: int = 180,
     bold_rules: bool = True,
 ) -> io.BytesIO:
+    from reportlab.pdfgen import canvas
+    _ensure_fonts()
 
     packet = io.BytesIO()
     can = canvas.Canvas(packet, pagesize=(page_w, page_h))
@@ -277,38 +379,333 @@ def build_footer_overlay(
 
             can.setFont(fn, fs)
             can.drawString(x, y, text)
-            x += pdfmetrics.stringWidth(text, fn, fs)
+            x += text_width(text, fn, fs)
 
     can.save()
     packet.seek(0)
     return packet
 
 
-def add_footer_to_pdf(src_bytes: bytes, **kw) -> bytes:
+# -----------------------------------------------------------------------------
+# Overlay önbelleği (aynı sayfa ölçüsü + aynı ayarlar => tek render/parse)
+# -----------------------------------------------------------------------------
+OVERLAY_CACHE_MAX = 64
+_OVERLAY_CACHE: "OrderedDict[tuple, object]" = OrderedDict()
+_OVERLAY_CACHE_LOCK = threading.Lock()
+
+
+def _overlay_cache_key(builder, page_w: float, page_h: float, kw: dict) -> tuple:
+    return (builder.__name__, float(page_w), float(page_h), tuple(sorted(kw.items())))
+
+
+def get_overlay_page(builder, page_w: float, page_h: float, **kw):
+    """
+    builder(page_w, page_h, **kw) ile üretilen overlay'in parse edilmiş ilk sayfasını döndürür.
+    (builder, genişlik, yükseklik, kwargs) anahtarıyla önbelleklenir; aynı anahtar için
+    ReportLab render'ı ve PdfReader parse'ı yalnızca bir kez yapılır.
+    """
+    from pypdf import PdfReader
+    key = _overlay_cache_key(builder, page_w, page_h, kw)
+    return _overlay_cached(key, lambda: PdfReader(builder(page_w, page_h, **kw)).pages[0])
+
+
+def _overlay_cached(key: tuple, factory):
+    with _OVERLAY_CACHE_LOCK:
+        cached = _OVERLAY_CACHE.get(key)
+        if cached is not None:
+            _OVERLAY_CACHE.move_to_end(key)
+            return cached
+
+    value = factory()
+
+    with _OVERLAY_CACHE_LOCK:
+        _OVERLAY_CACHE[key] = value
+        while len(_OVERLAY_CACHE) > OVERLAY_CACHE_MAX:
+            _OVERLAY_CACHE.popitem(last=False)
+    return value
+
+
+def clear_overlay_cache():
+    with _OVERLAY_CACHE_LOCK:
+        _OVERLAY_CACHE.clear()
+
+
+# --- Footer'ı Form XObject olarak paylaşma ------------------------------------
+FOOTER_XOBJECT_NAME = "/AvFooter"
+
+
+def _page_to_form_xobject(overlay_page, page_w: float, page_h: float):
+    """Tek sayfalık overlay'i (içerik + kaynaklar) Form XObject stream'ine çevirir."""
+    from pypdf.generic import ArrayObject, DecodedStreamObject, FloatObject, NameObject
+    form = DecodedStreamObject()
+    form.set_data(overlay_page.get_contents().get_data())
+    form.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Form"),
+        NameObject("/BBox"): ArrayObject([FloatObject(0), FloatObject(0), FloatObject(page_w), FloatObject(page_h)]),
+        NameObject("/Resources"): overlay_page[NameObject("/Resources")],
+    })
+    return form.flate_encode()
+
+
+def _writer_add(writer, obj):
+    """
+    Nesneyi writer'a dolaylı nesne olarak ekler. pypdf'in bunun için genel bir API'si yok
+    (clone yalnız zaten dolaylı olanları taşır); özel _add_object tek yerden çağrılır ve
+    pypdf sürümü requirements.txt'te bu yüzden sabitlenmiştir.
+    """
+    return writer._add_object(obj)
+
+
+def get_footer_form(page_w: float, page_h: float, **footer_kwargs):
+    """
+    Footer'ın Form XObject'ine dolaylı referans döndürür (ölçü + kwargs başına bir kez).
+    Stream'ler PDF'te dolaylı nesne olmak zorunda; küçük bir PdfWriter taşıyıcı görevi görür,
+    sayfa yazılırken nesne hedef writer'a kopyalanır.
+    """
+    from pypdf import PdfWriter
+    def factory():
+        overlay = get_overlay_page(build_footer_overlay, page_w, page_h, **footer_kwargs)
+        holder = PdfWriter()
+        return _writer_add(holder, _page_to_form_xobject(overlay, page_w, page_h))
+
+    key = _overlay_cache_key(get_footer_form, page_w, page_h, footer_kwargs)
+    return _overlay_cached(key, factory)
+
+
+def _attach_footer_form(overlay_page, footer_form):
+    """
+    overlay_page'in içeriğinin önüne 'q /AvFooter Do Q' ekler ve footer formunu kaynaklarına koyar.
+    Böylece footer + overlay tek sayfa olur; hedef sayfaya tek merge_page yeter ve
+    footer içerik akışı her sayfada yeniden parse edilmez.
+    """
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+    resources = overlay_page.get(NameObject("/Resources"))
+    resources = resources.get_object() if resources is not None else DictionaryObject()
+    xobjects = resources.get(NameObject("/XObject"))
+    xobjects = xobjects.get_object() if xobjects is not None else DictionaryObject()
+    xobjects[NameObject(FOOTER_XOBJECT_NAME)] = footer_form
+    resources[NameObject("/XObject")] = xobjects
+    overlay_page[NameObject("/Resources")] = resources
+
+    old = overlay_page.get_contents()
+    content = DecodedStreamObject()
+    content.set_data(
+        f"q {FOOTER_XOBJECT_NAME} Do Q\n".encode("ascii") + (old.get_data() if old is not None else b"")
+    )
+    overlay_page[NameObject("/Contents")] = content
+    return overlay_page
+
+
+def get_footer_only_overlay(page_w: float, page_h: float, **footer_kwargs):
+    """Yalnız footer formunu çizen (boş) overlay sayfası; ölçü + kwargs başına önbelleklenir."""
+    from pypdf import PageObject
+    def factory():
+        blank = PageObject.create_blank_page(width=page_w, height=page_h)
+        return _attach_footer_form(blank, get_footer_form(page_w, page_h, **footer_kwargs))
+
+    key = _overlay_cache_key(get_footer_only_overlay, page_w, page_h, footer_kwargs)
+    return _overlay_cached(key, factory)
+
+
+def _draw_shared_form(writer: PdfWriter, page, form_ref, form_name: str, wrappers: dict):
+    """
+    Sayfanın mevcut içeriğine dokunmadan formu çizdirir:
+    /Contents = [q, <orijinal akışlar>, Q + 'q /Form Do Q'].
+    Baştaki/sondaki küçük akışlar writer içinde tek kez oluşturulup tüm sayfalarca paylaşılır.
+    """
+    from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject
+    resources = page.get(NameObject("/Resources"))
+    if resources is None:
+        resources = page[NameObject("/Resources")] = DictionaryObject()
+    resources = resources.get_object()
+    xobjects = resources.get(NameObject("/XObject"))
+    if xobjects is None:
+        xobjects = resources[NameObject("/XObject")] = DictionaryObject()
+    xobjects = xobjects.get_object()
+    name = form_name
+    while name in xobjects and xobjects.raw_get(name) != form_ref:
+        name += "_"
+    xobjects[NameObject(name)] = form_ref
+
+    if name not in wrappers:
+        head = DecodedStreamObject()
+        head.set_data(b"q\n")
+        tail = DecodedStreamObject()
+        tail.set_data(f"\nQ\nq {name} Do Q\n".encode("ascii"))
+        wrappers[name] = (_writer_add(writer, head), _writer_add(writer, tail))
+    head_ref, tail_ref = wrappers[name]
+
+    contents = page.raw_get("/Contents") if "/Contents" in page else None
+    if contents is None:
+        original = []
+    elif isinstance(contents.get_object(), ArrayObject):
+        original = list(contents.get_object())
+    else:
+        original = [contents]
+    page[NameObject("/Contents")] = ArrayObject([head_ref, *original, tail_ref])
+
+
+def add_footer_to_pdf(src_bytes: bytes, shared_xobject: bool = True, **kw) -> bytes:
+    """
+    shared_xobject=True: footer, sayfa ölçüsü başına tek bir Form XObject olarak gömülür ve
+    her sayfadan referansla çizilir (çıktı boyutu sayfa sayısıyla footer kadar büyümez).
+    False: eski yol, footer her sayfaya merge_page ile kopyalanır.
+    """
+    from pypdf import PdfReader, PdfWriter
     reader = PdfReader(io.BytesIO(src_bytes))
     writer = PdfWriter()
+    forms: Dict[Tuple[float, float], Tuple[object, str]] = {}
+    wrappers: dict = {}
     for page in reader.pages:
         w = float(page.mediabox.width)
         h = float(page.mediabox.height)
-        overlay_io = build_footer_overlay(w, h, **kw)
-        overlay = PdfReader(overlay_io)
-        page.merge_page(overlay.pages[0])
-        writer.add_page(page)
+        if not shared_xobject:
+            page.merge_page(get_overlay_page(build_footer_overlay, w, h, **kw))
+            writer.add_page(page)
+            continue
+
+        if (w, h) not in forms:
+            # formu bu writer'a bir kez kopyala; farklı ölçüler ayrı ad alır
+            form_ref = get_footer_form(w, h, **kw).get_object().clone(writer).indirect_reference
+            forms[(w, h)] = (form_ref, f"{FOOTER_XOBJECT_NAME}{len(forms)}")
+        form_ref, form_name = forms[(w, h)]
+        _draw_shared_form(writer, writer.add_page(page), form_ref, form_name, wrappers)
     out = io.BytesIO()
     writer.write(out)
     return out.getvalue()
 
 
-def split_pdf(src_bytes: bytes) -> List[Tuple[str, bytes]]:
+# -----------------------------------------------------------------------------
+# Tek sayfa çıktı optimizasyonu (kullanılmayan kaynaklar, sıkıştırma, rapor)
+# -----------------------------------------------------------------------------
+_RE_PDF_NAME = re.compile(rb"/([^\s/\[\]()<>{}%]+)")
+_RE_PDF_NAME_ESCAPE = re.compile(rb"#([0-9A-Fa-f]{2})")
+_PRUNABLE_RESOURCES = ("/Font", "/XObject", "/ExtGState", "/ColorSpace", "/Pattern", "/Shading", "/Properties")
+
+
+def _content_names(data: bytes) -> set:
+    """İçerik akışında geçen tüm /Ad token'ları (#xx kaçışları çözülmüş)."""
+    names = set()
+    for raw in _RE_PDF_NAME.findall(data):
+        if b"#" in raw:
+            raw = _RE_PDF_NAME_ESCAPE.sub(lambda m: bytes([int(m.group(1), 16)]), raw)
+        names.add("/" + raw.decode("latin-1"))
+    return names
+
+
+def _prune_unused_resources(page):
+    """
+    Sayfa kaynaklarından içerik akışında adı hiç geçmeyenleri düşürür.
+    Ad metin içinde geçse bile tutulur (temkinli); iç içe form'ların kendi kaynakları korunur.
+    """
+    from pypdf.generic import DictionaryObject, NameObject
+    resources = page.get(NameObject("/Resources"))
+    contents = page.get_contents()
+    if resources is None or contents is None:
+        return
+    used = _content_names(contents.get_data())
+    resources = resources.get_object()
+    for cat in _PRUNABLE_RESOURCES:
+        if cat not in resources:
+            continue
+        entries = resources[cat].get_object()
+        if not isinstance(entries, DictionaryObject):
+            continue
+        for name in [k for k in entries if k not in used]:
+            del entries[name]
+
+
+def _writer_bytes(writer: PdfWriter) -> bytes:
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def _write_single_page(page, optimize: bool = False, measure: bool = True) -> Tuple[bytes, Optional[int]]:
+    """
+    Sayfayı tek sayfalık PDF olarak yazar; (bayt, optimizasyon öncesi boyut) döndürür.
+    optimize=True: kullanılmayan kaynaklar atılır, içerik akışları sıkıştırılır ve
+    aynı/erişilmeyen nesneler ayıklanır. Öncesi boyutu ikinci bir yazım gerektirir;
+    measure=False ise yapılmaz ve boyut None döner.
+    """
+    from pypdf import PdfWriter
+    wri = PdfWriter()
+    wpage = wri.add_page(page)
+    if not optimize:
+        data = _writer_bytes(wri)
+        return data, len(data)
+
+    size_before = len(_writer_bytes(wri)) if measure else None
+    _prune_unused_resources(wpage)
+    wpage.compress_content_streams()
+    wri.compress_identical_objects()
+    return _writer_bytes(wri), size_before
+
+
+# Optimizasyon öncesi boyut her OPTIMIZE_SAMPLE_EVERY sayfada bir ölçülür (ikinci yazım);
+# rapordaki toplam "öncesi" bu örnekten oranlanır.
+OPTIMIZE_SAMPLE_EVERY = 10
+
+
+def _measure_page(page_no: int) -> bool:
+    return (page_no - 1) % OPTIMIZE_SAMPLE_EVERY == 0
+
+
+def new_optimize_report() -> dict:
+    # bytes_before / measured_after: yalnız öncesi ölçülen sayfaların toplamları
+    return {"pages": 0, "bytes_before": 0, "bytes_after": 0, "reused": 0, "measured": 0, "measured_after": 0}
+
+
+def _report_page(report: Optional[dict], size_before: Optional[int], size_after: int, reused: bool = False):
+    if report is not None:
+        report["pages"] += 1
+        report["bytes_after"] += size_after
+        report["reused"] += 1 if reused else 0
+        if size_before is not None:
+            report["measured"] += 1
+            report["bytes_before"] += size_before
+            report["measured_after"] += size_after
+
+
+def iter_split_pages(
+    src_bytes: bytes, optimize: bool = False, report: Optional[dict] = None
+) -> Iterator[Tuple[str, bytes]]:
+    from pypdf import PdfReader
     reader = PdfReader(io.BytesIO(src_bytes))
-    pages = []
     for i, p in enumerate(reader.pages, start=1):
-        w = PdfWriter()
-        w.add_page(p)
-        b = io.BytesIO()
-        w.write(b)
-        pages.append((f"page_{i:03d}.pdf", b.getvalue()))
-    return pages
+        data, size_before = _write_single_page(p, optimize, measure=report is not None and _measure_page(i))
+        _report_page(report, size_before, len(data))
+        yield f"page_{i:03d}.pdf", data
+
+
+def split_pdf(src_bytes: bytes) -> List[Tuple[str, bytes]]:
+    return list(iter_split_pages(src_bytes))
+
+
+def write_pages_zip(pages: Iterable[Tuple[str, bytes]], dest) -> int:
+    """
+    (ad, bayt) çiftlerini geldikleri sırayla dest'e (yol veya dosya nesnesi) ZIP olarak yazar.
+    Sayfalar listede biriktirilmez; bellek kullanımı tek sayfa boyutuyla sınırlı kalır.
+    """
+    n = 0
+    with zipfile.ZipFile(dest, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, data in pages:
+            z.writestr(name, data)
+            n += 1
+    return n
+
+
+def pages_zip_to_tempfile(pages: Iterable[Tuple[str, bytes]]) -> Tuple[str, int]:
+    """ZIP'i diskteki geçici bir dosyaya yazar; (yol, sayfa sayısı) döndürür."""
+    fd, path = tempfile.mkstemp(prefix="fatura_", suffix=".zip")
+    os.close(fd)
+    try:
+        n = write_pages_zip(pages, path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path, n
 
 # -----------------------------------------------------------------------------
 # Daire No Algılama & Köşe Etiketi & Yeniden Adlandırma
@@ -323,8 +720,9 @@ _re_daire_raws = [
 ]
 
 
-def _find_daire_id(raw_text: str) -> Optional[str]:
-    norm = _normalize_tr(raw_text)
+def _find_daire_id(raw_text: str, norm: Optional[str] = None) -> Optional[str]:
+    if norm is None:
+        norm = _normalize_tr(raw_text)
     for rx in _re_daire_norms:
         m = rx.search(norm)
         if m:
@@ -340,16 +738,196 @@ def _find_daire_id(raw_text: str) -> Optional[str]:
     return None
 
 
+# Hızlı DaireID taraması: "Daire No" Manas faturasında hep üst başlık bloğundadır.
+# Yalnız içerik akışının başı (tam BT..ET blokları) ve sayfanın bu bölgesindeki metin okunur.
+DAIRE_SCAN_REGION = (0.0, 0.0, 1.0, 0.35)  # (sol, üst, sağ, alt) — sayfa oranı, sol üstten
+DAIRE_SCAN_PREFIX_BYTES = 16384
+_RE_PDF_ET = re.compile(rb"(?:^|\s)ET(?=\s|$)")
+
+
+class _StopScan(Exception):
+    pass
+
+
+def _find_daire_id_in_region(
+    page,
+    region: Tuple[float, float, float, float] = DAIRE_SCAN_REGION,
+    prefix_bytes: int = DAIRE_SCAN_PREFIX_BYTES,
+) -> Optional[str]:
+    """
+    Sayfanın yalnız verilen bölgesinden DaireID arar (pypdf visitor ile filtre);
+    numarası tamamlanmış bir eşleşme bulunduğu anda çıkarma durdurulur. Bulunamazsa
+    None döner — çağıran tam sayfa çıkarımına düşer.
+    """
+    from pypdf import PageObject
+    from pypdf.generic import DecodedStreamObject, NameObject
+    try:
+        contents = page.get_contents()
+        if contents is None:
+            return None
+        data = contents.get_data()
+        if len(data) > prefix_bytes:
+            cut = None
+            for m in _RE_PDF_ET.finditer(data, 0, prefix_bytes):
+                cut = m.end()
+            if cut is None:
+                return None
+            view = PageObject(page.pdf)
+            view.update(page)
+            stream = DecodedStreamObject()
+            stream.set_data(data[:cut])
+            view[NameObject("/Contents")] = stream
+        else:
+            view = page
+
+        box = page.mediabox
+        left, bottom = float(box.left), float(box.bottom)
+        w, h = float(box.width), float(box.height)
+        x0, x1 = left + region[0] * w, left + region[2] * w
+        y_top, y_bot = bottom + (1 - region[1]) * h, bottom + (1 - region[3]) * h
+    except Exception:
+        return None
+
+    # Parçalar tam çıkarımdaki gibi birleştirilir: aynı satırda bitişik, satır değişince "\n".
+    # Erken durma yalnız "DAIRE NO … X9 … NNN" eşleşmesinden sonra okunmuş bir karakter
+    # varsa (numara başka bir parçayla uzayamaz); aksi halde bölgenin tamamı okunur.
+    parts: List[str] = []
+    last_y: List[float] = []
+    found: List[str] = []
+
+    def visit(text, cm, tm, font_dict, font_size):
+        if not text:
+            return
+        x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+        y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+        if x0 <= x <= x1 and y_bot <= y <= y_top:
+            if last_y and abs(y - last_y[0]) > 1.0:
+                parts.append("\n")
+            last_y[:] = [y]
+            parts.append(text)
+            norm = _normalize_tr("".join(parts))
+            m = _re_daire_norms[0].search(norm)
+            if m and m.end() < len(norm):
+                found.append(f"{m.group(1).upper()}-{_pad3_digits(m.group(2))}")
+                raise _StopScan
+
+    try:
+        view.extract_text(visitor_text=visit)
+    except _StopScan:
+        return found[0]
+    except Exception:
+        return None
+    return _find_daire_id("".join(parts)) if parts else None
+
+
+# -----------------------------------------------------------------------------
+# Sayfa Metin Deposu (PDF içerik hash'i => sayfa bazlı raw/norm metin + DaireID)
+# -----------------------------------------------------------------------------
+PAGE_TEXT_STORE_MAX_DOCS = 8
+_PAGE_TEXT_LOCK = threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def _page_text_store() -> "OrderedDict[str, dict]":
+    """
+    Streamlit rerun'ları ve sekmeler arasında paylaşılan depo:
+    pdf_hash -> {"n_pages": int | None, "pages": {sayfa_index: kayıt}}
+    """
+    return OrderedDict()
+
+
+def pdf_content_hash(pdf_bytes: bytes) -> str:
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def _extract_page_record(page, fast_id: bool = False) -> dict:
+    """
+    Sayfadan bir kez metin çıkarır; raw, normalize metin ve DaireID'yi birlikte tutar.
+    fast_id=True: DaireID önce yalnız üst bölgeden aranır; bulunursa tam metin
+    çıkarılmaz (raw/norm None kalır, gerektiğinde tamamlanır). Bulunamazsa tam sayfa.
+    """
+    if fast_id:
+        did = _find_daire_id_in_region(page)
+        if did:
+            return {"raw": None, "norm": None, "daire_id": did}
+    try:
+        raw = page.extract_text() or ""
+    except Exception:
+        raw = ""
+    norm = _normalize_tr(raw)
+    return {"raw": raw, "norm": norm, "daire_id": _find_daire_id(raw, norm)}
+
+
+def _page_text_doc(pdf_hash: str) -> dict:
+    store = _page_text_store()
+    with _PAGE_TEXT_LOCK:
+        doc = store.get(pdf_hash)
+        if doc is None:
+            doc = store[pdf_hash] = {"n_pages": None, "pages": {}}
+            while len(store) > PAGE_TEXT_STORE_MAX_DOCS:
+                store.popitem(last=False)
+        else:
+            store.move_to_end(pdf_hash)
+        return doc
+
+
+def get_page_text(pdf_hash: str, page_index: int, page, need_text: bool = True) -> dict:
+    """
+    Kayıt depoda yoksa (lazy) çıkarır ve saklar. page_index 0 tabanlıdır.
+    need_text=False: yalnız DaireID gerekir; hızlı bölge taraması yeterlidir.
+    """
+    doc = _page_text_doc(pdf_hash)
+    rec = doc["pages"].get(page_index)
+    if rec is None or (need_text and rec["raw"] is None):
+        rec = doc["pages"][page_index] = _page_record_cached(page, fast_id=not need_text)
+    return rec
+
+
+def put_page_texts(pdf_hash: str, records: Dict[int, dict], n_pages: Optional[int] = None):
+    """Başka bir süreçte (ör. paralel işçi) çıkarılmış kayıtları depoya ekler."""
+    doc = _page_text_doc(pdf_hash)
+    pages = doc["pages"]
+    for i, rec in records.items():
+        old = pages.get(i)
+        # tam metinli kayıt, yalnız DaireID içeren hızlı/OCR kaydıyla ezilmez (metni boşsa ezilir)
+        if old is None or rec["raw"] is not None or not old["raw"]:
+            pages[i] = rec
+    if n_pages is not None:
+        doc["n_pages"] = n_pages
+
+
+def iter_pdf_page_texts(pdf_bytes: bytes, pdf_hash: Optional[str] = None) -> Iterator[Tuple[int, dict]]:
+    """
+    (sayfa_index, kayıt) üretir. PDF'in tüm sayfaları depodaysa PDF hiç parse edilmez.
+    """
+    from pypdf import PdfReader
+    pdf_hash = pdf_hash or pdf_content_hash(pdf_bytes)
+    doc = _page_text_doc(pdf_hash)
+    n = doc["n_pages"]
+    if n is not None and all(doc["pages"].get(i, {}).get("raw") is not None for i in range(n)):
+        for i in range(n):
+            yield i, doc["pages"][i]
+        return
+
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    doc["n_pages"] = len(reader.pages)
+    for i, page in enumerate(reader.pages):
+        yield i, get_page_text(pdf_hash, i, page)
+
+
 def build_corner_label_overlay(
     page_w: float, page_h: float, label_text: str,
     font_size: int = 13, bold: bool = True,
     position: str = "TR", pad_x: int = 20, pad_y: int = 20
 ) -> io.BytesIO:
+    from reportlab.pdfgen import canvas
+    _ensure_fonts()
+
     packet = io.BytesIO()
     can = canvas.Canvas(packet, pagesize=(page_w, page_h))
     font_name = "NotoSans-Bold" if bold else "NotoSans-Regular"
     can.setFont(font_name, font_size)
-    text_w = pdfmetrics.stringWidth(label_text, font_name, font_size)
+    text_w = text_width(label_text, font_name, font_size)
     text_h = font_size * 1.2
 
     if position == "TR":
@@ -371,170 +949,1134 @@ def build_corner_label_overlay(
     return packet
 
 
-def add_footer_and_stamp_per_page(
-    src_bytes: bytes,
+def build_page_overlay(
+    page_w: float, page_h: float,
+    footer_kwargs: dict, label_tpl: str, stamp_opts: dict,
+    daire_id: Optional[str] = None,
+):
+    """
+    Footer ve köşe etiketini tek overlay sayfasında birleştirir.
+    Footer ölçü başına bir kez render edilip Form XObject olarak paylaşılır;
+    sayfaya özel olan yalnızca etiket canvas'ıdır.
+    """
+    from pypdf import PdfReader
+    if not daire_id:
+        return get_footer_only_overlay(page_w, page_h, **footer_kwargs)
+
+    label_page = PdfReader(build_corner_label_overlay(
+        page_w, page_h, label_tpl.format(daire_id=daire_id),
+        font_size=stamp_opts.get("font_size", 13),
+        bold=stamp_opts.get("bold", True),
+        position=stamp_opts.get("position", "TR"),
+        pad_x=stamp_opts.get("pad_x", 20),
+        pad_y=stamp_opts.get("pad_y", 20),
+    )).pages[0]
+    return _attach_footer_form(label_page, get_footer_form(page_w, page_h, **footer_kwargs))
+
+
+def _stamp_single_page(
+    page,
+    page_no: int,
+    daire_id: Optional[str],
     footer_kwargs: dict,
     stamp_on: bool,
     label_tpl: str,
     stamp_opts: dict,
-    rename_files: bool
-) -> List[Tuple[str, bytes]]:
-    reader = PdfReader(io.BytesIO(src_bytes))
-    out_pages: List[Tuple[str, bytes]] = []
+    rename_files: bool,
+    optimize: bool = False,
+) -> Tuple[str, bytes, Optional[int]]:
+    """
+    Tek sayfaya alt yazı + (ops.) köşe etiketi basar ve tek sayfalık PDF olarak döndürür:
+    (ad, bayt, optimizasyon öncesi boyut).
+    DaireID, overlay'ler eklenmeden önce sayfa metin deposundan alınır.
+    Seri ve paralel yol aynı fonksiyonu kullanır; çıktı adları birebir aynıdır.
+    """
+    w = float(page.mediabox.width)
+    h = float(page.mediabox.height)
 
-    for i, page in enumerate(reader.pages, start=1):
-        w = float(page.mediabox.width)
-        h = float(page.mediabox.height)
+    # footer + (ops.) köşe etiketi => sayfa başına tek merge
+    page.merge_page(build_page_overlay(w, h, footer_kwargs, label_tpl, stamp_opts, daire_id if stamp_on else None))
 
-        # footer
-        footer_overlay_io = build_footer_overlay(w, h, **footer_kwargs)
-        footer_overlay = PdfReader(footer_overlay_io)
-        page.merge_page(footer_overlay.pages[0])
+    # tek sayfa pdf
+    data, size_before = _write_single_page(page, optimize, measure=_measure_page(page_no))
 
-        # DaireID
-        daire_id = None
-        try:
-            txt = page.extract_text() or ""
-            daire_id = _find_daire_id(txt)
-        except Exception:
-            daire_id = None
-
-        # köşe etiketi
-        if stamp_on and daire_id:
-            label_text = label_tpl.format(daire_id=daire_id)
-            label_overlay_io = build_corner_label_overlay(
-                w, h, label_text,
-                font_size=stamp_opts.get("font_size", 13),
-                bold=stamp_opts.get("bold", True),
-                position=stamp_opts.get("position", "TR"),
-                pad_x=stamp_opts.get("pad_x", 20),
-                pad_y=stamp_opts.get("pad_y", 20),
-            )
-            label_overlay = PdfReader(label_overlay_io)
-            page.merge_page(label_overlay.pages[0])
+    return _page_file_name(page_no, daire_id, rename_files), data, size_before
 
-        # tek sayfa pdf
-        wri = PdfWriter()
-        wri.add_page(page)
-        buf = io.BytesIO()
-        wri.write(buf)
-        buf.seek(0)
 
-        fname = f"page_{i:03d}.pdf"
-        if rename_files and daire_id:
-            fname = f"{daire_id}.pdf"
+def _page_file_name(page_no: int, daire_id: Optional[str], rename_files: bool) -> str:
+    if rename_files and daire_id:
+        return f"{daire_id}.pdf"
+    return f"page_{page_no:03d}.pdf"
 
-        out_pages.append((fname, buf.getvalue()))
 
-    return out_pages
+# --- Paralel motor (process pool) --------------------------------------------
+PARALLEL_MIN_PAGES = 24
+DEFAULT_WORKERS = max(1, min(4, os.cpu_count() or 1))
 
-# -----------------------------------------------------------------------------
-# MANAS PDF Parser (Isıtma / Sıcak Su / Su / Toplam)
-# -----------------------------------------------------------------------------
-def parse_manas_pdf_totals(pdf_bytes: bytes) -> Dict[str, Dict[str, float]]:
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    result: Dict[str, Dict[str, float]] = {}
+_WORKER_STATE: dict = {}
 
-    re_daire_norms = [
-        re.compile(r"DAIRE\s*NO[^A-Z0-9]{0,15}([A-Z]\d)[^0-9]{0,20}(\d{1,4})"),
-        re.compile(r"([A-Z]\d)[^\d\n\r]{0,30}DAIRE[^0-9]{0,10}(\d{1,4})"),
-    ]
-    re_daire_raws = [
-        re.compile(r"DA[İI]RE\s*NO[^A-Z0-9]{0,15}([A-Z]\d)[^0-9]{0,20}(\d{1,4})"),
-        re.compile(r"([A-Z]\d)[^\d\n\r]{0,30}DA[İI]RE[^0-9]{0,10}(\d{1,4})"),
-    ]
-    re_odenecek = re.compile(r"(?:ÖDENECEK|ODENECEK)\s*TUTAR[^0-9]{0,10}([0-9\.\,]+)", re.IGNORECASE)
-    re_toplam = re.compile(r"TOPLAM\s+TUTAR[^0-9]{0,10}([0-9\.\,]+)", re.IGNORECASE)
 
-    def find_daire_id(raw_text: str) -> Optional[str]:
-        norm = _normalize_tr(raw_text)
-        for rx in re_daire_norms:
-            m = rx.search(norm)
-            if m:
-                return f"{m.group(1).upper()}-{_pad3_digits(m.group(2))}"
-        for rx in re_daire_raws:
-            m = rx.search(raw_text)
-            if m:
-                return f"{m.group(1).upper()}-{_pad3_digits(m.group(2))}"
-        return None
+def _init_page_worker(src_bytes: bytes, job_args: tuple, known_texts: Dict[int, dict], fast_id: bool = False):
+    """
+    Her işçi süreci kaynak PDF için kendi PdfReader'ını bir kez açar.
+    fork ile kopyalanan kilit/önbellek durumu temizlenir; ana süreçte zaten
+    çıkarılmış sayfa metinleri (known_texts) yeniden çıkarılmaz.
+    """
+    from pypdf import PdfReader
+    global _OVERLAY_CACHE_LOCK
+    _OVERLAY_CACHE_LOCK = threading.Lock()
+    _OVERLAY_CACHE.clear()
+    _WORKER_STATE["reader"] = PdfReader(io.BytesIO(src_bytes))
+    _WORKER_STATE["job_args"] = job_args
+    _WORKER_STATE["known_texts"] = known_texts
+    _WORKER_STATE["fast_id"] = fast_id
+
+
+def _process_page_range(indices: List[int]) -> List[Tuple[int, dict, bytes, int]]:
+    reader = _WORKER_STATE["reader"]
+    job_args = _WORKER_STATE["job_args"]
+    known = _WORKER_STATE["known_texts"]
+    fast_id = _WORKER_STATE["fast_id"]
+    out = []
+    for i in indices:
+        page = reader.pages[i]
+        rec = known.get(i) or _page_record_cached(page, fast_id)
+        _, data, size_before = _stamp_single_page(page, i + 1, rec["daire_id"], *job_args)
+        out.append((i, rec, data, size_before))
+    return out
 
-    def grab_section_amount(norm_text: str, header_word: str) -> float:
-        idx = norm_text.find(header_word)
-        if idx == -1:
-            return 0.0
-        tail = norm_text[idx: idx + 2500]
-        m = re_odenecek.search(tail)
-        return _to_float_tr(m.group(1)) if m else 0.0
 
-    for pi, page in enumerate(reader.pages):
-        raw = page.extract_text() or ""
-        norm = _normalize_tr(raw)
+def _page_chunks(indices: List[int], workers: int, chunk_size: Optional[int] = None) -> List[List[int]]:
+    """İşlenecek sayfa index'lerini sıralı parçalara böler (işçi başına ~4 parça)."""
+    if not chunk_size:
+        chunk_size = max(1, -(-len(indices) // (workers * 4)))
+    return [indices[s:s + chunk_size] for s in range(0, len(indices), chunk_size)]
 
-        did = find_daire_id(raw)
-        if not did:
-            if pi == 0:
-                st.info("⚠️ Daire No satırı bulunamadı. İlk sayfanın normalize içeriğinin bir kısmı:")
-                st.code(norm[:800])
-            continue
 
-        isitma = grab_section_amount(norm, "ISITMA")
-        sicak = grab_section_amount(norm, "SICAK SU")
+def _iter_footer_and_stamp_parallel(
+    src_bytes: bytes,
+    pdf_hash: str,
+    indices: List[int],
+    job_args: tuple,
+    workers: int,
+    chunk_size: Optional[int] = None,
+    fast_id: bool = False,
+) -> Iterator[Tuple[int, dict, bytes, int]]:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Streamlit script'i sahte bir __main__ modülünde çalıştırır; spawn bu modülü
+    # yeniden içe aktaramaz. Bu yüzden yalnızca fork destekleniyorsa paralel çalışılır.
+    ctx = multiprocessing.get_context("fork")
+    chunks = iter(_page_chunks(indices, workers, chunk_size))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=ctx,
+        initializer=_init_page_worker,
+        initargs=(src_bytes, job_args, dict(_page_text_doc(pdf_hash)["pages"]), fast_id),
+    ) as ex:
+        # Aynı anda en fazla workers*2 parça havada; sonuçlar gönderim sırasıyla
+        # tüketilir => sayfa sırası korunur ve bekleyen çıktı sınırlı kalır.
+        pending = deque()
+        for bounds in chunks:
+            pending.append(ex.submit(_process_page_range, bounds))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            part = pending.popleft().result()
+            nxt = next(chunks, None)
+            if nxt is not None:
+                pending.append(ex.submit(_process_page_range, nxt))
+            # işçilerin çıkardığı metinler ana süreçteki depoya işlenir (Tab B tekrar çıkarmaz)
+            put_page_texts(pdf_hash, {i: rec for i, rec, _, _ in part})
+            yield from part
+
+
+def _iter_processed_pages(
+    reader,
+    src_bytes: bytes,
+    pdf_hash: str,
+    indices: List[int],
+    job_args: tuple,
+    workers: int,
+    chunk_size: Optional[int],
+    fast_id: bool,
+    report: Optional[dict] = None,
+) -> Iterator[Tuple[int, dict, bytes, int]]:
+    """
+    Verilen sayfaları damgalar: (index, metin kaydı, bayt, optimizasyon öncesi boyut).
+    Paralel yol ilk sayfayı vermeden düşerse (havuz kurulamadı, ilk parça hata verdi) hata
+    kaydedilir ve tüm sayfalar seri yoldan işlenir; sayfa verildikten sonraki hatalar çağırana iletilir.
+    """
+    if workers > 1 and len(indices) >= PARALLEL_MIN_PAGES:
+        parallel = _iter_footer_and_stamp_parallel(
+            src_bytes, pdf_hash, indices, job_args, workers, chunk_size, fast_id
+        )
+        try:
+            first = next(parallel)
+        except Exception as e:
+            _log.warning("Paralel sayfa işleme başlatılamadı; seri yola geçiliyor", exc_info=True)
+            if report is not None:
+                report["parallel_error"] = f"{type(e).__name__}: {e}"
+        else:
+            yield first
+            yield from parallel
+            return
+
+    for i in indices:
+        page = reader.pages[i]
+        rec = get_page_text(pdf_hash, i, page, need_text=not fast_id)
+        _, data, size_before = _stamp_single_page(page, i + 1, rec["daire_id"], *job_args)
+        yield i, rec, data, size_before
 
-        # SU başlığı SICAK SU ile karışmasın:
-        su = 0.0
-        idx_sicak = norm.find("SICAK SU")
-        search_base = norm[idx_sicak + 8:] if idx_sicak != -1 else norm
-        idx_su = search_base.find("\nSU")
-        if idx_su == -1:
-            idx_su = search_base.find(" SU ")
-        if idx_su != -1:
-            tail_su = search_base[idx_su: idx_su + 2000]
-            m_su = re_odenecek.search(tail_su)
-            if m_su:
-                su = _to_float_tr(m_su.group(1))
-        if su == 0.0:
-            su = grab_section_amount(norm, "\nSU")
 
-        mt = re_toplam.search(norm)
-        toplam = _to_float_tr(mt.group(1)) if mt else (isitma + sicak + su)
+def iter_footer_and_stamp_pages(
+    src_bytes: bytes,
+    footer_kwargs: dict,
+    stamp_on: bool,
+    label_tpl: str,
+    stamp_opts: dict,
+    rename_files: bool,
+    workers: int = 1,
+    chunk_size: Optional[int] = None,
+    optimize: bool = False,
+    report: Optional[dict] = None,
+    fast_id: bool = False,
+) -> Iterator[Tuple[str, bytes]]:
+    """
+    Sayfaları (ad, bayt) olarak sırayla üretir.
+    workers > 1 ise sayfalar parçalara bölünüp process pool'da işlenir
+    (her işçi kaynak baytlar üzerinde kendi PdfReader'ını açar).
+    Paralel yol ilk sayfadan önce düşerse tüm sayfalar seri yoldan işlenir (report["parallel_error"]).
+    report verilirse (new_optimize_report) öncesi/sonrası bayt toplamları buraya işlenir.
+    fast_id=True: DaireID yalnız sayfanın üst bölgesinden okunur (bulunamazsa tam sayfa).
+    Sayfa önbelleği açıksa parmak izi ve ayarları aynı olan sayfalar (ör. önceki revizyon)
+    önbellekten verilir; yalnız değişen / yeni sayfalar işlenir ve PDF'in manifesti yazılır.
+    """
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(src_bytes))
+    n_pages = len(reader.pages)
+    pdf_hash = pdf_content_hash(src_bytes)
+    put_page_texts(pdf_hash, {}, n_pages=n_pages)
+    job_args = (footer_kwargs, stamp_on, label_tpl, stamp_opts, rename_files, optimize)
+
+    use_cache = PAGE_CACHE_MAX_BYTES > 0
+    fps: List[Optional[str]] = [None] * n_pages
+    reused: Dict[int, Tuple[bytes, int, Optional[str]]] = {}
+    if use_cache:
+        skey = _stamp_settings_key(job_args, fast_id)
+        known = _page_text_doc(pdf_hash)["pages"]
+        cached_recs: Dict[int, dict] = {}
+        for i, page in enumerate(reader.pages):
+            fp = fps[i] = page_fingerprint(page)
+            rec = known.get(i)
+            if rec is None:
+                rec = cached_recs[i] = load_cached_page_record(fp)
+            hit = load_cached_stamp(fp, skey) if rec is not None else None
+            if hit is not None and hit[2] == rec["daire_id"]:  # ör. OCR sonrası DaireID değiştiyse yeniden
+                reused[i] = hit
+        put_page_texts(pdf_hash, {i: r for i, r in cached_recs.items() if r is not None})
+
+    fresh = _iter_processed_pages(
+        reader, src_bytes, pdf_hash, [i for i in range(n_pages) if i not in reused],
+        job_args, workers, chunk_size, fast_id, report,
+    )
+    manifest = []
+    for i in range(n_pages):
+        if i in reused:
+            data, size_before, daire_id = reused[i]
+        else:
+            _, rec, data, size_before = next(fresh)
+            daire_id = rec["daire_id"]
+            if use_cache:
+                store_stamp(fps[i], skey, data, size_before, daire_id)
+        _report_page(report, size_before, len(data), reused=i in reused)
+        manifest.append({"fp": fps[i], "daire_id": daire_id})
+        yield _page_file_name(i + 1, daire_id, rename_files), data
+
+    if use_cache:
+        save_page_manifest(pdf_hash, manifest)
+        prune_page_cache()
 
-        result[did] = {"isitma": isitma, "sicak": sicak, "su": su, "toplam": toplam}
 
-    return result
+def add_footer_and_stamp_per_page(
+    src_bytes: bytes,
+    footer_kwargs: dict,
+    stamp_on: bool,
+    label_tpl: str,
+    stamp_opts: dict,
+    rename_files: bool,
+    workers: int = 1,
+    chunk_size: Optional[int] = None,
+    optimize: bool = False,
+    report: Optional[dict] = None,
+    fast_id: bool = False,
+) -> List[Tuple[str, bytes]]:
+    return list(iter_footer_and_stamp_pages(
+        src_bytes, footer_kwargs, stamp_on, label_tpl, stamp_opts, rename_files,
+        workers=workers, chunk_size=chunk_size, optimize=optimize, report=report,
+        fast_id=fast_id,
+    ))
 
 # -----------------------------------------------------------------------------
-# Apsiyon Excel Yardımcıları
+# Çıktı Önbelleği (içerik adresli, diskte; boyut sınırı + LRU)
 # -----------------------------------------------------------------------------
-def _norm_cols(s: str) -> str:
-    return (str(s).strip().lower()
-            .replace("\n", " ").replace("\r", " ")
-            .replace(".", "").replace("_", " ").replace("-", " "))
+ARTIFACT_CACHE_DIR = os.getenv("FATURA_CACHE_DIR", ".fatura_cache")
+ARTIFACT_CACHE_MAX_BYTES = int(float(os.getenv("FATURA_CACHE_MAX_MB", "512")) * 1024 * 1024)
+# Çıktıyı değiştiren bir render/yazım değişikliğinde artırılır (eski kayıtlar kendiliğinden geçersizleşir).
+ARTIFACT_CACHE_VERSION = 1
 
 
-def _pad3_aps(x) -> str:
-    try:
-        n = int(str(x).strip())
-        return f"{n:03d}"
-    except:
-        s = str(x).strip()
-        nums = "".join([ch for ch in s if ch.isdigit()])
-        return f"{int(nums):03d}" if nums else s
+@st.cache_resource(show_spinner=False)
+def _artifact_cache_state() -> dict:
+    """Süreç boyunca paylaşılan kilit ve isabet/ıska sayaçları."""
+    return {"lock": threading.Lock(), "hits": 0, "misses": 0, "evictions": 0}
 
 
-def _find_header_row(df_raw: pd.DataFrame) -> Optional[int]:
-    limit = min(15, len(df_raw))
-    for i in range(limit):
-        cells = [_norm_cols(c) for c in list(df_raw.iloc[i].values)]
-        row_text = " | ".join(cells)
-        if ("blok" in row_text) and (("daire no" in row_text) or ("daire" in row_text)):
-            return i
-    return None
+def artifact_key(src_bytes: bytes, mode: str, **settings) -> str:
+    """
+    PDF içeriği + mod + çıktıyı etkileyen ayarlar => anahtar.
+    (İşçi sayısı gibi sonucu değiştirmeyen ayarlar buraya verilmez.)
+    """
+    h = hashlib.sha256()
+    h.update(f"v{ARTIFACT_CACHE_VERSION}|{mode}|".encode("utf-8"))
+    h.update(pdf_content_hash(src_bytes).encode("ascii"))
+    h.update(json.dumps(settings, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    return h.hexdigest()
 
 
-def _rename_apsiyon_cols(df: pd.DataFrame) -> pd.DataFrame:
-    mapping = {}
-    for c in df.columns:
-        nc = _norm_cols(c)
+def _artifact_paths(key: str) -> Tuple[str, str]:
+    base = os.path.join(ARTIFACT_CACHE_DIR, key)
+    return base + ".bin", base + ".json"
+
+
+def artifact_cache_get(key: str) -> Optional[Tuple[str, dict]]:
+    """İsabette (dosya yolu, meta) döndürür ve kaydı en yeni kullanılan yapar."""
+    state = _artifact_cache_state()
+    data_path, meta_path = _artifact_paths(key)
+    with state["lock"]:
+        try:
+            with open(meta_path, "r", encoding="utf-8") as fh:
+                meta = json.load(fh)
+            os.utime(data_path, None)  # LRU sırası = son erişim (mtime)
+        except (OSError, ValueError):
+            state["misses"] += 1
+            return None
+        state["hits"] += 1
+    return data_path, meta
+
+
+def _cache_entries() -> List[Tuple[float, Optional[str], str, int]]:
+    """Boyut bütçesine giren kayıtlar: (mtime, çıktı anahtarı | None, yol, boyut) — çıktılar ve OCR metinleri."""
+    out = []
+    for folder, suffix in ((ARTIFACT_CACHE_DIR, ".bin"), (OCR_CACHE_DIR, ".txt")):
+        if not os.path.isdir(folder):
+            continue
+        for entry in os.scandir(folder):
+            if not entry.name.endswith(suffix):
+                continue
+            try:
+                st_ = entry.stat()
+            except OSError:  # başka bir süreç silmiş olabilir
+                continue
+            key = entry.name[:-4] if suffix == ".bin" else None
+            out.append((st_.st_mtime, key, entry.path, st_.st_size))
+    return out
+
+
+def _evict_artifacts(keep: str, max_bytes: int) -> None:
+    """Toplam boyut sınırı aşılırsa en eski kullanılan kayıtları siler (kilit çağıranda)."""
+    entries = sorted(_cache_entries())
+    total = sum(e[3] for e in entries)
+    state = _artifact_cache_state()
+    for _, key, path, size in entries:
+        if total <= max_bytes:
+            break
+        if key is not None and key == keep:
+            continue
+        for p in (_artifact_paths(key) if key is not None else (path,)):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+        total -= size
+        state["evictions"] += 1
+
+
+def artifact_cache_put(key: str, src_path: str, meta: Optional[dict] = None) -> Optional[str]:
+    """
+    Hazır çıktı dosyasını önbelleğe taşır (os.replace); önbellekteki yolu döndürür.
+    Önbellek kapalıysa / dosya sınırdan büyükse / yazılamazsa None döner ve kaynak dosya yerinde kalır.
+    """
+    max_bytes = ARTIFACT_CACHE_MAX_BYTES
+    try:
+        if max_bytes <= 0 or os.path.getsize(src_path) > max_bytes:
+            return None
+        os.makedirs(ARTIFACT_CACHE_DIR, exist_ok=True)
+        data_path, meta_path = _artifact_paths(key)
+        state = _artifact_cache_state()
+        with state["lock"]:
+            tmp_meta = meta_path + f".{uuid.uuid4().hex}.tmp"
+            with open(tmp_meta, "w", encoding="utf-8") as fh:
+                json.dump(meta or {}, fh, ensure_ascii=False)
+            try:
+                os.replace(src_path, data_path)
+            except OSError:
+                # farklı dosya sistemi: kopyala
+                import shutil
+                shutil.copyfile(src_path, data_path)
+                os.remove(src_path)
+            os.replace(tmp_meta, meta_path)  # meta en son: okuyucu yarım kayıt görmez
+            _evict_artifacts(key, max_bytes)
+        return data_path
+    except OSError:
+        return None
+
+
+def artifact_cache_put_bytes(key: str, data: bytes, meta: Optional[dict] = None) -> Optional[str]:
+    fd, path = tempfile.mkstemp(prefix="fatura_", suffix=".bin")
+    with os.fdopen(fd, "wb") as fh:
+        fh.write(data)
+    cached = artifact_cache_put(key, path, meta)
+    if cached is None:
+        os.remove(path)
+    return cached
+
+
+def artifact_cache_stats() -> dict:
+    state = _artifact_cache_state()
+    entries = _cache_entries()
+    return {"hits": state["hits"], "misses": state["misses"], "evictions": state["evictions"],
+            "entries": sum(1 for e in entries if e[1] is not None),
+            "ocr_entries": sum(1 for e in entries if e[1] is None),
+            "bytes": sum(e[3] for e in entries), "max_bytes": ARTIFACT_CACHE_MAX_BYTES}
+
+
+def clear_artifact_cache() -> None:
+    state = _artifact_cache_state()
+    with state["lock"]:
+        if os.path.isdir(ARTIFACT_CACHE_DIR):
+            for entry in os.scandir(ARTIFACT_CACHE_DIR):
+                if entry.name.endswith((".bin", ".json", ".tmp")):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+        # sayfa ve OCR önbellekleri de temizlenir
+        import shutil
+        shutil.rmtree(os.path.join(ARTIFACT_CACHE_DIR, "pages"), ignore_errors=True)
+        shutil.rmtree(OCR_CACHE_DIR, ignore_errors=True)
+
+# -----------------------------------------------------------------------------
+# Sayfa Parmak İzi & Artımlı İşleme (düzeltilmiş fatura revizyonları)
+# -----------------------------------------------------------------------------
+# Sayfa sözlüğü + içerik akışı + kaynaklar (font, görsel...) => parmak izi. Metin kaydı ve
+# damgalı tek sayfa PDF bu izle diskte saklanır; PDF'in yalnız değişen / yeni sayfaları
+# yeniden işlenir. Her PDF için sayfa listesi (iz + DaireID) manifest olarak tutulur.
+PAGE_CACHE_DIR = os.path.join(ARTIFACT_CACHE_DIR, "pages")
+PAGE_CACHE_MAX_BYTES = int(float(os.getenv("FATURA_PAGE_CACHE_MAX_MB", "256")) * 1024 * 1024)  # 0 => kapalı
+PAGE_TEXT_CACHE = os.getenv("FATURA_PAGE_TEXT_CACHE", "") == "1"  # fatura metni de diske yazılsın mı
+MANIFEST_KEEP = 24
+
+
+def _hash_pdf_object(h, obj, memo: dict) -> None:
+    from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+    if isinstance(obj, IndirectObject):
+        ref = (obj.idnum, obj.generation)
+        digest = memo.get(ref)
+        if digest is None:
+            memo[ref] = b"R"  # döngü: işlenmekte olan nesneye geri referans
+            sub = hashlib.sha256()
+            _hash_pdf_object(sub, obj.get_object(), memo)
+            digest = memo[ref] = sub.digest()
+        h.update(digest)
+    elif isinstance(obj, DictionaryObject):
+        h.update(b"<<")
+        for k in sorted(obj):
+            if k != "/Parent":
+                h.update(k.encode("utf-8", "replace"))
+                _hash_pdf_object(h, obj.raw_get(k), memo)
+        if isinstance(obj, StreamObject):
+            h.update(b"stream")
+            try:
+                h.update(obj.get_data() or b"")
+            except Exception:  # çözülemeyen filtre: iz tekil olsun ki önbellekten yanlış sayfa gelmesin
+                h.update(uuid.uuid4().bytes)
+        h.update(b">>")
+    elif isinstance(obj, ArrayObject):
+        h.update(b"[")
+        for v in obj:
+            _hash_pdf_object(h, v, memo)
+        h.update(b"]")
+    else:
+        h.update(repr(obj).encode("utf-8", "replace"))
+
+
+_FP_MEMOS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_FP_MEMOS_LOCK = threading.Lock()
+
+
+def _document_fp_memo(page) -> dict:
+    """Sayfanın PdfReader'ına bağlı memo; okuyucu atılınca o da gider."""
+    with _FP_MEMOS_LOCK:
+        try:
+            return _FP_MEMOS.setdefault(page.pdf, {})
+        except TypeError:  # okuyucu yok / weakref desteklemiyor
+            return {}
+
+
+def page_fingerprint(page, memo: Optional[dict] = None) -> str:
+    """
+    Sayfanın çıktısını belirleyen her şeyin hash'i (nesne numaralarından bağımsız).
+    memo verilmezse sayfanın belgesine ait memo kullanılır; ortak fontlar/görseller
+    belge başına bir kez hash'lenir.
+    """
+    memo = _document_fp_memo(page) if memo is None else memo
+    if page.indirect_reference is not None:
+        memo.setdefault((page.indirect_reference.idnum, page.indirect_reference.generation), b"P")
+    h = hashlib.sha256()
+    _hash_pdf_object(h, page, memo)
+    return h.hexdigest()
+
+
+def _page_cache_path(name: str) -> str:
+    return os.path.join(PAGE_CACHE_DIR, name[:2], name)
+
+
+def _page_cache_write(name: str, data: bytes) -> None:
+    path = _page_cache_path(name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)  # işçiler aynı sayfayı yazsa da yarım dosya görünmez
+    except OSError:
+        pass
+
+
+def _page_cache_read(name: str) -> Optional[bytes]:
+    path = _page_cache_path(name)
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+        os.utime(path, None)
+        return data
+    except OSError:
+        return None
+
+
+def load_cached_page_record(fp: str) -> Optional[dict]:
+    data = _page_cache_read(fp + ".json") if PAGE_CACHE_MAX_BYTES > 0 else None
+    return json.loads(data) if data else None
+
+
+def store_page_record(fp: str, rec: dict) -> None:
+    """
+    Diske varsayılan olarak yalnız DaireID ve sayfanın tutarları yazılır; fatura metni
+    (ad, adres…) yalnız PAGE_TEXT_CACHE açıksa saklanır.
+    """
+    if PAGE_CACHE_MAX_BYTES > 0 and not rec.get("ocr"):
+        payload = {"raw": None, "norm": None, "daire_id": rec["daire_id"]}
+        if rec["norm"] is not None:
+            payload["totals"] = scan_manas_sections(rec["norm"])
+            if PAGE_TEXT_CACHE:
+                payload["raw"], payload["norm"] = rec["raw"], rec["norm"]
+        _page_cache_write(fp + ".json", json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+
+def _page_record_cached(page, fast_id: bool = False) -> dict:
+    """_extract_page_record + parmak izi önbelleği (aynı içerikli sayfa bir daha çıkarılmaz)."""
+    if PAGE_CACHE_MAX_BYTES <= 0:
+        return _extract_page_record(page, fast_id)
+    fp = page_fingerprint(page)
+    cached = load_cached_page_record(fp)
+    if cached is not None and (fast_id or cached["raw"] is not None):
+        return cached
+    rec = _extract_page_record(page, fast_id)
+    if cached is None or (rec["raw"] is not None and (PAGE_TEXT_CACHE or "totals" not in cached)):
+        store_page_record(fp, rec)
+    return rec
+
+
+def _stamp_settings_key(job_args: tuple, fast_id: bool) -> str:
+    """Damgalı sayfayı etkileyen ayarlar (dosya adı hariç; o sayfa no + DaireID'den üretilir)."""
+    footer_kwargs, stamp_on, label_tpl, stamp_opts, _rename, optimize = job_args
+    payload = [ARTIFACT_CACHE_VERSION, footer_kwargs, stamp_on, label_tpl if stamp_on else None,
+               stamp_opts if stamp_on else None, optimize, fast_id]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+                          .encode("utf-8")).hexdigest()[:24]
+
+
+def load_cached_stamp(fp: str, skey: str) -> Optional[Tuple[bytes, int, Optional[str]]]:
+    """(bayt, optimizasyon öncesi boyut, DaireID) ya da None."""
+    if PAGE_CACHE_MAX_BYTES <= 0:
+        return None
+    meta = _page_cache_read(f"{fp}-{skey}.json")
+    data = _page_cache_read(f"{fp}-{skey}.pdf") if meta else None
+    if data is None:
+        return None
+    meta = json.loads(meta)
+    return data, meta["size_before"], meta["daire_id"]
+
+
+def store_stamp(fp: str, skey: str, data: bytes, size_before: int, daire_id: Optional[str]) -> None:
+    if PAGE_CACHE_MAX_BYTES > 0:
+        _page_cache_write(f"{fp}-{skey}.pdf", data)
+        _page_cache_write(f"{fp}-{skey}.json", json.dumps(
+            {"size_before": size_before, "daire_id": daire_id}).encode("utf-8"))  # meta en son
+
+
+def prune_page_cache(max_bytes: int = PAGE_CACHE_MAX_BYTES) -> int:
+    """Sınır aşılırsa en eski kullanılan sayfa dosyalarını siler; silinen dosya sayısını döner."""
+    if not os.path.isdir(PAGE_CACHE_DIR):
+        return 0
+    entries, total = [], 0
+    for sub in os.scandir(PAGE_CACHE_DIR):
+        if not sub.is_dir() or sub.name == "manifests":
+            continue
+        for entry in os.scandir(sub.path):
+            try:
+                st_ = entry.stat()
+            except OSError:  # başka bir süreç silmiş olabilir
+                continue
+            entries.append((st_.st_mtime, entry.path, st_.st_size))
+            total += st_.st_size
+    entries.sort()
+    removed = 0
+    for _, path, size in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
+
+
+def _manifest_dir() -> str:
+    return os.path.join(PAGE_CACHE_DIR, "manifests")
+
+
+def save_page_manifest(pdf_hash: str, pages: List[dict]) -> None:
+    """pages: [{"fp", "daire_id"}] sayfa sırasıyla. En yeni MANIFEST_KEEP manifest tutulur."""
+    if PAGE_CACHE_MAX_BYTES <= 0:
+        return
+    mdir = _manifest_dir()
+    try:
+        os.makedirs(mdir, exist_ok=True)
+        tmp = os.path.join(mdir, f"{pdf_hash}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"pdf_hash": pdf_hash, "created": time.time(), "pages": pages}, fh, ensure_ascii=False)
+        os.replace(tmp, os.path.join(mdir, pdf_hash + ".json"))
+        olds = sorted((e.stat().st_mtime, e.path) for e in os.scandir(mdir) if e.name.endswith(".json"))
+        for _, path in olds[:-MANIFEST_KEEP]:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def load_page_manifest(pdf_hash: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(_manifest_dir(), pdf_hash + ".json"), "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def build_page_manifest(pdf_bytes: bytes) -> dict:
+    """Manifest yoksa oluşturur: parmak izleri + DaireID (metin depodan / önbellekten / çıkarılarak)."""
+    from pypdf import PdfReader
+    pdf_hash = pdf_content_hash(pdf_bytes)
+    manifest = load_page_manifest(pdf_hash)
+    if manifest is not None:
+        return manifest
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    put_page_texts(pdf_hash, {}, n_pages=len(reader.pages))
+    pages = []
+    for i, page in enumerate(reader.pages):
+        fp = page_fingerprint(page)
+        rec = _page_text_doc(pdf_hash)["pages"].get(i) or load_cached_page_record(fp)
+        if rec is None:
+            rec = get_page_text(pdf_hash, i, page, need_text=False)
+        pages.append({"fp": fp, "daire_id": rec["daire_id"]})
+    save_page_manifest(pdf_hash, pages)
+    return load_page_manifest(pdf_hash) or {"pdf_hash": pdf_hash, "created": time.time(), "pages": pages}
+
+
+def _previous_manifest(manifest: dict) -> Optional[dict]:
+    """
+    Bu manifestten önce oluşturulmuş manifestlerden en çok ortak sayfası olanı
+    (eşitse en yenisi); sonradan işlenmiş bir PDF önceki revizyon sayılmaz.
+    """
+    fps = {p["fp"] for p in manifest["pages"]}
+    created = manifest.get("created", time.time())
+    best, best_key = None, (0, 0.0)
+    try:
+        entries = list(os.scandir(_manifest_dir()))
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.name.endswith(".json") or entry.name[:-5] == manifest["pdf_hash"]:
+            continue
+        try:
+            with open(entry.path, "r", encoding="utf-8") as fh:
+                other = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        if other.get("created", 0.0) >= created:
+            continue
+        key = (len(fps & {p["fp"] for p in other["pages"]}), other.get("created", 0.0))
+        if key > best_key:
+            best, best_key = other, key
+    return best
+
+
+def _cached_totals(fp: str) -> Optional[Dict[str, float]]:
+    rec = load_cached_page_record(fp)
+    if not rec:
+        return None
+    if rec.get("totals") is not None:
+        return rec["totals"]
+    return scan_manas_sections(rec["norm"]) if rec["norm"] is not None else None
+
+
+def diff_page_manifests(old: dict, new: dict) -> dict:
+    """
+    Sayfa ve daire bazında fark: değişen/yeni sayfa no'ları, tutarı değişen, eklenen ve
+    çıkan daireler. Eski/yeni tutarlar önbellekte tam metin varsa eklenir.
+    """
+    old_fps = {p["fp"] for p in old["pages"]}
+    old_by_flat = {p["daire_id"]: p["fp"] for p in old["pages"] if p["daire_id"]}
+    new_by_flat = {p["daire_id"]: p["fp"] for p in new["pages"] if p["daire_id"]}
+    changed = sorted(d for d in new_by_flat.keys() & old_by_flat.keys() if new_by_flat[d] != old_by_flat[d])
+    flats = []
+    for did in changed:
+        before, after = _cached_totals(old_by_flat[did]), _cached_totals(new_by_flat[did])
+        flats.append({
+            "daire_id": did,
+            "toplam_onceki": before["toplam"] if before else None,
+            "toplam": after["toplam"] if after else None,
+        })
+    changed_pages = [i + 1 for i, p in enumerate(new["pages"]) if p["fp"] not in old_fps]
+    return {
+        "prev_pdf_hash": old["pdf_hash"],
+        "pages": len(new["pages"]),
+        "unchanged_pages": len(new["pages"]) - len(changed_pages),
+        "changed_pages": changed_pages,
+        "flats_changed": flats,
+        "flats_added": sorted(new_by_flat.keys() - old_by_flat.keys()),
+        "flats_removed": sorted(old_by_flat.keys() - new_by_flat.keys()),
+    }
+
+
+def revision_diff(pdf_bytes: bytes) -> Optional[dict]:
+    """
+    Bu PDF'i sayfaların en az yarısını paylaştığı en yakın önceki revizyonla karşılaştırır;
+    öyle bir revizyon yoksa None.
+    """
+    if PAGE_CACHE_MAX_BYTES <= 0:
+        return None
+    manifest = build_page_manifest(pdf_bytes)
+    prev = _previous_manifest(manifest)
+    if prev is None:
+        return None
+    shared = {p["fp"] for p in prev["pages"]} & {p["fp"] for p in manifest["pages"]}
+    if 2 * len(shared) < len(manifest["pages"]):  # sayfaların yarısı bile ortak değilse başka fatura
+        return None
+    return diff_page_manifests(prev, manifest)
+
+
+def format_revision_diff(d: dict) -> str:
+    msg = (f"Önceki revizyona göre: {d['unchanged_pages']}/{d['pages']} sayfa aynı (yeniden kullanıldı), "
+           f"{len(d['changed_pages'])} sayfa değişti/yeni • {len(d['flats_changed'])} dairenin sayfası değişti")
+    if d["flats_added"]:
+        msg += f" • eklenen: {', '.join(d['flats_added'][:10])}"
+    if d["flats_removed"]:
+        msg += f" • çıkan: {', '.join(d['flats_removed'][:10])}"
+    return msg
+
+# -----------------------------------------------------------------------------
+# OCR Yedeği (metin katmanı olmayan / taranmış sayfalar)
+# -----------------------------------------------------------------------------
+# Rasterleme pdf2image (poppler) ile; OCR motoru easyocr, yoksa pytesseract (tesseract).
+OCR_ENGINE = os.getenv("FATURA_OCR_ENGINE", "") or (
+    "easyocr" if _module_available("easyocr") else
+    "tesseract" if _module_available("pytesseract") else ""
+)
+HAS_OCR = bool(OCR_ENGINE) and _module_available("pdf2image")
+OCR_DPI = 200
+OCR_LANGS = ("tr", "en")
+OCR_CACHE_DIR = os.path.join(ARTIFACT_CACHE_DIR, "ocr")
+
+_OCR_WORKER_STATE: dict = {}
+
+
+def _load_ocr_model(engine: str):
+    """Model yüklemesi pahalıdır: süreç başına bir kez çağrılır."""
+    if engine == "easyocr":
+        import easyocr
+        return easyocr.Reader(list(OCR_LANGS), gpu=False, verbose=False)
+    if engine == "tesseract":
+        import pytesseract
+        return pytesseract
+    raise RuntimeError("OCR motoru yok (easyocr veya pytesseract kurun).")
+
+
+@st.cache_resource(show_spinner=False)
+def _shared_ocr_model(engine: str):
+    return _load_ocr_model(engine)
+
+
+def _ocr_image(model, engine: str, img) -> str:
+    if engine == "easyocr":
+        import numpy as np
+        return "\n".join(model.readtext(np.asarray(img), detail=0, paragraph=True))
+    lang = "+".join({"tr": "tur", "en": "eng"}.get(code, code) for code in OCR_LANGS)
+    return model.image_to_string(img, lang=lang)
+
+
+def _rasterize_page(pdf_bytes: bytes, page_index: int, dpi: int,
+                    region: Optional[Tuple[float, float, float, float]] = None):
+    """Tek sayfayı (0 tabanlı) PIL görüntüsüne çevirir; region verilirse o bölgeye kırpar."""
+    from pdf2image import convert_from_bytes
+    img = convert_from_bytes(pdf_bytes, dpi=dpi, first_page=page_index + 1, last_page=page_index + 1)[0]
+    if region is not None:
+        w, h = img.size
+        img = img.crop((int(region[0] * w), int(region[1] * h), int(region[2] * w), int(region[3] * h)))
+    return img
+
+
+def _ocr_page(model, engine: str, pdf_bytes: bytes, page_index: int, dpi: int, region) -> str:
+    return _ocr_image(model, engine, _rasterize_page(pdf_bytes, page_index, dpi, region))
+
+
+def _init_ocr_worker(pdf_bytes: bytes, engine: str):
+    """İşçi başına model bir kez yüklenir; PDF baytları fork ile paylaşılır."""
+    _OCR_WORKER_STATE["pdf_bytes"] = pdf_bytes
+    _OCR_WORKER_STATE["engine"] = engine
+    _OCR_WORKER_STATE["model"] = _load_ocr_model(engine)
+
+
+def _ocr_page_task(args: Tuple[int, int, Optional[tuple]]) -> Tuple[int, Optional[str], str]:
+    page_index, dpi, region = args
+    st_ = _OCR_WORKER_STATE
+    try:
+        return page_index, _ocr_page(st_["model"], st_["engine"], st_["pdf_bytes"], page_index, dpi, region), ""
+    except Exception as e:
+        return page_index, None, f"{type(e).__name__}: {e}"
+
+
+def _ocr_cache_path(page_hash: str, engine: str, dpi: int, region) -> str:
+    key = hashlib.sha256(f"{page_hash}|{engine}|{','.join(OCR_LANGS)}|{dpi}|{region}".encode("utf-8")).hexdigest()
+    return os.path.join(OCR_CACHE_DIR, key + ".txt")
+
+
+def _needs_ocr(rec: Optional[dict]) -> bool:
+    return rec is not None and rec["raw"] is not None and not rec["raw"].strip()
+
+
+def ocr_missing_pages(
+    pdf_bytes: bytes,
+    region: Optional[Tuple[float, float, float, float]] = None,
+    dpi: int = OCR_DPI,
+    workers: int = 1,
+    engine: Optional[str] = None,
+) -> dict:
+    """
+    Metin katmanı boş çıkan sayfaları OCR'lar ve sonuçları sayfa metin deposuna yazar;
+    ardından gelen DaireID tespiti ve parse_manas_pdf_totals bu metni kullanır.
+    region None => tam sayfa (tutarlar için); verilirse yalnız o bölge (DaireID için).
+    Yalnız gereken sayfalar rasterlenir; sonuçlar sayfa içeriği hash'iyle diskte önbelleklenir.
+    """
+    from pypdf import PdfReader
+    t0 = time.perf_counter()
+    engine = engine or OCR_ENGINE
+    stats = {"pages": 0, "cached": 0, "ocr": 0, "ids": 0, "errors": [], "seconds": 0.0}
+
+    pdf_hash = pdf_content_hash(pdf_bytes)
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    n_pages = len(reader.pages)
+    put_page_texts(pdf_hash, {}, n_pages=n_pages)
+    need_text = region is None
+
+    texts: Dict[int, str] = {}
+    todo: List[int] = []
+    cache_paths: Dict[int, str] = {}
+    for i, page in enumerate(reader.pages):
+        if not _needs_ocr(get_page_text(pdf_hash, i, page, need_text=need_text)):
+            continue
+        stats["pages"] += 1
+        path = cache_paths[i] = _ocr_cache_path(page_fingerprint(page), engine, dpi, region)
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                texts[i] = fh.read()
+            os.utime(path, None)  # LRU sırası
+            stats["cached"] += 1
+        except OSError:
+            todo.append(i)
+
+    if todo:
+        results: List[Tuple[int, Optional[str], str]] = []
+        if workers > 1 and len(todo) > 1:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            ctx = multiprocessing.get_context("fork")  # bkz. paralel motor notu
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=min(workers, len(todo)), mp_context=ctx,
+                    initializer=_init_ocr_worker, initargs=(pdf_bytes, engine),
+                ) as ex:
+                    results = list(ex.map(_ocr_page_task, [(i, dpi, region) for i in todo]))
+            except Exception as e:  # ör. işçide model yüklenemedi (BrokenProcessPool)
+                results = [(i, None, f"{type(e).__name__}: {e}") for i in todo]
+        else:
+            try:
+                model = _shared_ocr_model(engine)
+            except Exception as e:
+                model = None
+                results = [(i, None, f"{type(e).__name__}: {e}") for i in todo]
+            if model is not None:
+                for i in todo:
+                    try:
+                        results.append((i, _ocr_page(model, engine, pdf_bytes, i, dpi, region), ""))
+                    except Exception as e:
+                        results.append((i, None, f"{type(e).__name__}: {e}"))
+
+        os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+        for i, text, err in results:
+            if text is None:
+                stats["errors"].append(f"Sayfa {i + 1}: {err}")
+                continue
+            texts[i] = text
+            stats["ocr"] += 1
+            try:
+                with open(cache_paths[i], "w", encoding="utf-8") as fh:
+                    fh.write(text)
+            except OSError:
+                pass
+        if ARTIFACT_CACHE_MAX_BYTES > 0:  # OCR metinleri de çıktı önbelleğinin boyut sınırına tabi
+            state = _artifact_cache_state()
+            with state["lock"]:
+                _evict_artifacts("", ARTIFACT_CACHE_MAX_BYTES)
+
+    records: Dict[int, dict] = {}
+    for i, text in texts.items():
+        norm = _normalize_tr(text)
+        did = _find_daire_id(text, norm)
+        stats["ids"] += 1 if did else 0
+        if region is None:
+            records[i] = {"raw": text, "norm": norm, "daire_id": did, "ocr": True}
+        elif did:
+            records[i] = {"raw": None, "norm": None, "daire_id": did, "ocr": True}
+    put_page_texts(pdf_hash, records)
+    stats["seconds"] = time.perf_counter() - t0
+    return stats
+
+
+def format_ocr_stats(stats: dict) -> str:
+    msg = (f"OCR: {stats['pages']} sayfada metin katmanı yok • {stats['cached']} önbellekten, "
+           f"{stats['ocr']} yeni OCR • {stats['ids']} DaireID bulundu • {stats['seconds']:.1f} sn")
+    if stats["errors"]:
+        msg += f" • {len(stats['errors'])} hata (ilk: {stats['errors'][0]})"
+    return msg
+
+# -----------------------------------------------------------------------------
+# MANAS PDF Parser (Isıtma / Sıcak Su / Su / Toplam)
+# -----------------------------------------------------------------------------
+_RE_ODENECEK = re.compile(r"(?:ÖDENECEK|ODENECEK)\s*TUTAR[^0-9]{0,10}([0-9\.\,]+)", re.IGNORECASE)
+_RE_TOPLAM = re.compile(r"TOPLAM\s+TUTAR[^0-9]{0,10}([0-9\.\,]+)", re.IGNORECASE)
+_MANAS_WINDOW = 2500     # bölüm başlığından sonra tutarın arandığı pencere
+_MANAS_SU_WINDOW = 2000
+
+
+def scan_manas_sections(norm: str) -> Dict[str, float]:
+    """
+    Normalize sayfa metninden ISITMA / SICAK SU / SU / TOPLAM tutarlarını çıkarır.
+    Başlık konumları bir kez str.find ile bulunur; tutar, başlıktan sonraki pencerede
+    dilim kopyası almadan (pos/endpos) aranır. Sonuçlar eski bul + dilimle yöntemiyle aynıdır.
+    """
+    def amount_after(idx: int, window: int) -> float:
+        if idx == -1:
+            return 0.0
+        m = _RE_ODENECEK.search(norm, idx, idx + window)
+        return _to_float_tr(m.group(1)) if m else 0.0
+
+    idx_sicak = norm.find("SICAK SU")
+    isitma = amount_after(norm.find("ISITMA"), _MANAS_WINDOW)
+    sicak = amount_after(idx_sicak, _MANAS_WINDOW)
+
+    # SU başlığı SICAK SU ile karışmasın: SICAK SU'dan sonrası taranır.
+    base = idx_sicak + 8 if idx_sicak != -1 else 0
+    idx_nl_su = norm.find("\nSU")
+    idx_su = idx_nl_su if idx_nl_su >= base else norm.find("\nSU", base)
+    if idx_su == -1:
+        idx_su = norm.find(" SU ", base)
+    su = amount_after(idx_su, _MANAS_SU_WINDOW)
+    if su == 0.0:
+        su = amount_after(idx_nl_su, _MANAS_WINDOW)
+
+    mt = _RE_TOPLAM.search(norm)
+    toplam = _to_float_tr(mt.group(1)) if mt else (isitma + sicak + su)
+    return {"isitma": isitma, "sicak": sicak, "su": su, "toplam": toplam}
+
+
+def pdf_page_count(pdf_bytes: bytes, pdf_hash: Optional[str] = None) -> int:
+    """Sayfa sayısı; depoda biliniyorsa PDF açılmaz."""
+    from pypdf import PdfReader
+    pdf_hash = pdf_hash or pdf_content_hash(pdf_bytes)
+    doc = _page_text_doc(pdf_hash)
+    if doc["n_pages"] is None:
+        put_page_texts(pdf_hash, {}, n_pages=len(PdfReader(io.BytesIO(pdf_bytes)).pages))
+    return doc["n_pages"]
+
+
+def iter_manas_pdf_totals(
+    pdf_bytes: bytes, max_pages: Optional[int] = None
+) -> Iterator[Tuple[int, Optional[str], Optional[Dict[str, float]]]]:
+    """
+    Sayfa sayfa (sayfa_index, daire_id, tutarlar) üretir; DaireID bulunamayan sayfada
+    daire_id ve tutarlar None'dır. max_pages: ilk N sayfadan sonra durur (hızlı doğrulama).
+    Döngüyü kırmak da yeterlidir; kalan sayfaların metni çıkarılmaz.
+    """
+    # Sayfa metinleri ortak depodan gelir; Tab A aynı PDF'i işlediyse yeniden çıkarılmaz.
+    if max_pages is not None and max_pages <= 0:
+        return
+    for pi, rec in iter_pdf_page_texts(pdf_bytes):
+        did = rec["daire_id"]
+        yield pi, did, (scan_manas_sections(rec["norm"]) if did else None)
+        if max_pages is not None and pi + 1 >= max_pages:
+            return
+
+
+def parse_manas_pdf_totals(pdf_bytes: bytes, max_pages: Optional[int] = None) -> Dict[str, Dict[str, float]]:
+    return {did: vals for _, did, vals in iter_manas_pdf_totals(pdf_bytes, max_pages) if did}
+
+# -----------------------------------------------------------------------------
+# Tutar Mutabakatı & Anomali Raporu
+# -----------------------------------------------------------------------------
+RECON_TOLERANCE = 0.05   # TL; kalemler toplamı ile TOPLAM arasındaki kuruş yuvarlaması
+RECON_OUTLIER_Z = 3.5    # robust z (medyan / MAD) eşiği
+_RECON_COLS = ["isitma", "sicak", "su", "toplam"]
+_RECON_LABELS = {"isitma": "Isıtma", "sicak": "Sıcak Su", "su": "Su"}
+
+
+def reconcile_totals(
+    totals_map: Dict[str, Dict[str, float]],
+    tolerance: float = RECON_TOLERANCE,
+    z_limit: float = RECON_OUTLIER_Z,
+) -> pd.DataFrame:
+    """
+    Tüm daireleri tek seferde (vektörel) denetler:
+      fark          = toplam - (isitma + sicak + su);  uyumsuz = |fark| > tolerance
+      sifir_tuketim = üç kalem de 0
+      aykiri        = bir kalemin site geneline göre robust z'si (0.6745·(x−medyan)/MAD) > z_limit
+                      (sıfır tüketimli daireler bu ölçüye katılmaz; zaten ayrıca işaretlidir)
+    Ek fark eklenmeden önceki (PDF'teki) tutarlarla çağrılmalıdır.
+    """
+    import numpy as np
+    import pandas as pd
+    df = pd.DataFrame.from_dict(totals_map, orient="index", columns=_RECON_COLS).astype(float).fillna(0.0)
+    df = df.rename_axis("daire_id").reset_index().sort_values("daire_id", ignore_index=True)
+
+    vals = df[_RECON_COLS].to_numpy()
+    parts = vals[:, :3].sum(axis=1)
+    diff = vals[:, 3] - parts
+    df["kalem_toplami"] = parts.round(2)
+    df["fark"] = diff.round(2)
+    df["uyumsuz"] = np.abs(diff) > tolerance
+    df["sifir_tuketim"] = ~vals[:, :3].any(axis=1)
+
+    used = ~df["sifir_tuketim"].to_numpy()
+    z_abs = np.zeros((len(df), 3))
+    if used.any():
+        med = np.median(vals[used, :3], axis=0)
+        mad = np.median(np.abs(vals[used, :3] - med), axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z_abs[used] = np.abs(np.where(mad > 0, 0.6745 * (vals[used, :3] - med) / mad, 0.0))
+    df["z_max"] = z_abs.max(axis=1, initial=0.0).round(2)
+    df["aykiri"] = df["z_max"] > z_limit
+    worst = np.array([_RECON_LABELS[c] for c in _RECON_COLS[:3]], dtype=object)[z_abs.argmax(axis=1)]
+
+    durum = (
+        pd.Series(np.where(df["uyumsuz"], "toplam ≠ kalemler; ", ""), dtype=object)
+        + np.where(df["sifir_tuketim"], "sıfır tüketim; ", "")
+        + np.where(df["aykiri"], "aykırı " + pd.Series(worst, dtype=object) + "; ", "")
+    )
+    df["durum"] = durum.str.rstrip("; ")
+    return df
+
+
+def reconcile_summary(df: pd.DataFrame) -> dict:
+    return {
+        "daire": int(len(df)),
+        "uyumsuz": int(df["uyumsuz"].sum()),
+        "sifir_tuketim": int(df["sifir_tuketim"].sum()),
+        "aykiri": int(df["aykiri"].sum()),
+        "toplam_fark": round(float(df["fark"].sum()), 2),
+    }
+
+
+def format_reconcile_summary(s: dict) -> str:
+    return (f"Mutabakat: {s['daire']} daire • {s['uyumsuz']} toplam uyumsuz "
+            f"(net fark {s['toplam_fark']:,.2f} TL) • {s['sifir_tuketim']} sıfır tüketim • {s['aykiri']} aykırı")
+
+
+def anomaly_report_bytes(df: pd.DataFrame) -> bytes:
+    """Anomaliler / Tüm Daireler / Özet sayfalarından oluşan Excel raporu."""
+    import pandas as pd
+    flagged = df[df["uyumsuz"] | df["sifir_tuketim"] | df["aykiri"]]
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        flagged.to_excel(writer, index=False, sheet_name="Anomaliler")
+        df.to_excel(writer, index=False, sheet_name="Tüm Daireler")
+        pd.DataFrame(
+            [{"Kalem": k, "Değer": v} for k, v in reconcile_summary(df).items()]
+        ).to_excel(writer, index=False, sheet_name="Özet")
+    output.seek(0)
+    return output.getvalue()
+
+# -----------------------------------------------------------------------------
+# Apsiyon Excel Yardımcıları
+# -----------------------------------------------------------------------------
+APSIYON_MODES = [
+    "Seçenek 1 (G1=Sıcak Su, G2=Su, G3=Isıtma)",
+    "Seçenek 2 (G1=Toplam, G2/G3 boş)",
+    "Seçenek 3 (G1=Sıcak Su)",
+    "Seçenek 4 (G1=Su)",
+    "Seçenek 5 (G1=Isıtma)",
+]
+APSIYON_SOURCES = ["PDF (A sekmesi)", "Kayıtlı dönem"]
+
+
+def _norm_cols(s: str) -> str:
+    return (str(s).strip().lower()
+            .replace("\n", " ").replace("\r", " ")
+            .replace(".", "").replace("_", " ").replace("-", " "))
+
+
+def _pad3_aps(x) -> str:
+    try:
+        n = int(str(x).strip())
+        return f"{n:03d}"
+    except:
+        s = str(x).strip()
+        nums = "".join([ch for ch in s if ch.isdigit()])
+        return f"{int(nums):03d}" if nums else s
+
+
+def _is_aps_header_row(row: list) -> bool:
+    cells = [_norm_cols(c) for c in row]
+    row_text = " | ".join(cells)
+    return ("blok" in row_text) and (("daire no" in row_text) or ("daire" in row_text))
+
+
+def _rename_apsiyon_cols(df: pd.DataFrame) -> pd.DataFrame:
+    mapping = {}
+    for c in df.columns:
+        nc = _norm_cols(c)
         if "blok" == nc:
             mapping[c] = "Blok"
         elif ("daire no" == nc) or (nc == "daire") or ("daire  no" == nc) or ("daireno" == nc):
@@ -558,14 +2100,73 @@ def _rename_apsiyon_cols(df: pd.DataFrame) -> pd.DataFrame:
     return df2
 
 
-def load_apsiyon_template(excel_bytes: bytes) -> pd.DataFrame:
+def _convert_aps_cell(cell):
+    # pandas'ın openpyxl okuyucusuyla aynı dönüşüm (boş → "", tam sayı float → int)
+    v = cell.value
+    if v is None:
+        return ""
+    if cell.data_type == "e":
+        return float("nan")
+    if cell.data_type == "n":
+        n = int(v)
+        return n if n == v else float(v)
+    return v
+
+
+def _xlsx_rows(excel_bytes: bytes) -> Iterator[tuple]:
+    """İlk sayfanın satırlarını (openpyxl hücreleri) read-only akışla üretir."""
     from io import BytesIO
-    raw = pd.read_excel(BytesIO(excel_bytes), header=None, engine="openpyxl")
-    hdr = _find_header_row(raw)
-    if hdr is None:
-        df = pd.read_excel(BytesIO(excel_bytes), engine="openpyxl")
-    else:
-        df = pd.read_excel(BytesIO(excel_bytes), header=hdr, engine="openpyxl")
+    from openpyxl import load_workbook
+    wb = load_workbook(BytesIO(excel_bytes), read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        yield from ws.rows
+    finally:
+        wb.close()
+
+
+def read_apsiyon_sheet(excel_bytes: bytes, stats: Optional[dict] = None) -> pd.DataFrame:
+    """
+    Şablonun ilk sayfasını openpyxl read-only ile TEK geçişte okur.
+    Başlık satırı (ilk 15 satırda 'Blok' + 'Daire') akış sırasında bulunur;
+    sonuç pd.read_excel(header=hdr) ile aynıdır.
+    """
+    import pandas as pd
+    from pandas.errors import EmptyDataError
+    from pandas.io.parsers import TextParser
+
+    t0 = time.perf_counter()
+    data, hdr, last = [], None, -1
+    for i, row in enumerate(_xlsx_rows(excel_bytes)):
+        vals = [_convert_aps_cell(c) for c in row]
+        while vals and vals[-1] == "":
+            vals.pop()
+        if vals:
+            last = i
+        if hdr is None and i < 15 and vals and _is_aps_header_row(vals):
+            hdr = i
+        data.append(vals)
+
+    data = data[: last + 1]
+    if data:
+        width = max(len(r) for r in data)
+        data = [r + [""] * (width - len(r)) for r in data]
+    try:
+        df = TextParser(data, header=hdr or 0, skip_blank_lines=False).read()
+    except EmptyDataError:
+        df = pd.DataFrame()
+
+    if stats is not None:
+        stats["rows"] = len(df)
+        stats["columns"] = df.shape[1]
+        stats["header_row"] = hdr
+        stats["seconds"] = time.perf_counter() - t0
+    return df
+
+
+def load_apsiyon_template(excel_bytes: bytes, stats: Optional[dict] = None) -> pd.DataFrame:
+    df = read_apsiyon_sheet(excel_bytes, stats=stats)
     df = _rename_apsiyon_cols(df)
     if ("Blok" not in df.columns) or ("Daire No" not in df.columns):
         st.error("Excel’de 'Blok' ve 'Daire No' sütunları bulunamadı.")
@@ -574,6 +2175,36 @@ def load_apsiyon_template(excel_bytes: bytes) -> pd.DataFrame:
     return df
 
 
+# Seçenek → (G1, G2, G3) kalemleri; None olan gider boşaltılır
+_APSIYON_MODE_FIELDS = {
+    "Seçenek 1": ("sicak", "su", "isitma"),
+    "Seçenek 2": ("toplam", None, None),
+    "Seçenek 3": ("sicak", None, None),
+    "Seçenek 4": ("su", None, None),
+    "Seçenek 5": ("isitma", None, None),
+}
+
+
+def _map_unique(col: pd.Series, fn):
+    # fn yalnız benzersiz değerlere uygulanır; sonuç satırlara kodlarla dağıtılır
+    import numpy as np
+    import pandas as pd
+    codes, uniques = pd.factorize(col, use_na_sentinel=False)
+    return np.array([fn(u) for u in uniques], dtype=object)[codes]
+
+
+def apsiyon_daire_ids(df: pd.DataFrame) -> pd.Series:
+    """Şablon satırlarının DaireID'si ('A1-001'); Blok/Daire No satır satır değil, benzersiz değer başına çözülür."""
+    import numpy as np
+    import pandas as pd
+    n = len(df)
+    blok = (_map_unique(df["Blok"], lambda v: str(v).strip().upper())
+            if "Blok" in df.columns else np.full(n, "", dtype=object))
+    dno = (_map_unique(df["Daire No"], _pad3_aps)
+           if "Daire No" in df.columns else np.full(n, "", dtype=object))
+    return pd.Series(blok + "-" + dno, index=df.index, dtype=object)
+
+
 def fill_expenses_to_apsiyon(
     df_in: pd.DataFrame,
     totals: dict,
@@ -582,52 +2213,45 @@ def fill_expenses_to_apsiyon(
     exp2: str,
     exp3: str,
 ) -> pd.DataFrame:
+    import numpy as np
+    import pandas as pd
     df = df_in.copy()
 
-    def make_did(blok, dno) -> str:
-        b = str(blok).strip().upper()
-        d = _pad3_aps(dno)
-        return f"{b}-{d}"
-
     g1t, g1a = "Gider1 Tutarı", "Gider1 Açıklaması"
     g2t, g2a = "Gider2 Tutarı", "Gider2 Açıklaması"
     g3t, g3a = "Gider3 Tutarı", "Gider3 Açıklaması"
-
-    for idx, row in df.iterrows():
-        did = make_did(row.get("Blok", ""), row.get("Daire No", ""))
-        if did in totals:
-            t = totals[did]
-
-            if mode.startswith("Seçenek 1"):
-                # G1=Sıcak Su, G2=Su, G3=Isıtma
-                df.at[idx, g1t] = t.get("sicak", 0.0);  df.at[idx, g1a] = exp1 or ""
-                df.at[idx, g2t] = t.get("su", 0.0);     df.at[idx, g2a] = exp2 or ""
-                df.at[idx, g3t] = t.get("isitma", 0.0); df.at[idx, g3a] = exp3 or ""
-
-            elif mode.startswith("Seçenek 2"):
-                # G1=Toplam, G2/G3 boş
-                df.at[idx, g1t] = t.get("toplam", 0.0); df.at[idx, g1a] = exp1 or ""
-                df.at[idx, g2t] = None; df.at[idx, g2a] = None
-                df.at[idx, g3t] = None; df.at[idx, g3a] = None
-
-            elif mode.startswith("Seçenek 3"):
-                # G1=Sıcak Su
-                df.at[idx, g1t] = t.get("sicak", 0.0);  df.at[idx, g1a] = exp1 or ""
-                df.at[idx, g2t] = None; df.at[idx, g2a] = None
-                df.at[idx, g3t] = None; df.at[idx, g3a] = None
-
-            elif mode.startswith("Seçenek 4"):
-                # G1=Su
-                df.at[idx, g1t] = t.get("su", 0.0);     df.at[idx, g1a] = exp1 or ""
-                df.at[idx, g2t] = None; df.at[idx, g2a] = None
-                df.at[idx, g3t] = None; df.at[idx, g3a] = None
-
-            elif mode.startswith("Seçenek 5"):
-                # G1=Isıtma
-                df.at[idx, g1t] = t.get("isitma", 0.0); df.at[idx, g1a] = exp1 or ""
-                df.at[idx, g2t] = None; df.at[idx, g2a] = None
-                df.at[idx, g3t] = None; df.at[idx, g3a] = None
-
+    # boş açıklama sütunları float64 (NaN) okunur; metin yazılabilsin
+    for col in (g1a, g2a, g3a):
+        df[col] = df[col].astype(object)
+
+    fields = next((f for k, f in _APSIYON_MODE_FIELDS.items() if mode.startswith(k)), None)
+    if fields is None or not totals or df.empty:
+        return df
+
+    # tutarlar tek DataFrame'e; şablona DaireID üzerinden bir kez eşlenir
+    keys = ("sicak", "su", "isitma", "toplam")
+    tot = pd.DataFrame(
+        [[t.get(k, 0.0) for k in keys] for t in totals.values()],
+        index=list(totals.keys()), columns=keys,
+    )
+    dids = apsiyon_daire_ids(df)
+    mask = dids.isin(tot.index).to_numpy()
+    if not mask.any():
+        return df
+    matched = tot.reindex(dids[mask])
+
+    def put(col, value):
+        # aynı adlı birden çok sütun olabilir (şablonda tekrar eden başlık)
+        for j in np.flatnonzero(df.columns == col):
+            df.iloc[mask, j] = value
+
+    for (tcol, acol), field, exp in zip(((g1t, g1a), (g2t, g2a), (g3t, g3a)), fields, (exp1, exp2, exp3)):
+        if field is None:
+            put(tcol, None)
+            put(acol, None)
+        else:
+            put(tcol, matched[field].to_numpy())
+            put(acol, exp or "")
     return df
 
 
@@ -635,6 +2259,7 @@ def export_excel_bytes(df_out: pd.DataFrame, summary: Optional[dict] = None) ->
     """
     Apsiyon çıktısını Excel'e yazar; varsa summary'yi ayrı bir sayfaya koyar.
     """
+    import pandas as pd
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine="openpyxl") as writer:
         df_out.to_excel(writer, index=False, sheet_name="Giderler")
@@ -646,6 +2271,509 @@ def export_excel_bytes(df_out: pd.DataFrame, summary: Optional[dict] = None) ->
     output.seek(0)
     return output.getvalue()
 
+# Hücre yaması: şablon zip'i açılır, yalnız ilk sayfanın değişen Gider hücreleri
+# XML'de yerinde değiştirilir; diğer parçalar (biçim, ek sayfalar) aynen kopyalanır.
+APSIYON_EXPORTS = ["Şablonu koru (yalnız değişen hücreler)", "Tablodan yeniden oluştur"]
+_APS_GIDER_COLS = ("Gider1 Tutarı", "Gider1 Açıklaması", "Gider2 Tutarı",
+                   "Gider2 Açıklaması", "Gider3 Tutarı", "Gider3 Açıklaması")
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_REL_WS = _NS_REL + "/worksheet"
+_CT_WS = "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"
+
+_RE_X_ROW = re.compile(rb"<((?:\w+:)?)row\b([^>]*?)(?:/>|>(.*?)</\1row>)", re.S)
+_RE_X_CELL = re.compile(rb"<((?:\w+:)?)c\b([^>]*?)(?:/>|>(.*?)</\1c>)", re.S)
+_RE_X_ROW_NUM = re.compile(rb'\br="(\d+)"')
+_RE_X_CELL_REF = re.compile(rb'\br="([A-Z]+)\d+"')
+_RE_X_STYLE = re.compile(rb'\bs="(\d+)"')
+_RE_X_SPANS = re.compile(rb'\s+spans="[^"]*"')
+_RE_X_FORMULA = re.compile(rb"<(?:\w+:)?f\b")
+_RE_X_DIM = re.compile(rb'(<(?:\w+:)?dimension\b[^>]*\bref=")([A-Z]+\d+:)?([A-Z]+)(\d+)(")')
+_RE_X_SHEET = re.compile(rb"<(?:\w+:)?sheet\b[^>]*>")
+
+
+def _col_letter(n: int) -> bytes:
+    out = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        out = chr(65 + r) + out
+    return out.encode()
+
+
+def _col_index(letters: bytes) -> int:
+    n = 0
+    for ch in letters:
+        n = n * 26 + ch - 64
+    return n
+
+
+def _xml_cell(pfx: bytes, ref: bytes, style: bytes, value) -> bytes:
+    from xml.sax.saxutils import escape
+    attrs = b'r="%s"' % ref + (b' s="%s"' % style if style else b"")
+    if value is None:
+        return b"<%sc %s/>" % (pfx, attrs)
+    if isinstance(value, str):
+        sp = b' xml:space="preserve"' if value != value.strip() else b""
+        return b'<%sc %s t="inlineStr"><%sis><%st%s>%s</%st></%sis></%sc>' % (
+            pfx, attrs, pfx, pfx, sp, escape(value).encode("utf-8"), pfx, pfx, pfx)
+    num = repr(float(value)) if isinstance(value, float) else str(value)
+    return b"<%sc %s><%sv>%s</%sv></%sc>" % (pfx, attrs, pfx, num.encode(), pfx, pfx)
+
+
+def _xml_row_cells(pfx: bytes, rn: int, body: bytes, pending: list) -> Tuple[bytes, bool, bool]:
+    """Satır gövdesine pending [(sütun, değer)] hücrelerini sırasına göre yerleştirir."""
+    cells, cpos, cprev, inserted, formula_hit = [], 0, 0, False, False
+    for cm in _RE_X_CELL.finditer(body):
+        ref = _RE_X_CELL_REF.search(cm.group(2))
+        col = _col_index(ref.group(1)) if ref else cprev + 1
+        cprev = col
+        cells.append(body[cpos:cm.start()])
+        while pending and pending[0][0] < col:
+            c, v = pending.pop(0)
+            cells.append(_xml_cell(pfx, _col_letter(c) + str(rn).encode(), b"", v))
+            inserted = True
+        if pending and pending[0][0] == col:
+            _, v = pending.pop(0)
+            sm = _RE_X_STYLE.search(cm.group(2))
+            formula_hit |= bool(cm.group(3) and _RE_X_FORMULA.search(cm.group(3)))
+            cells.append(_xml_cell(pfx, _col_letter(col) + str(rn).encode(), sm.group(1) if sm else b"", v))
+        else:
+            cells.append(cm.group(0))
+        cpos = cm.end()
+    cells.append(body[cpos:])
+    for c, v in pending:
+        cells.append(_xml_cell(pfx, _col_letter(c) + str(rn).encode(), b"", v))
+        inserted = True
+    return b"".join(cells), inserted, formula_hit
+
+
+def _patch_sheet_xml(xml: bytes, patches: Dict[int, Dict[int, object]]) -> Tuple[bytes, bool]:
+    """patches: {satır: {sütun: değer}} (1 tabanlı). Döner: (yeni xml, formül ezildi mi)."""
+    todo = sorted(patches)  # XML'de hiç olmayan (boş) satırlar sırasına göre eklenir
+    out, pos, prev, formula_hit, pfx = [], 0, 0, False, b""
+
+    def new_rows(upto: Optional[int]) -> bytes:
+        rows = []
+        while todo and (upto is None or todo[0] < upto):
+            rn = todo.pop(0)
+            body, _, _ = _xml_row_cells(pfx, rn, b"", sorted(patches[rn].items()))
+            rows.append(b'<%srow r="%d">%s</%srow>' % (pfx, rn, body, pfx))
+        return b"".join(rows)
+
+    for m in _RE_X_ROW.finditer(xml):
+        rm = _RE_X_ROW_NUM.search(m.group(2))
+        rn = int(rm.group(1)) if rm else prev + 1
+        prev, pfx = rn, m.group(1)
+        if not todo or todo[0] > rn:
+            continue
+        out.append(xml[pos:m.start()])
+        out.append(new_rows(rn))
+        if todo and todo[0] == rn:
+            todo.pop(0)
+            body, inserted, hit = _xml_row_cells(pfx, rn, m.group(3) or b"", sorted(patches[rn].items()))
+            formula_hit |= hit
+            attrs = _RE_X_SPANS.sub(b"", m.group(2)) if inserted else m.group(2)
+            out.append(b"<%srow%s>%s</%srow>" % (pfx, attrs, body, pfx))
+        else:
+            out.append(m.group(0))
+        pos = m.end()
+    out.append(xml[pos:])
+    xml = b"".join(out)
+    if todo:
+        sm = re.search(rb"<((?:\w+:)?)sheetData\s*/>", xml)
+        if sm:
+            pfx = sm.group(1)
+            xml = xml[:sm.start()] + b"<%ssheetData>%s</%ssheetData>" % (pfx, new_rows(None), pfx) + xml[sm.end():]
+        else:
+            sm = re.search(rb"</((?:\w+:)?)sheetData>", xml)
+            pfx = sm.group(1)
+            xml = xml[:sm.start()] + new_rows(None) + xml[sm.start():]
+
+    max_col = max((c for row in patches.values() for c in row), default=0)
+    dm = _RE_X_DIM.search(xml)
+    if dm and max_col > _col_index(dm.group(3)):
+        xml = xml[:dm.start()] + dm.group(1) + (dm.group(2) or b"") + _col_letter(max_col) \
+            + dm.group(4) + dm.group(5) + xml[dm.end():]
+    return xml, formula_hit
+
+
+def _gider_cell_patches(
+    df_tpl: pd.DataFrame, df_out: pd.DataFrame, header_row: int, sheet_cols: int
+) -> Dict[int, Dict[int, object]]:
+    import numpy as np
+    patches: Dict[int, Dict[int, object]] = {}
+    first = header_row + 2  # ilk veri satırının sayfa satırı (1 tabanlı)
+    for j, col in enumerate(df_out.columns):
+        if col not in _APS_GIDER_COLS:
+            continue
+        if j >= sheet_cols:  # şablonda olmayan sütun: başlığı da yazılır
+            patches.setdefault(header_row + 1, {})[j + 1] = col
+        new = df_out.iloc[:, j]
+        old = df_tpl.iloc[:, j]
+        same = ((new == old) | (new.isna() & old.isna())).to_numpy(dtype=bool)
+        for k in np.flatnonzero(~same):
+            v = new.iat[k]
+            if v is None or (isinstance(v, float) and v != v):
+                v = None
+            elif isinstance(v, np.generic):
+                v = v.item()
+            elif not isinstance(v, (str, int, float)):
+                v = str(v)
+            patches.setdefault(first + int(k), {})[j + 1] = v
+    return patches
+
+
+def _summary_sheet_xml(summary: dict) -> bytes:
+    rows = [("Kalem", "Tutar")] + [(k, v) for k, v in summary.items()]
+    body = b"".join(
+        b'<row r="%d">%s%s</row>' % (
+            i, _xml_cell(b"", b"A%d" % i, b"", str(k)), _xml_cell(b"", b"B%d" % i, b"", v))
+        for i, (k, v) in enumerate(rows, start=1)
+    )
+    return (b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            b"<sheetData>%s</sheetData></worksheet>" % body)
+
+
+def patch_apsiyon_excel_bytes(
+    template_bytes: bytes,
+    df_tpl: pd.DataFrame,
+    df_out: pd.DataFrame,
+    header_row: Optional[int],
+    sheet_cols: int,
+    summary: Optional[dict] = None,
+    stats: Optional[dict] = None,
+) -> bytes:
+    """
+    Doldurulmuş tabloyu şablonun KENDİSİNE yazar: yalnız değişen Gider hücreleri
+    ilk sayfada değiştirilir, summary varsa 'Özet' sayfası eklenir. Biçim, diğer
+    sayfalar ve dokunulmayan hücreler olduğu gibi kalır.
+    header_row / sheet_cols: load_apsiyon_template(stats=...) çıktısındaki değerler.
+    """
+    t0 = time.perf_counter()
+    patches = _gider_cell_patches(df_tpl, df_out, header_row or 0, sheet_cols)
+
+    zin = zipfile.ZipFile(io.BytesIO(template_bytes))
+    names = set(zin.namelist())
+    wb_xml = zin.read("xl/workbook.xml")
+    rels = zin.read("xl/_rels/workbook.xml.rels")
+    ctypes = zin.read("[Content_Types].xml")
+
+    sheets = _RE_X_SHEET.findall(wb_xml)
+    if not sheets:
+        raise ValueError("Şablonda sayfa bulunamadı.")
+    rid = re.search(rb'\b\w+:id="([^"]+)"', sheets[0]).group(1)
+    rel = re.search(rb'<(?:\w+:)?Relationship\b[^>]*\bId="%s"[^>]*>' % re.escape(rid), rels).group(0)
+    target = re.search(rb'\bTarget="([^"]+)"', rel).group(1).decode()
+    sheet_part = target.lstrip("/") if target.startswith("/") else "xl/" + target
+
+    replaced = {}
+    sheet_xml, formula_hit = _patch_sheet_xml(zin.read(sheet_part), patches)
+    replaced[sheet_part] = sheet_xml
+    dropped = set()
+    if formula_hit and "xl/calcChain.xml" in names:
+        # ezilen formüller calcChain'de kalırsa Excel "onarım" ister; Excel yeniden kurar
+        dropped.add("xl/calcChain.xml")
+        rels = re.sub(rb"<(?:\w+:)?Relationship\b[^>]*calcChain[^>]*/>", b"", rels)
+        ctypes = re.sub(rb"<(?:\w+:)?Override\b[^>]*calcChain[^>]*/>", b"", ctypes)
+
+    added = {}
+    if summary:
+        titles = {re.search(rb'\bname="([^"]*)"', t).group(1).decode("utf-8") for t in sheets}
+        title, n = "Özet", 2
+        while title in titles:
+            title, n = f"Özet {n}", n + 1
+        k = 1
+        while f"xl/worksheets/sheet{k}.xml" in names:
+            k += 1
+        new_rid, n = "rIdOzet", 2
+        while b'Id="%s"' % new_rid.encode() in rels:
+            new_rid, n = f"rIdOzet{n}", n + 1
+        sheet_id = max(int(x) for x in re.findall(rb'\bsheetId="(\d+)"', wb_xml)) + 1
+        rpfx = re.search(rb'\b(\w+):id="', sheets[0]).group(1)
+        tag = b'<sheet xmlns:%s="%s" name="%s" sheetId="%d" %s:id="%s"/>' % (
+            rpfx, _NS_REL.encode(), title.encode("utf-8"), sheet_id, rpfx, new_rid.encode())
+        wb_xml = re.sub(rb"(</(?:\w+:)?sheets>)", lambda m: tag + m.group(1), wb_xml, count=1)
+        rels = rels.replace(b"</Relationships>", b'<Relationship Id="%s" Type="%s" Target="worksheets/sheet%d.xml"/></Relationships>'
+                            % (new_rid.encode(), _NS_REL_WS.encode(), k))
+        ctypes = ctypes.replace(b"</Types>", b'<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="%s"/></Types>'
+                                % (k, _CT_WS.encode()))
+        replaced["xl/workbook.xml"] = wb_xml
+        added[f"xl/worksheets/sheet{k}.xml"] = _summary_sheet_xml(summary)
+    if summary or dropped:
+        replaced["xl/_rels/workbook.xml.rels"] = rels
+        replaced["[Content_Types].xml"] = ctypes
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for info in zin.infolist():
+            if info.filename in dropped:
+                continue
+            zout.writestr(info, replaced.get(info.filename) or zin.read(info.filename))
+        for name, data in added.items():
+            zout.writestr(name, data)
+    zin.close()
+
+    if stats is not None:
+        stats["cells"] = sum(len(v) for v in patches.values())
+        stats["rows"] = len(patches)
+        stats["seconds"] = time.perf_counter() - t0
+    return out.getvalue()
+
+
+# -----------------------------------------------------------------------------
+# Toplu Apsiyon Doldurma (çok site / dönem)
+# -----------------------------------------------------------------------------
+# İş sözlüğü: name, pdf_bytes, template_bytes, mode, extra, exp1, exp2, exp3, patch
+_BATCH_COLS = ["job", "ok", "error", "pages", "daire", "matched", "pdf_only", "template_only",
+               "missing_pages", "duplicates", "uyumsuz", "pdf_total",
+               "parse_s", "fill_s", "write_s", "seconds"]
+
+
+def add_extra_to_totals(totals: Dict[str, Dict[str, float]], extra: float) -> Dict[str, Dict[str, float]]:
+    """Her dairenin toplamına ek farkı ekler; girdi değiştirilmez, yeni sözlük döner."""
+    return {did: {**vals, "toplam": vals.get("toplam", 0.0) + extra} if extra else dict(vals)
+            for did, vals in totals.items()}
+
+
+def fill_apsiyon_job(job: dict) -> Tuple[dict, Optional[bytes]]:
+    """
+    Tek (PDF, şablon) işini baştan sona yapar: tutarları okur, mutabakatı ve daire
+    eşleşmesini çıkarır, şablonu doldurur. Streamlit çağrısı yoktur (işçi süreçte de çalışır).
+    job["totals"] verilirse (ör. CLI tutarları zaten okuduysa) PDF yeniden okunmaz.
+    Döner: (özet satırı, doldurulmuş xlsx | hata varsa None)
+    """
+    t0 = time.perf_counter()
+    res = {"job": job["name"], "ok": False, "error": ""}
+    try:
+        if not job.get("template_bytes"):
+            raise ValueError("Apsiyon şablonu yok")
+        if job.get("totals") is not None:
+            totals = job["totals"]
+        else:
+            totals, missing, seen, dups = {}, [], set(), set()
+            for pi, did, vals in iter_manas_pdf_totals(job["pdf_bytes"]):
+                if not did:
+                    missing.append(pi + 1)
+                    continue
+                if did in seen:
+                    dups.add(did)
+                seen.add(did)
+                totals[did] = vals
+            res["pages"] = pdf_page_count(job["pdf_bytes"])
+            res["missing_pages"], res["duplicates"] = len(missing), len(dups)
+        if not totals:
+            raise ValueError("PDF’ten tutar okunamadı")
+        res["uyumsuz"] = int(reconcile_totals(totals)["uyumsuz"].sum())
+        extra = float(job.get("extra") or 0.0)
+        totals = add_extra_to_totals(totals, extra)
+        res["daire"] = len(totals)
+        res["pdf_total"] = round(sum(v.get("toplam", 0.0) for v in totals.values()), 2)
+        res["parse_s"] = round(time.perf_counter() - t0, 3)
+
+        t1 = time.perf_counter()
+        aps_stats = {}
+        df_aps = _rename_apsiyon_cols(read_apsiyon_sheet(job["template_bytes"], stats=aps_stats))
+        if ("Blok" not in df_aps.columns) or ("Daire No" not in df_aps.columns):
+            raise ValueError("Apsiyon şablonunda 'Blok' / 'Daire No' başlıkları tespit edilemedi.")
+        df_out = fill_expenses_to_apsiyon(df_aps, totals, job["mode"],
+                                          job.get("exp1", ""), job.get("exp2", ""), job.get("exp3", ""))
+        has_row = (df_aps["Blok"].notna() & df_aps["Daire No"].notna()).to_numpy()
+        tpl_ids = set(apsiyon_daire_ids(df_aps)[has_row])
+        res["pdf_only_ids"] = sorted(set(totals) - tpl_ids)
+        res["template_only_ids"] = sorted(tpl_ids - set(totals))
+        res["pdf_only"], res["template_only"] = len(res["pdf_only_ids"]), len(res["template_only_ids"])
+        res["matched"] = len(tpl_ids & set(totals))
+        res["rows"], res["template_s"] = len(df_out), round(aps_stats["seconds"], 3)
+        res["fill_s"] = round(time.perf_counter() - t1, 3)
+
+        t2 = time.perf_counter()
+        summary = {"ek_fark_her_daire": extra, "pdf_total_yeni": res["pdf_total"]}
+        if job.get("patch", True):
+            patch_stats = {}
+            data = patch_apsiyon_excel_bytes(job["template_bytes"], df_aps, df_out, aps_stats["header_row"],
+                                             aps_stats["columns"], summary=summary, stats=patch_stats)
+            res["cells"] = patch_stats["cells"]
+        else:
+            data = export_excel_bytes(df_out, summary=summary)
+        res["write_s"] = round(time.perf_counter() - t2, 3)
+        res["ok"] = True
+    except Exception as e:
+        res["error"] = f"{type(e).__name__}: {e}"
+        data = None
+    res["seconds"] = round(time.perf_counter() - t0, 3)
+    return res, data
+
+
+def _iter_apsiyon_pool(jobs: List[dict], workers: int) -> Iterator[Tuple[int, dict, Optional[bytes]]]:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    ctx = multiprocessing.get_context("fork")  # bkz. paralel motor notu
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=ctx) as ex:
+        futs = {ex.submit(fill_apsiyon_job, job): k for k, job in enumerate(jobs)}
+        for fut in as_completed(futs):
+            yield (futs[fut], *fut.result())
+
+
+def iter_apsiyon_batch(
+    jobs: List[dict], workers: int = 1, report: Optional[dict] = None
+) -> Iterator[Tuple[int, dict, Optional[bytes]]]:
+    """
+    İşleri yürütür; (iş sırası, özet, xlsx) bitiş sırasıyla üretilir. workers > 1 ise process
+    havuzu kullanılır; havuz ilk sonuçtan önce düşerse hata kaydedilir (report["parallel_error"])
+    ve tüm işler seri yürütülür, sonuç verildikten sonraki hatalar çağırana iletilir.
+    """
+    if workers > 1 and len(jobs) > 1:
+        pooled = _iter_apsiyon_pool(jobs, workers)
+        try:
+            first = next(pooled)
+        except Exception as e:
+            _log.warning("Toplu Apsiyon havuzu başlatılamadı; seri yola geçiliyor", exc_info=True)
+            if report is not None:
+                report["parallel_error"] = f"{type(e).__name__}: {e}"
+        else:
+            yield first
+            yield from pooled
+            return
+    for k, job in enumerate(jobs):
+        yield (k, *fill_apsiyon_job(job))
+
+
+def apsiyon_batch_archive(results: List[Tuple[dict, Optional[bytes]]]) -> bytes:
+    """Doldurulmuş şablonlar (iş/Apsiyon_Doldurulmus.xlsx) + ozet.xlsx (Özet, Eşleşmeyenler) tek ZIP."""
+    import pandas as pd
+    summary = pd.DataFrame([{c: r.get(c) for c in _BATCH_COLS} for r, _ in results], columns=_BATCH_COLS)
+    mism = pd.DataFrame(
+        [{"job": r["job"], "daire_id": d, "neden": "PDF'te var, şablonda yok"} for r, _ in results
+         for d in r.get("pdf_only_ids", [])]
+        + [{"job": r["job"], "daire_id": d, "neden": "Şablonda var, PDF'te yok"} for r, _ in results
+           for d in r.get("template_only_ids", [])],
+        columns=["job", "daire_id", "neden"],
+    )
+    xbuf = io.BytesIO()
+    with pd.ExcelWriter(xbuf, engine="openpyxl") as writer:
+        summary.to_excel(writer, index=False, sheet_name="Özet")
+        mism.to_excel(writer, index=False, sheet_name="Eşleşmeyenler")
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        used = set()
+        for r, data in results:
+            if data is None:
+                continue
+            base = re.sub(r"[^\w.-]+", "_", r["job"]).strip("_") or "is"
+            name, n = base, 2
+            while name in used:
+                name, n = f"{base}_{n}", n + 1
+            used.add(name)
+            zf.writestr(f"{name}/Apsiyon_Doldurulmus.xlsx", data)
+        zf.writestr("ozet.xlsx", xbuf.getvalue())
+    return out.getvalue()
+
+
+def format_apsiyon_batch(results: List[dict], elapsed: float) -> str:
+    ok = [r for r in results if r["ok"]]
+    work = sum(r["seconds"] for r in results)
+    msg = (f"{len(ok)}/{len(results)} iş tamam • {sum(r['daire'] for r in ok)} daire • "
+           f"{elapsed:.1f} sn (işlerin toplamı {work:.1f} sn)")
+    mism = sum(r["pdf_only"] + r["template_only"] for r in ok)
+    if mism:
+        msg += f" • {mism} eşleşmeyen daire"
+    return msg
+
+
+def pair_batch_files(pdf_names: List[str], template_names: List[str]) -> Dict[str, Optional[str]]:
+    """PDF → şablon eşlemesi: aynı dosya adı (uzantısız) öncelikli; tek şablon varsa herkese o."""
+    stems = {os.path.splitext(t)[0].lower(): t for t in template_names}
+    pairs = {}
+    for p in pdf_names:
+        stem = os.path.splitext(p)[0].lower()
+        pairs[p] = stems.get(stem) or (template_names[0] if len(template_names) == 1 else None)
+    return pairs
+
+
+# -----------------------------------------------------------------------------
+# Telefon Numaraları (E.164) — rehber ve WhatsApp gönderimi aynı kuralları kullanır
+# -----------------------------------------------------------------------------
+# Kurallar (rakam ve '+' dışındaki her şey atılır):
+#   +…          → olduğu gibi (yalnız baştaki '+')      00…        → +…
+#   90 + 10 hane → +90…                                 0 + 10 hane → +90…
+#   5 + 9 hane   → +905…                                diğerleri  → temizlenmiş hali (geçersiz)
+# 00 + 5 + 9 hane (fazladan 0 yazılmış TR cep, 005321234567) 00 kuralına girmez → geçersiz.
+# Geçerli: +90 + 10 hane, ya da başka ülke kodlu +[1-9] + 7-14 hane.
+_RE_PHONE_JUNK = re.compile(r"[^\d+]")
+_RE_PHONE_TR = re.compile(r"\+90\d{10}")
+_RE_PHONE_INTL = re.compile(r"\+[1-9]\d{7,14}")
+_RE_PHONE_TR_TYPO = re.compile(r"005\d{9}")
+# TR ya da INTL (+90 dışı); bakış (lookaround) yok ki pyarrow'un RE2 motoru doğrudan çalıştırsın
+_RE_PHONE_VALID = re.compile(r"\+90\d{10}|\+[1-8]\d{7,14}|\+9[1-9]\d{6,13}")
+
+
+def normalize_phone(x) -> Tuple[str, bool]:
+    """Tek numara için başvuru uygulaması; toplu iş için normalize_phones kullanılır."""
+    c = _RE_PHONE_JUNK.sub("", "" if x is None or x != x else str(x))
+    d = c.replace("+", "")
+    if c.startswith("+"):
+        e = "+" + d
+    elif d.startswith("00") and not _RE_PHONE_TR_TYPO.fullmatch(d):
+        e = "+" + d[2:]
+    elif len(d) == 12 and d.startswith("90"):
+        e = "+" + d
+    elif len(d) == 11 and d.startswith("0"):
+        e = "+90" + d[1:]
+    elif len(d) == 10 and d.startswith("5"):
+        e = "+90" + d
+    else:
+        e = c
+    ok = bool(_RE_PHONE_TR.fullmatch(e)) if e.startswith("+90") else bool(_RE_PHONE_INTL.fullmatch(e))
+    return e, ok
+
+
+def normalize_phones(values) -> pd.DataFrame:
+    """
+    normalize_phone kurallarının sütun bazlı (vektörel) hali.
+    Döner: girdiyle aynı index'te 'e164' (str) ve 'valid' (bool) sütunları.
+    """
+    import pandas as pd
+    s = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    s = s.astype(object).where(s.notna(), "").astype(str)
+    c = s.str.replace(_RE_PHONE_JUNK.pattern, "", regex=True)
+    d = c.str.replace("+", "", regex=False)
+    plus = c.str.startswith("+")
+    ruled = (plus | d.str.match(r"00|90\d{10}$|0\d{10}$|5\d{9}$")) & ~d.str.fullmatch(_RE_PHONE_TR_TYPO.pattern)
+    # 0+10 hane → 0 yerine 90, 5+9 hane → başa 90, 00 → atılır (ilk ikisinden sonra '00' ile başlayan kalmaz)
+    t = (
+        d.str.replace(r"^0([1-9]\d{9})$", r"90\1", regex=True)
+        .str.replace(r"^(5\d{9})$", r"90\1", regex=True)
+        .str.replace(r"^00", "", regex=True)
+    )
+    e = ("+" + t.where(~plus, d)).where(ruled, c)
+    valid = e.str.fullmatch(_RE_PHONE_VALID.pattern).astype(bool)
+    return pd.DataFrame({"e164": e, "valid": valid}, index=s.index)
+
+
+def bench_phone_normalization(n: int = 200_000, seed: int = 0) -> dict:
+    """Rehber boyutunda sentetik numaralarla satır satır (normalize_phone) / vektörel karşılaştırma."""
+    import random
+    import pandas as pd
+    rnd = random.Random(seed)
+    forms = [
+        lambda k: f"05{k:09d}", lambda k: f"5{k:09d}", lambda k: f"+90 5{k:02d} {k:03d} {k:02d} {k:02d}",
+        lambda k: f"0 (5{k:02d}) {k:03d}-{k:02d}-{k:02d}", lambda k: f"90{5000000000 + k}", lambda k: f"0049{k:010d}",
+        lambda k: f"005{k:09d}",
+        lambda k: "", lambda k: "yok", lambda k: f"{k}",
+    ]
+    vals = pd.Series([rnd.choice(forms)(rnd.randrange(100)) for _ in range(n)], dtype=str)
+    t0 = time.perf_counter()
+    rows = [normalize_phone(v) for v in vals]
+    t_row = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    vec = normalize_phones(vals)
+    t_vec = time.perf_counter() - t0
+    same = [r[0] for r in rows] == vec["e164"].tolist() and [r[1] for r in rows] == vec["valid"].tolist()
+    return {"rows": n, "row_s": round(t_row, 4), "vector_s": round(t_vec, 4),
+            "speedup": round(t_row / t_vec, 1) if t_vec else None, "same": same,
+            "valid": int(vec["valid"].sum())}
+
 # -----------------------------------------------------------------------------
 # Rehber Okuyucu (WhatsApp için) — Esnek: Apsiyon veya Basit CSV şeması
 # -----------------------------------------------------------------------------
@@ -675,12 +2803,42 @@ def _find_header_row_contacts(df_raw: pd.DataFrame, search_rows: int = 50) -> Op
     return 0
 
 
-def _map_contact_columns(df: pd.DataFrame) -> pd.DataFrame:
+# Basit CSV şemasında (phone + daire_id) bakılan başlıklar
+_SIMPLE_CONTACT_KEYS = {
+    "phone", "mobile", "telefon", "tel", "gsm", "cep", "telefon no",
+    "daire id", "daireid", "daireid ", "daire_id",
+    "name", "ad soyad", "ad soyad  unvan", "ad soyad/unvan", "unvan",
+}
+
+
+def _contact_col_role(nc: str) -> Optional[str]:
+    """Normalize başlığın Apsiyon rehber şemasındaki karşılığı (yoksa None)."""
+    if nc in ("blok", "blok adi", "blok adı", "blokadi", "blok ad", "blokad", "block"):
+        return "Blok"
+    if nc in ("daire no", "daire  no", "daireno", "daire", "apartment", "flat", "apt no", "apartment no", "unit", "unit no"):
+        return "Daire No"
+    if ("ad soyad / unvan" in nc) or ("ad soyad/unvan" in nc) or ("ad soyad" in nc) or ("unvan" in nc) or (nc == "name") or ("full name" in nc):
+        return "Ad Soyad / Unvan"
+    if (nc in ("telefon", "tel", "cep", "gsm", "telefon no", "tel no", "telefon numarasi", "telefon numarası", "phone", "mobile")) or ("telefon no" in nc):
+        return "Telefon"
+    if nc in ("daire id", "daireid", "daire id ", "daire_id"):
+        return "DaireID"
+    return None
+
+
+def _contact_col_used(name) -> bool:
+    nc = _norm_rehber(name)
+    return nc in _SIMPLE_CONTACT_KEYS or _contact_col_role(nc) is not None
+
+
+def _map_contact_columns(df: pd.DataFrame, all_columns: Optional[List[str]] = None) -> pd.DataFrame:
     """
     Hem Apsiyon başlıklarını hem de basit CSV başlıklarını destekler.
     Hedef final kolonlar: Blok, Daire No, Ad Soyad / Unvan (ops), Telefon
-    Ayrıca daire_id varsa parçalar.
+    Ayrıca daire_id varsa parçalar. all_columns: hata mesajında gösterilecek tüm başlıklar
+    (df yalnız kullanılan sütunlarla okunmuş olabilir).
     """
+    import pandas as pd
     # Orijinal kolon adları
     original_cols = list(df.columns)
 
@@ -720,22 +2878,9 @@ def _map_contact_columns(df: pd.DataFrame) -> pd.DataFrame:
 
         tmp["Blok"], tmp["Daire No"] = zip(*tmp["DaireID"].map(_split_did))
 
-        # Telefonu normalize et
-        def _quick_norm_phone(x: str) -> str:
-            s = re.sub(r"[^\d+]", "", str(x))
-            if s.startswith("+"):
-                return s
-            if re.fullmatch(r"05\d{9}", s):
-                return "+90" + s[1:]
-            if re.fullmatch(r"5\d{9}", s):
-                return "+90" + s
-            if re.fullmatch(r"0\d{10,11}", s):
-                return "+90" + s[1:]
-            if re.fullmatch(r"90\d{10}", s):
-                return "+" + s
-            return s
-
-        tmp["Telefon"] = tmp["Telefon"].apply(_quick_norm_phone)
+        # Telefonu E.164'e çevir (geçersizler temizlenmiş haliyle kalır)
+        ph = normalize_phones(tmp["Telefon"])
+        tmp["Telefon"], tmp["Telefon Geçerli"] = ph["e164"], ph["valid"]
 
         # Eksik olanları kontrol edip final döndür
         if "Ad Soyad / Unvan" not in tmp.columns:
@@ -743,22 +2888,14 @@ def _map_contact_columns(df: pd.DataFrame) -> pd.DataFrame:
         tmp["Blok"] = tmp["Blok"].astype(str).str.upper().str.strip()
         tmp["Daire No"] = tmp["Daire No"].astype(str).str.replace(r"\D", "", regex=True).str.zfill(3)
         tmp["DaireID"] = tmp["Blok"] + "-" + tmp["Daire No"]
-        return tmp[["Blok", "Daire No", "Ad Soyad / Unvan", "Telefon", "DaireID"]]
+        return _compact_contacts(tmp[["Blok", "Daire No", "Ad Soyad / Unvan", "Telefon", "DaireID", "Telefon Geçerli"]])
 
     # Apsiyon şeması (TR/EN çeşitleri) — esnek eşleme
     mapping = {}
     for c in original_cols:
-        nc = _norm_rehber(c)
-        if nc in ("blok", "blok adi", "blok adı", "blokadi", "blok ad", "blokad", "block"):
-            mapping[c] = "Blok"
-        elif nc in ("daire no", "daire  no", "daireno", "daire", "apartment", "flat", "apt no", "apartment no", "unit", "unit no"):
-            mapping[c] = "Daire No"
-        elif ("ad soyad / unvan" in nc) or ("ad soyad/unvan" in nc) or ("ad soyad" in nc) or ("unvan" in nc) or (nc == "name") or ("full name" in nc):
-            mapping[c] = "Ad Soyad / Unvan"
-        elif (nc in ("telefon", "tel", "cep", "gsm", "telefon no", "tel no", "telefon numarasi", "telefon numarası", "phone", "mobile")) or ("telefon no" in nc):
-            mapping[c] = "Telefon"
-        elif nc in ("daire id", "daireid", "daire id ", "daire_id"):
-            mapping[c] = "DaireID"
+        role = _contact_col_role(_norm_rehber(c))
+        if role:
+            mapping[c] = role
 
     df2 = df.rename(columns=mapping)
 
@@ -785,7 +2922,7 @@ def _map_contact_columns(df: pd.DataFrame) -> pd.DataFrame:
     # Zorunlu kolonlar
     for need in ["Blok", "Daire No", "Telefon"]:
         if need not in df2.columns:
-            cols_map_debug = {c: _norm_rehber(c) for c in df.columns}
+            cols_map_debug = {c: _norm_rehber(c) for c in (all_columns or df.columns)}
             st.error("Rehberde zorunlu kolon(lar) eksik: Blok, Daire No, Telefon")
             st.write("Algılanan kolonlar (normalize):", cols_map_debug)
             raise ValueError("Apsiyon rehber başlık eşlemesi yapılamadı.")
@@ -795,29 +2932,118 @@ def _map_contact_columns(df: pd.DataFrame) -> pd.DataFrame:
         digits = "".join(ch for ch in str(x or "") if ch.isdigit())
         return digits.zfill(3) if digits else ""
 
-    def _quick_norm_phone(x: str) -> str:
-        s = re.sub(r"[^\d+]", "", str(x))
-        if s.startswith("+"):
-            return s
-        if re.fullmatch(r"05\d{9}", s):
-            return "+90" + s[1:]
-        if re.fullmatch(r"5\d{9}", s):
-            return "+90" + s
-        if re.fullmatch(r"0\d{10,11}", s):
-            return "+90" + s[1:]
-        if re.fullmatch(r"90\d{10}", s):
-            return "+" + s
-        return s
-
     if "Ad Soyad / Unvan" not in df2.columns:
         df2["Ad Soyad / Unvan"] = None
 
     df2["Blok"] = df2["Blok"].astype(str).str.upper().str.strip()
     df2["Daire No"] = df2["Daire No"].apply(_pad3_for_merge)
-    df2["Telefon"] = df2["Telefon"].apply(_quick_norm_phone)
+    ph = normalize_phones(df2["Telefon"])
+    df2["Telefon"], df2["Telefon Geçerli"] = ph["e164"], ph["valid"]
     df2["DaireID"] = df2["Blok"] + "-" + df2["Daire No"]
 
-    return df2[["Blok", "Daire No", "Ad Soyad / Unvan", "Telefon", "DaireID"]]
+    return _compact_contacts(df2[["Blok", "Daire No", "Ad Soyad / Unvan", "Telefon", "DaireID", "Telefon Geçerli"]])
+
+
+def _compact_contacts(df: pd.DataFrame) -> pd.DataFrame:
+    # Blok / Daire No çok tekrar eder (birkaç blok, blok başına yüzlerce daire) → kategorik.
+    # DaireID ve Telefon str kalır: önkontrol ve kayıt bunlara fillna / str işlemleri uygular.
+    df = df.copy()
+    for c in ("Blok", "Daire No"):
+        df[c] = df[c].astype("category")
+    return df
+
+
+CONTACTS_HEADER_ROWS = 50     # başlık yalnız bu kadar satırlık önekte aranır
+CONTACTS_CSV_CHUNK = 20_000   # CSV gövdesi bu kadar satırlık parçalarla okunur
+
+
+def _contact_names(header: List[str], upper: Optional[pd.Series]) -> List[str]:
+    # 'Unnamed' kolon isimlerini bir üst satırdan düzelt (Apsiyon ham dosyalarda sık görülür)
+    import pandas as pd
+    if upper is None:
+        return list(header)
+    names = []
+    for i, c in enumerate(header):
+        name = str(c)
+        if name.lower().startswith("unnamed"):
+            alt = upper[i] if i < len(upper) else None
+            if pd.notna(alt) and str(alt).strip():
+                name = str(alt)
+            else:
+                name = f"Kolon_{i+1}"
+        names.append(name)
+    return names
+
+
+def _read_contacts_csv(file_bytes: bytes) -> Tuple[pd.DataFrame, List[str]]:
+    import pandas as pd
+    from io import BytesIO
+    raw = pd.read_csv(BytesIO(file_bytes), header=None, dtype=str, nrows=CONTACTS_HEADER_ROWS)
+    hdr = _find_header_row_contacts(raw, search_rows=CONTACTS_HEADER_ROWS)
+    header = pd.read_csv(BytesIO(file_bytes), header=hdr, dtype=str, nrows=0).columns
+    names = _contact_names(list(header), raw.iloc[hdr - 1] if hdr > 0 else None)
+    pos = [i for i, n in enumerate(names) if _contact_col_used(n)]
+    parts = []
+    if pos:
+        with pd.read_csv(BytesIO(file_bytes), header=hdr, dtype=str, usecols=pos,
+                         chunksize=CONTACTS_CSV_CHUNK) as reader:
+            parts = list(reader)
+    cols = [names[i] for i in pos]
+    df = pd.concat(parts) if parts else pd.DataFrame({c: pd.Series(dtype=str) for c in cols})
+    df.columns = cols
+    return df, names
+
+
+def _read_contacts_xlsx(file_bytes: bytes) -> Tuple[pd.DataFrame, List[str]]:
+    import pandas as pd
+    from pandas.errors import EmptyDataError
+    from pandas.io.parsers import TextParser
+
+    def parse(rows, **kw):
+        try:
+            return TextParser(rows, dtype=str, skip_blank_lines=False, **kw).read()
+        except EmptyDataError:
+            return pd.DataFrame()
+
+    rows = _xlsx_rows(file_bytes)
+    prefix, last = [], -1
+    for row in rows:
+        vals = [_convert_aps_cell(c) for c in row]
+        while vals and vals[-1] == "":
+            vals.pop()
+        if vals:
+            last = len(prefix)
+        prefix.append(vals)
+        if len(prefix) >= CONTACTS_HEADER_ROWS:
+            break
+    width = max((len(r) for r in prefix), default=0)
+    padded = [r + [""] * (width - len(r)) for r in prefix[: last + 1]]
+    raw = parse(padded, header=None)
+    hdr = _find_header_row_contacts(raw, search_rows=CONTACTS_HEADER_ROWS)
+    if not padded:
+        rows.close()
+        return pd.DataFrame(), []
+
+    header = list(parse([padded[hdr]], header=0).columns) if hdr < len(padded) else []
+    names = _contact_names(header, raw.iloc[hdr - 1] if hdr > 0 else None)
+    pos = [i for i, n in enumerate(names) if _contact_col_used(n)]
+
+    # gövde: önekte kalanlar + akıştaki satırlar; yalnız kullanılan hücreler dönüştürülür
+    body = [[r[j] if j < len(r) else "" for j in pos] for r in padded[hdr + 1:]]
+    body += [[] for _ in prefix[last + 1:]]
+    last_body = len(padded) - hdr - 2
+    for row in rows:
+        if any(c.value is not None and c.value != "" for c in row):
+            last_body = len(body)
+        body.append([_convert_aps_cell(row[j]) if j < len(row) else "" for j in pos])
+    body = [r if r else [""] * len(pos) for r in body[: last_body + 1]]
+
+    cols = [names[i] for i in pos]
+    df = parse(body, header=None) if body and pos else pd.DataFrame()
+    if df.empty and not len(df.columns):
+        df = pd.DataFrame({c: pd.Series(dtype=str) for c in cols})
+    df.columns = cols
+    return df, names
 
 
 def load_contacts_any(file_bytes: bytes, filename: str) -> pd.DataFrame:
@@ -825,44 +3051,87 @@ def load_contacts_any(file_bytes: bytes, filename: str) -> pd.DataFrame:
     - Apsiyon ham Excel/CSV (Blok, Daire No, Telefon …)
     - Basit CSV (phone, name, daire_id, [file_name])
     Şemalarının her ikisini de kabul eder.
+    Dosya tek geçişte okunur: başlık ilk CONTACTS_HEADER_ROWS satırda aranır, gövdeden
+    yalnız eşlemede kullanılabilecek sütunlar alınır (CSV parça parça).
     """
-    from io import BytesIO
-
-    # 1) Ham oku (header=None) ve mantıklı başlık satırı tespit et
+    # 1) Başlık tespiti + kullanılan sütunlarla gövde
     if filename.lower().endswith(".csv"):
-        raw = pd.read_csv(BytesIO(file_bytes), header=None, dtype=str)
+        df, names = _read_contacts_csv(file_bytes)
     else:
-        raw = pd.read_excel(BytesIO(file_bytes), header=None, dtype=str, engine="openpyxl")
+        df, names = _read_contacts_xlsx(file_bytes)
 
-    hdr = _find_header_row_contacts(raw, search_rows=50)
+    # 2) Tamamen boş kolonları at
+    df = df.dropna(axis=1, how="all")
 
-    # 2) Başlıkla tekrar oku
-    if filename.lower().endswith(".csv"):
-        df = pd.read_csv(BytesIO(file_bytes), header=hdr, dtype=str)
-    else:
-        df = pd.read_excel(BytesIO(file_bytes), header=hdr, dtype=str, engine="openpyxl")
-
-    # 3) 'Unnamed' kolon isimlerini bir üst satırdan düzelt (Apsiyon ham dosyalarda sık görülür)
-    if hdr > 0:
-        upper = raw.iloc[hdr-1]
-        new_cols = []
-        for i, c in enumerate(df.columns):
-            name = str(c)
-            if name.lower().startswith("unnamed"):
-                alt = upper[i] if i < len(upper) else None
-                if pd.notna(alt) and str(alt).strip():
-                    name = str(alt)
-                else:
-                    name = f"Kolon_{i+1}"
-            new_cols.append(name)
-        df.columns = new_cols
+    # 3) Esnek kolon eşlemesi ve temiz DataFrame
+    return _map_contact_columns(df, all_columns=names)
 
-    # 4) Tamamen boş kolonları at
-    df = df.dropna(axis=1, how="all")
+# -----------------------------------------------------------------------------
+# Ön Kontrol (tam çalıştırmadan önce yalnız DaireID taraması)
+# -----------------------------------------------------------------------------
+def preflight_scan(pdf_bytes: bytes, contacts: Optional[pd.DataFrame] = None) -> dict:
+    """
+    Alt yazı/bölme yapmadan yalnız DaireID'leri okur (en hızlı yol: sayfa deposu / parmak izi
+    önbelleği, yoksa üst bölge taraması). Sayfa sayısı, DaireID'siz sayfalar, tekrar eden
+    DaireID'ler ve contacts (load_contacts_any çıktısı) verilirse rehber kapsaması döner.
+    Okunan DaireID'ler depoda kalır; ardından gelen tam çalıştırma bunları yeniden okumaz.
+    """
+    from pypdf import PdfReader
+    t0 = time.perf_counter()
+    pdf_hash = pdf_content_hash(pdf_bytes)
+    reader = PdfReader(io.BytesIO(pdf_bytes))
+    n_pages = len(reader.pages)
+    put_page_texts(pdf_hash, {}, n_pages=n_pages)
+
+    pages_by_id: Dict[str, List[int]] = {}
+    missing: List[int] = []
+    for i, page in enumerate(reader.pages):
+        did = get_page_text(pdf_hash, i, page, need_text=False)["daire_id"]
+        if did:
+            pages_by_id.setdefault(did, []).append(i + 1)
+        else:
+            missing.append(i + 1)
+
+    res = {
+        "pages": n_pages,
+        "ids": len(pages_by_id),
+        "missing_pages": missing,
+        "duplicates": {did: pages for did, pages in pages_by_id.items() if len(pages) > 1},
+    }
+    if contacts is not None:
+        ids = contacts["DaireID"].fillna("").astype(str).str.strip()
+        phones = contacts["Telefon"].fillna("").astype(str).str.strip()
+        contact_ids = set(ids[ids != ""])
+        with_phone = set(ids[(ids != "") & (phones != "")])
+        valid = contacts["Telefon Geçerli"] if "Telefon Geçerli" in contacts else normalize_phones(phones)["valid"]
+        with_valid = set(ids[(ids != "") & valid.to_numpy(dtype=bool)])
+        pdf_ids = set(pages_by_id)
+        res["coverage"] = {
+            "contacts": len(contact_ids),
+            "matched": len(pdf_ids & contact_ids),
+            "not_in_contacts": sorted(pdf_ids - contact_ids),
+            "not_in_pdf": sorted(contact_ids - pdf_ids),
+            "no_phone": sorted((pdf_ids & contact_ids) - with_phone),
+            "bad_phone": sorted((pdf_ids & with_phone) - with_valid),
+        }
+    res["seconds"] = time.perf_counter() - t0
+    return res
 
-    # 5) Esnek kolon eşlemesi ve temiz DataFrame
-    out = _map_contact_columns(df)
-    return out
+
+def preflight_ok(res: dict) -> bool:
+    cov = res.get("coverage")
+    return (res["ids"] > 0 and not res["missing_pages"] and not res["duplicates"]
+            and (cov is None or not cov["not_in_contacts"]))
+
+
+def format_preflight(res: dict) -> str:
+    msg = (f"Ön kontrol: {res['pages']} sayfa • {res['ids']} farklı DaireID • "
+           f"{len(res['missing_pages'])} sayfada DaireID yok • {len(res['duplicates'])} tekrar eden DaireID")
+    cov = res.get("coverage")
+    if cov is not None:
+        msg += (f" • rehber: {cov['matched']}/{res['ids']} eşleşti, {len(cov['not_in_contacts'])} rehberde yok, "
+                f"{len(cov['no_phone'])} telefonsuz, {len(cov['bad_phone'])} geçersiz telefon")
+    return msg + f" • {res['seconds']:.1f} sn"
 
 # -----------------------------------------------------------------------------
 # Google Drive vars
@@ -872,18 +3141,6 @@ DEFAULT_DRIVE_FOLDER_ID = "1llFZbn_1769tun1v7Otehfg3_SfAotcQ"
 # -----------------------------------------------------------------------------
 # WhatsApp API helper'ları
 # -----------------------------------------------------------------------------
-def _ok_number(s: str) -> str:
-    s = str(s or "").strip()
-    s = s.replace(" ", "")
-    if s.startswith("05") and len(s) == 11:
-        return "+90" + s[1:]
-    if s.startswith("5") and len(s) == 10:
-        return "+90" + s
-    if s.startswith("0") and len(s) in (10, 11):
-        return "+90" + s[1:]
-    return s
-
-
 def send_template(
     access_token: str,
     phone_id: str,
@@ -904,6 +3161,7 @@ def send_template(
     - Diğer şablonlar:
         BODY: {{1}} = isim, {{2}} = daire_id, {{3}} = file_url
     """
+    import requests
     url = f"https://graph.facebook.com/v20.0/{phone_id}/messages"
     headers = {
         "Authorization": f"Bearer {access_token}",
@@ -976,6 +3234,7 @@ def send_template(
 
 
 def send_text(access_token: str, phone_id: str, to: str, text: str):
+    import requests
     url = f"https://graph.facebook.com/v20.0/{phone_id}/messages"
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
     payload = {
@@ -989,6 +3248,7 @@ def send_text(access_token: str, phone_id: str, to: str, text: str):
 
 
 def send_document_msg(access_token: str, phone_id: str, to: str, file_url: str, caption: str):
+    import requests
     url = f"https://graph.facebook.com/v20.0/{phone_id}/messages"
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
     payload = {
@@ -1095,137 +3355,687 @@ def save_outgoing(wa_chat_id: str, phone: str, text: str, wa_message_id: str = "
     conn.close()
 
 # -----------------------------------------------------------------------------
-# UI — Sekmeler
+# Dönem Tutarları DB'si (ayrıştırılmış MANAS tutarları, dönem + DaireID)
 # -----------------------------------------------------------------------------
-st.title("🧾 Atlas Vadi Fatura — Böl & Alt Yazı & Apsiyon")
-
-tab_a, tab_b, tab_c, tab_w, tab_panel = st.tabs([
-    "📄 Böl & Alt Yazı",
-    "📊 Apsiyon Gider Doldurucu",
-    "📤 WhatsApp Gönderim Hazırlığı",
-    "📲 WhatsApp Gönder (Cloud API)",
-    "💬 Mesaj Paneli"
-])
-
-# ---------------- TAB A: Böl & Alt Yazı ----------------
-with tab_a:
-    pdf_file = st.file_uploader("Fatura PDF dosyasını yükle", type=["pdf"], key="pdf_a")
-
-    if pdf_file:
-        st.session_state["pdf_bytes"] = pdf_file.getvalue()
-
-    st.subheader("Alt Yazı Kaynağı")
-    t1, t2 = st.tabs(["✍️ Metin alanı", "📄 .docx yükle (opsiyonel)"])
-
-    default_text = (
-        "SON ÖDEME TARİHİ     24.10.2025\n\n"
-        "Manas paylaşımlarında oturumda olup (0) gelen dairelerin önceki ödediği paylaşım tutarları baz alınarak "
-        "bedel yansıtılması; ayrıca İSKİ su sayacının okuduğu harcama tutarı ile site içerisindeki harcama tutarı "
-        "arasındaki farkın İSKİ faturasının ödenebilmesi için 152 daireye eşit olarak yansıtılması oya sunuldu. "
-        "Oybirliği ile kabul edildi.\n\n"
-        "28.02.2017 TARİHLİ TEMSİLCİLER OLAĞAN TOPLANTISINDA ALINAN KARARA İSTİNADEN\n"
-        "AÇIKLAMA\n"
-        "İski saatinden okunan m3 = 1.319  M3\n"
-        "Manas okuması m3= 1.202,5 M3\n"
-        "Ortak alan tüketimler m3= 32  M3 \n"
-        "Açıkta kalan:  84,5 m3     \n"
-        "Su m3 fiyatı 82,09   TL    84,5*82,9 = 7.005,05 TL / 152 = 46,08 TL."
+DATA_DB_PATH = os.getenv("FATURA_DB_PATH", os.path.join(os.path.dirname(DB_PATH), "fatura_data.db"))
+_RE_PERIOD = re.compile(r"^\s*(?:(\d{4})[-/.](\d{1,2})|(\d{1,2})[-/.](\d{4}))\s*$")
+
+
+def get_data_connection():
+    """
+    Tutar DB'sine bağlanır ve tablo/indeks yoksa oluşturur.
+    """
+    conn = sqlite3.connect(DATA_DB_PATH, check_same_thread=False)
+    cur = conn.cursor()
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS period_totals (
+            site TEXT NOT NULL DEFAULT '',
+            period TEXT NOT NULL,         -- 'YYYY-MM'
+            daire_id TEXT NOT NULL,
+            isitma REAL NOT NULL DEFAULT 0,
+            sicak REAL NOT NULL DEFAULT 0,
+            su REAL NOT NULL DEFAULT 0,
+            toplam REAL NOT NULL DEFAULT 0,
+            pdf_hash TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (site, period, daire_id)
+        )
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_period_totals_daire ON period_totals (site, daire_id, period)"
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS contacts (
+            site TEXT NOT NULL DEFAULT '',
+            daire_id TEXT NOT NULL,
+            sira INTEGER NOT NULL,        -- aynı dairenin kaçıncı kişisi (dosyadaki sıra)
+            blok TEXT,
+            daire_no TEXT,
+            ad TEXT,
+            telefon TEXT,
+            telefon_gecerli INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (site, daire_id, sira)
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_contacts_phone ON contacts (site, telefon)")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS contact_sources (
+            site TEXT PRIMARY KEY,
+            file_hash TEXT,
+            file_name TEXT,
+            rows INTEGER,
+            updated_at TEXT
+        )
+        """
     )
+    conn.commit()
+    return conn
 
-    with t1:
-        footer_text = st.text_area(
-            "Alt yazı (kalın yapmak istediğiniz kelimenin başına ve sonuna ** hem büyük hem kalın yapmak istiyorsanız *** koyunuz )",
-            value=default_text,
-            height=220,
-            key="footer_text"
+
+def normalize_period(s: str) -> str:
+    """'2025-10', '2025/10', '10.2025' => '2025-10'. Geçersizse ValueError."""
+    m = _RE_PERIOD.match(str(s))
+    if not m:
+        raise ValueError(f"Dönem YYYY-AA biçiminde olmalı: {s!r}")
+    year, month = (m.group(1), m.group(2)) if m.group(1) else (m.group(4), m.group(3))
+    if not 1 <= int(month) <= 12:
+        raise ValueError(f"Geçersiz ay: {s!r}")
+    return f"{int(year):04d}-{int(month):02d}"
+
+
+def save_period_totals(
+    period: str, totals_map: Dict[str, Dict[str, float]], site: str = "", pdf_hash: Optional[str] = None
+) -> int:
+    """
+    Dönemin tutarlarını kaydeder; aynı (site, dönem) için önceki kayıtların yerini alır
+    (düzeltilmiş PDF yeniden yüklenince silinen daireler de kalkar). Yazılan satır sayısını döner.
+    """
+    period = normalize_period(period)
+    ts_str = datetime.utcnow().isoformat(sep=" ", timespec="seconds")
+    rows = [
+        (site, period, did, v.get("isitma", 0.0), v.get("sicak", 0.0), v.get("su", 0.0),
+         v.get("toplam", 0.0), pdf_hash, ts_str)
+        for did, v in totals_map.items()
+    ]
+    conn = get_data_connection()
+    with conn:
+        conn.execute("DELETE FROM period_totals WHERE site = ? AND period = ?", (site, period))
+        conn.executemany(
+            """
+            INSERT INTO period_totals
+            (site, period, daire_id, isitma, sicak, su, toplam, pdf_hash, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
         )
+    conn.close()
+    return len(rows)
 
-    with t2:
-        if not HAS_DOCX:
-            st.info("python-docx yüklü değilse .docx modu devre dışı olur.")
-        docx_file = st.file_uploader(".docx yükleyin (opsiyonel)", type=["docx"], key="docx_up")
-        if docx_file and HAS_DOCX:
-            try:
-                d = docx.Document(docx_file)
-                paragraphs = [p.text for p in d.paragraphs]
-                docx_text = "\n".join(paragraphs).strip()
-                if docx_text:
-                    footer_text = docx_text
-                    st.success("Alt yazı .docx içeriğinden alındı.")
-            except Exception as e:
-                st.error(f".docx okunamadı: {e}")
-
-    st.subheader("Görünüm Ayarları")
-    c1, c2 = st.columns(2)
-    with c1:
-        font_size = st.slider("🅰️ Yazı Boyutu", 9, 16, 11, key="fs")
-        leading = st.slider("↕️ Satır Aralığı (pt)", 12, 22, 14, key="lead")
-    with c2:
-        align = st.radio("Hizalama", ["left", "center"], index=0, key="align",
-                         format_func=lambda x: "Sol" if x == "left" else "Orta")
-        bottom_m = st.slider("Alt Marj (pt)", 24, 100, 48, key="bm")
-    box_h = st.slider("Alt Yazı Alanı Yüksekliği (pt)", 100, 260, 180, key="bh")
-    bold_rules = st.checkbox("Başlıkları otomatik kalın yap (SON ÖDEME, AÇIKLAMA, ...)",
-                             value=True, key="boldrules")
-
-    with st.expander("🏷️ Daire numarası etiketi & yeniden adlandırma (opsiyonel)", expanded=False):
-        stamp_on = st.checkbox("Daire numarasını köşeye yaz", value=False, key="stamp_on")
-        label_tpl = st.text_input("Etiket şablonu", value="Daire: {daire_id}", key="label_tpl")
-        c3, c4, c5 = st.columns(3)
-        with c3:
-            stamp_font_size = st.slider("Etiket punto", 10, 20, 13, key="stamp_fs")
-        with c4:
-            stamp_pos = st.selectbox("Konum", ["TR", "TL", "BR", "BL"], index=0, key="stamp_pos")
-        with c5:
-            stamp_bold = st.checkbox("Kalın", value=True, key="stamp_bold")
-        c6, c7 = st.columns(2)
-        with c6:
-            pad_x = st.slider("Köşe yatay boşluk (px)", 0, 80, 20, step=2, key="pad_x")
-        with c7:
-            pad_y = st.slider("Köşe dikey boşluk (px)", 0, 80, 20, step=2, key="pad_y")
-        rename_files = st.checkbox("Bölünmüş dosya adını daireID.pdf yap",
-                                   value=True, key="rename_files")
-
-    st.subheader("İşlem")
-    mode = st.radio(
-        "Ne yapmak istersiniz?",
-        ["Sadece sayfalara böl", "Sadece alt yazı uygula (tek PDF)", "Alt yazı uygula + sayfalara böl (ZIP)"],
-        index=2,
-        key="mode"
+
+def load_period_totals(period: str, site: str = "") -> Dict[str, Dict[str, float]]:
+    """Kayıtlı dönemi parse_manas_pdf_totals çıktısıyla aynı biçimde döner (PDF gerekmez)."""
+    conn = get_data_connection()
+    cur = conn.execute(
+        "SELECT daire_id, isitma, sicak, su, toplam FROM period_totals WHERE site = ? AND period = ?",
+        (site, normalize_period(period)),
     )
-    go = st.button("🚀 Başlat", key="go_a")
-
-    if go:
-        if not pdf_file:
-            st.warning("Lütfen önce bir PDF yükleyin.")
-            st.stop()
-
-        src = pdf_file.read()
-
-        if mode == "Sadece sayfalara böl":
-            pages = split_pdf(src)
-            with io.BytesIO() as zbuf:
-                with zipfile.ZipFile(zbuf, "w", zipfile.ZIP_DEFLATED) as z:
-                    for name, data in pages:
-                        z.writestr(name, data)
-                st.download_button("📥 Bölünmüş sayfalar (ZIP)",
-                                   zbuf.getvalue(),
-                                   file_name="bolunmus_sayfalar.zip")
-
-        elif mode == "Sadece alt yazı uygula (tek PDF)":
-            stamped = add_footer_to_pdf(
-                src,
-                footer_text=footer_text,
-                font_size=font_size,
-                leading=leading,
-                align=align,
-                bottom_margin=bottom_m,
-                box_height=box_h,
-                bold_rules=bold_rules,
-            )
-            st.download_button("📥 Alt yazılı PDF", stamped, file_name="alt_yazili.pdf")
+    out = {did: {"isitma": i, "sicak": s, "su": u, "toplam": t} for did, i, s, u, t in cur.fetchall()}
+    conn.close()
+    return out
+
+
+def period_pdf_hashes(period: str, site: str = "") -> List[str]:
+    """Dönemin kayıtlı satırlarının geldiği PDF hash'leri (kayıt yoksa boş liste)."""
+    conn = get_data_connection()
+    rows = conn.execute(
+        "SELECT DISTINCT COALESCE(pdf_hash, '') FROM period_totals WHERE site = ? AND period = ?",
+        (site, normalize_period(period)),
+    ).fetchall()
+    conn.close()
+    return [r[0] for r in rows]
+
+
+def list_periods(site: Optional[str] = None) -> List[Tuple[str, str, int, float]]:
+    """(site, dönem, daire sayısı, toplam) — en yeni dönem önce."""
+    conn = get_data_connection()
+    sql = "SELECT site, period, COUNT(*), ROUND(SUM(toplam), 2) FROM period_totals"
+    args: tuple = ()
+    if site is not None:
+        sql += " WHERE site = ?"
+        args = (site,)
+    rows = conn.execute(sql + " GROUP BY site, period ORDER BY period DESC, site", args).fetchall()
+    conn.close()
+    return rows
+
+
+def compare_periods(prev: str, cur: str, site: str = "") -> pd.DataFrame:
+    """
+    İki dönemi daire bazında karşılaştırır (DB'de birleştirilir): kalem başına önceki,
+    şimdiki ve fark sütunları; yalnız bir dönemde bulunan daireler de listelenir.
+    """
+    import pandas as pd
+    prev, cur = normalize_period(prev), normalize_period(cur)
+    conn = get_data_connection()
+    df = pd.read_sql_query(
+        """
+        WITH p AS (SELECT * FROM period_totals WHERE site = :site AND period = :prev),
+             c AS (SELECT * FROM period_totals WHERE site = :site AND period = :cur),
+             ids AS (SELECT daire_id FROM p UNION SELECT daire_id FROM c)
+        SELECT ids.daire_id,
+               p.isitma AS isitma_onceki, c.isitma AS isitma,
+               p.sicak  AS sicak_onceki,  c.sicak  AS sicak,
+               p.su     AS su_onceki,     c.su     AS su,
+               p.toplam AS toplam_onceki, c.toplam AS toplam
+        FROM ids
+        LEFT JOIN p ON p.daire_id = ids.daire_id
+        LEFT JOIN c ON c.daire_id = ids.daire_id
+        ORDER BY ids.daire_id
+        """,
+        conn,
+        params={"site": site, "prev": prev, "cur": cur},
+    )
+    conn.close()
+    for k in ("isitma", "sicak", "su", "toplam"):
+        df[f"{k}_fark"] = (df[k] - df[f"{k}_onceki"]).round(2)
+    df["toplam_degisim_yuzde"] = (
+        df["toplam_fark"] / df["toplam_onceki"].where(df["toplam_onceki"] > 0) * 100
+    ).round(1)
+    return df
+
+# -----------------------------------------------------------------------------
+# Rehber DB'si (kalıcı, DaireID ve telefon indeksli; yeniden yüklemede yalnız fark yazılır)
+# -----------------------------------------------------------------------------
+_CONTACT_DB_COLS = ["Blok", "Daire No", "Ad Soyad / Unvan", "Telefon", "Telefon Geçerli"]
+
 
+def _contact_delta(old: List[tuple], new: List[tuple]) -> Tuple[int, int, int]:
+    """
+    Bir dairenin eski/yeni kişilerini içerikle eşler: önce birebir aynı satır, sonra aynı
+    telefon, sonra aynı ad, en son kalanlar sırayla. Döner: (eklenen, değişen, silinen).
+    Satır tuple'ı: (blok, daire_no, ad, telefon, telefon_gecerli).
+    """
+    old, new = list(old), list(new)
+    for i in range(len(new) - 1, -1, -1):  # birebir aynı => değişmemiş
+        if new[i] in old:
+            old.remove(new[i])
+            del new[i]
+    changed = 0
+    for field in (3, 2):  # telefon, ad
+        for i in range(len(new) - 1, -1, -1):
+            val = new[i][field]
+            j = next((j for j, o in enumerate(old) if val and o[field] == val), None)
+            if j is not None:
+                del old[j], new[i]
+                changed += 1
+    paired = min(len(old), len(new))
+    return len(new) - paired, changed + paired, len(old) - paired
+
+
+def save_contacts(
+    contacts: pd.DataFrame, site: str = "", file_hash: Optional[str] = None, file_name: str = ""
+) -> Dict[str, int]:
+    """
+    load_contacts_any çıktısını rehber tablosuna upsert eder. Satırlar (site, DaireID, sıra)
+    anahtarıyla dosyadaki sırada tutulur; yalnız farklı olan satırlar yazılır, fazlası silinir.
+    Sayımlar daire içinde içerikle eşlenerek yapılır (bkz. _contact_delta), kişi sırası kayınca
+    sonraki kişiler değişmiş sayılmaz. Döner: {"added", "changed", "removed", "unchanged", "rows"}.
+    """
+    ts_str = datetime.utcnow().isoformat(sep=" ", timespec="seconds")
+    sira = contacts.groupby("DaireID", sort=False).cumcount()
+    new = {}
+    for did, k, blok, dno, ad, tel, ok in zip(contacts["DaireID"], sira, *(contacts[c] for c in _CONTACT_DB_COLS)):
+        ad = None if ad is None or ad != ad else str(ad)
+        new[(str(did), int(k))] = (str(blok), str(dno), ad, str(tel), int(bool(ok)))
+
+    conn = get_data_connection()
+    old = {
+        (did, k): tuple(vals)
+        for did, k, *vals in conn.execute(
+            "SELECT daire_id, sira, blok, daire_no, ad, telefon, telefon_gecerli FROM contacts WHERE site = ?",
+            (site,),
+        )
+    }
+    added = [key for key in new if key not in old]
+    changed = [key for key in new if key in old and old[key] != new[key]]
+    removed = [key for key in old if key not in new]
+
+    touched = {key[0] for key in added + changed + removed}
+    old_by: Dict[str, List[tuple]] = {did: [] for did in touched}
+    new_by: Dict[str, List[tuple]] = {did: [] for did in touched}
+    for rows, by in ((old, old_by), (new, new_by)):
+        for key in sorted(k for k in rows if k[0] in touched):
+            by[key[0]].append(rows[key])
+    counts = {"added": 0, "changed": 0, "removed": 0}
+    for did in touched:
+        a, c, r = _contact_delta(old_by[did], new_by[did])
+        counts["added"] += a
+        counts["changed"] += c
+        counts["removed"] += r
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO contacts
+            (site, daire_id, sira, blok, daire_no, ad, telefon, telefon_gecerli, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (site, daire_id, sira) DO UPDATE SET
+                blok = excluded.blok, daire_no = excluded.daire_no, ad = excluded.ad,
+                telefon = excluded.telefon, telefon_gecerli = excluded.telefon_gecerli,
+                updated_at = excluded.updated_at
+            """,
+            [(site, *key, *new[key], ts_str) for key in added + changed],
+        )
+        conn.executemany(
+            "DELETE FROM contacts WHERE site = ? AND daire_id = ? AND sira = ?",
+            [(site, *key) for key in removed],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO contact_sources (site, file_hash, file_name, rows, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (site, file_hash, file_name, len(new), ts_str),
+        )
+    conn.close()
+    return {**counts, "unchanged": len(new) - counts["added"] - counts["changed"], "rows": len(new)}
+
+
+def contacts_source(site: str = "") -> Optional[Tuple[str, str, int, str]]:
+    """Sitenin son kaydedilen rehberi: (dosya hash'i, dosya adı, satır, zaman) ya da None."""
+    conn = get_data_connection()
+    row = conn.execute(
+        "SELECT file_hash, file_name, rows, updated_at FROM contact_sources WHERE site = ?", (site,)
+    ).fetchone()
+    conn.close()
+    return row
+
+
+def load_contacts_db(site: str = "") -> pd.DataFrame:
+    """Kayıtlı rehberi load_contacts_any ile aynı sütunlarla döner (dosya gerekmez)."""
+    import pandas as pd
+    conn = get_data_connection()
+    df = pd.read_sql_query(
+        """
+        SELECT blok, daire_no, ad, telefon, daire_id, telefon_gecerli
+        FROM contacts WHERE site = ? ORDER BY daire_id, sira
+        """,
+        conn,
+        params=(site,),
+    )
+    conn.close()
+    df.columns = ["Blok", "Daire No", "Ad Soyad / Unvan", "Telefon", "DaireID", "Telefon Geçerli"]
+    df["Telefon Geçerli"] = df["Telefon Geçerli"].astype(bool)
+    return _compact_contacts(df)
+
+
+def join_contacts(pdf_df: pd.DataFrame, site: str = "") -> pd.DataFrame:
+    """
+    pdf_df'i (DaireID sütunlu) kayıtlı rehberle DB'de birleştirir; pdf_df.merge(rehber, on="DaireID",
+    how="left") ile aynı satırlar ve sıra, eklenen sütunlar Telefon ve Ad Soyad / Unvan.
+    """
+    import pandas as pd
+    conn = get_data_connection()
+    conn.execute("CREATE TEMP TABLE pdf_ids (pos INTEGER PRIMARY KEY, daire_id TEXT)")
+    conn.executemany(
+        "INSERT INTO pdf_ids VALUES (?, ?)",
+        ((i, None if pd.isna(did) else str(did)) for i, did in enumerate(pdf_df["DaireID"])),
+    )
+    m = pd.read_sql_query(
+        """
+        SELECT p.pos, c.telefon, c.ad
+        FROM pdf_ids p
+        LEFT JOIN contacts c ON c.site = ? AND c.daire_id = p.daire_id
+        ORDER BY p.pos, c.sira
+        """,
+        conn,
+        params=(site,),
+    )
+    conn.close()
+    out = pdf_df.iloc[m["pos"].to_numpy()].reset_index(drop=True)
+    out["Telefon"] = m["telefon"].to_numpy()
+    out["Ad Soyad / Unvan"] = m["ad"].to_numpy()
+    return out
+
+# -----------------------------------------------------------------------------
+# Soğuk başlangıç ölçümü (import süre raporu)
+# -----------------------------------------------------------------------------
+LAZY_MODULES = (
+    "pandas", "openpyxl", "pypdf", "reportlab.pdfgen.canvas", "requests",
+    "docx", "googleapiclient.discovery",
+)
+
+
+def _parse_importtime(stderr: str) -> Dict[str, float]:
+    """`python -X importtime` çıktısı => modül adı -> kümülatif süre (sn)."""
+    out: Dict[str, float] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        out.setdefault(parts[2].strip(), int(parts[1]) / 1e6)
+    return out
+
+
+def import_time_report(modules: Iterable[str] = LAZY_MODULES) -> List[Tuple[str, Optional[float]]]:
+    """
+    Temiz alt süreçlerde ölçer: app modülünün kendisi (streamlit dahil), ilk
+    overlay'deki font kaydı ve ilk kullanımda yüklenen ağır modüller tek tek.
+    Kurulu olmayan modüller için süre None döner.
+    """
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code: str) -> Tuple[Dict[str, float], str]:
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=here, capture_output=True, text=True, timeout=300,
+        )
+        return _parse_importtime(proc.stderr), proc.stdout
+
+    report: List[Tuple[str, Optional[float]]] = []
+    times, stdout = run(
+        "import time, app; t = time.perf_counter(); app._ensure_fonts(); "
+        "print(time.perf_counter() - t)"
+    )
+    report.append(("app (modül yükleme)", times.get("app")))
+    try:
+        report.append(("fontlar (ilk overlay)", float(stdout.strip().splitlines()[-1])))
+    except (ValueError, IndexError):
+        report.append(("fontlar (ilk overlay)", None))
+    for name in modules:
+        times, _ = run(f"import {name}") if _module_available(name) else ({}, "")
+        report.append((name, times.get(name)))
+    return report
+
+# -----------------------------------------------------------------------------
+# UI yardımcıları
+# -----------------------------------------------------------------------------
+def _serve_file_download(
+    label: str,
+    path: str,
+    file_name: str,
+    caption: Optional[str] = None,
+    remove_after: bool = True,
+    mime: str = "application/zip",
+):
+    """
+    Diskteki dosyayı indirme butonuna verir; remove_after ise ardından geçici dosyayı siler.
+    (ZIP bellekte ayrıca BytesIO + getvalue() kopyası olarak tutulmaz.)
+    """
+    try:
+        with open(path, "rb") as fh:
+            st.download_button(label, fh, file_name=file_name, mime=mime)
+    finally:
+        if remove_after:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    if caption:
+        st.caption(caption)
+
+def _serve_artifact(key: str, path: str, label: str, file_name: str, caption: str,
+                    mime: str = "application/zip"):
+    """Yeni üretilen çıktıyı önbelleğe alır ve sunar; önbelleğe alınamazsa geçici dosya silinir."""
+    cached = artifact_cache_put(key, path, {"caption": caption})
+    _serve_file_download(label, cached or path, file_name=file_name, caption=caption,
+                         remove_after=cached is None, mime=mime)
+
+def _serve_cached_artifact(key: str, label: str, file_name: str, mime: str = "application/zip") -> bool:
+    """Önbellekte varsa hemen sunar ve True döndürür."""
+    hit = artifact_cache_get(key)
+    if hit is None:
+        return False
+    path, meta = hit
+    caption = "♻️ Önbellekten sunuldu"
+    if meta.get("caption"):
+        caption += f" • {meta['caption']}"
+    try:
+        _serve_file_download(label, path, file_name=file_name, caption=caption,
+                             remove_after=False, mime=mime)
+    except OSError:
+        return False  # arada başka bir oturum tarafından silindiyse yeniden üretilir
+    return True
+
+def _format_optimize_report(report: dict, optimized: bool) -> str:
+    n = report["pages"]
+    msg = f"{n} sayfa"
+    if optimized and report["bytes_before"] and report["measured_after"]:
+        after = report["bytes_after"]
+        before = after * report["bytes_before"] / report["measured_after"]
+        saved = 100.0 * (before - after) / before
+        msg += (f" • toplam boyut ~{before / 1024:,.0f} KB → {after / 1024:,.0f} KB "
+                f"(%{saved:.1f} küçüldü; {report['measured']} sayfalık örneğe göre)")
+    if report.get("reused"):
+        msg += f" • {report['reused']} sayfa önceki çalıştırmadan yeniden kullanıldı"
+    return msg
+
+
+def _preflight_details(res: dict, limit: int = 20) -> List[str]:
+    def short(items) -> str:
+        items = list(items)
+        return ", ".join(str(x) for x in items[:limit]) + (f" … (+{len(items) - limit})" if len(items) > limit else "")
+
+    lines = []
+    if res["missing_pages"]:
+        lines.append(f"DaireID bulunamayan sayfalar: {short(res['missing_pages'])}")
+    if res["duplicates"]:
+        lines.append("Tekrar eden DaireID: " + short(
+            f"{did} (sayfa {', '.join(map(str, pages))})" for did, pages in res["duplicates"].items()))
+    cov = res.get("coverage")
+    if cov:
+        if cov["not_in_contacts"]:
+            lines.append(f"PDF'te var, rehberde yok: {short(cov['not_in_contacts'])}")
+        if cov["not_in_pdf"]:
+            lines.append(f"Rehberde var, PDF'te yok: {short(cov['not_in_pdf'])}")
+        if cov["no_phone"]:
+            lines.append(f"Rehberde telefonu boş: {short(cov['no_phone'])}")
+        if cov["bad_phone"]:
+            lines.append(f"Telefonu geçersiz: {short(cov['bad_phone'])}")
+    return lines
+
+
+def _stream_manas_totals(pdf_bytes: bytes, max_pages: Optional[int] = None):
+    """
+    iter_manas_pdf_totals'ı ilerleme çubuğu ve canlı ara tabloyla çalıştırır.
+    Dönüş: (totals_map, DaireID bulunamayan sayfa no'ları, tekrar eden DaireID'ler)
+    """
+    import pandas as pd
+    n = pdf_page_count(pdf_bytes)
+    if max_pages is not None:
+        n = min(n, max_pages)
+    progress = st.progress(0.0, text=f"0/{n} sayfa")
+    table = st.empty()
+
+    totals_map: Dict[str, Dict[str, float]] = {}
+    rows, missing, dups = [], [], []
+    last = 0.0
+    for pi, did, vals in iter_manas_pdf_totals(pdf_bytes, max_pages):
+        if did is None:
+            missing.append(pi + 1)
         else:
+            if did in totals_map:
+                dups.append(did)
+            totals_map[did] = vals
+            rows.append({"sayfa": pi + 1, "daire_id": did, **vals})
+        now = time.perf_counter()
+        if now - last >= 0.25:  # her sayfada yeniden çizmek ayrıştırmadan pahalı
+            last = now
+            progress.progress((pi + 1) / max(n, 1), text=f"{pi + 1}/{n} sayfa • {len(totals_map)} daire")
+            if rows:
+                table.dataframe(pd.DataFrame(rows[-15:]), hide_index=True, use_container_width=True)
+
+    progress.progress(1.0, text=f"{n}/{n} sayfa • {len(totals_map)} daire")
+    if rows:
+        table.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True, height=250)
+    else:
+        table.empty()
+
+    if missing and missing[0] == 1:
+        rec0 = _page_text_doc(pdf_content_hash(pdf_bytes))["pages"].get(0) or {}
+        st.info("⚠️ Daire No satırı bulunamadı. İlk sayfanın normalize içeriğinin bir kısmı:")
+        st.code((rec0.get("norm") or "")[:800])
+    return totals_map, missing, dups
+
+
+def _format_manas_scan(n_pages: int, totals_map: dict, missing: List[int], dups: List[str]) -> str:
+    msg = f"{n_pages} sayfa • {len(totals_map)} daire"
+    if missing:
+        head = ", ".join(str(p) for p in missing[:10])
+        msg += f" • DaireID bulunamayan {len(missing)} sayfa ({head}{'…' if len(missing) > 10 else ''})"
+    if dups:
+        msg += f" • tekrar eden DaireID: {', '.join(sorted(set(dups))[:10])}"
+    return msg
+
+# -----------------------------------------------------------------------------
+# UI — Sekmeler
+# -----------------------------------------------------------------------------
+def main():
+    """Streamlit arayüzü. `streamlit run app.py` ile çalışır; import edildiğinde (CLI) çalışmaz."""
+    st.set_page_config(page_title="Fatura • Atlas Vadi", page_icon="🧾", layout="wide")
+
+    st.title("🧾 Atlas Vadi Fatura — Böl & Alt Yazı & Apsiyon")
+
+    tab_a, tab_b, tab_c, tab_w, tab_panel = st.tabs([
+        "📄 Böl & Alt Yazı",
+        "📊 Apsiyon Gider Doldurucu",
+        "📤 WhatsApp Gönderim Hazırlığı",
+        "📲 WhatsApp Gönder (Cloud API)",
+        "💬 Mesaj Paneli"
+    ])
+
+    # ---------------- TAB A: Böl & Alt Yazı ----------------
+    with tab_a:
+        pdf_file = st.file_uploader("Fatura PDF dosyasını yükle", type=["pdf"], key="pdf_a")
+
+        if pdf_file:
+            st.session_state["pdf_bytes"] = pdf_file.getvalue()
+
+        st.subheader("Alt Yazı Kaynağı")
+        t1, t2 = st.tabs(["✍️ Metin alanı", "📄 .docx yükle (opsiyonel)"])
+
+        with t1:
+            footer_text = st.text_area(
+                "Alt yazı (kalın yapmak istediğiniz kelimenin başına ve sonuna ** hem büyük hem kalın yapmak istiyorsanız *** koyunuz )",
+                value=DEFAULT_FOOTER_TEXT,
+                height=220,
+                key="footer_text"
+            )
+
+        with t2:
+            if not HAS_DOCX:
+                st.info("python-docx yüklü değilse .docx modu devre dışı olur.")
+            docx_file = st.file_uploader(".docx yükleyin (opsiyonel)", type=["docx"], key="docx_up")
+            if docx_file and HAS_DOCX:
+                try:
+                    import docx  # python-docx
+                    d = docx.Document(docx_file)
+                    paragraphs = [p.text for p in d.paragraphs]
+                    docx_text = "\n".join(paragraphs).strip()
+                    if docx_text:
+                        footer_text = docx_text
+                        st.success("Alt yazı .docx içeriğinden alındı.")
+                except Exception as e:
+                    st.error(f".docx okunamadı: {e}")
+
+        st.subheader("Görünüm Ayarları")
+        c1, c2 = st.columns(2)
+        with c1:
+            font_size = st.slider("🅰️ Yazı Boyutu", 9, 16, 11, key="fs")
+            leading = st.slider("↕️ Satır Aralığı (pt)", 12, 22, 14, key="lead")
+        with c2:
+            align = st.radio("Hizalama", ["left", "center"], index=0, key="align",
+                             format_func=lambda x: "Sol" if x == "left" else "Orta")
+            bottom_m = st.slider("Alt Marj (pt)", 24, 100, 48, key="bm")
+        box_h = st.slider("Alt Yazı Alanı Yüksekliği (pt)", 100, 260, 180, key="bh")
+        bold_rules = st.checkbox("Başlıkları otomatik kalın yap (SON ÖDEME, AÇIKLAMA, ...)",
+                                 value=True, key="boldrules")
+
+        with st.expander("🏷️ Daire numarası etiketi & yeniden adlandırma (opsiyonel)", expanded=False):
+            stamp_on = st.checkbox("Daire numarasını köşeye yaz", value=False, key="stamp_on")
+            label_tpl = st.text_input("Etiket şablonu", value="Daire: {daire_id}", key="label_tpl")
+            c3, c4, c5 = st.columns(3)
+            with c3:
+                stamp_font_size = st.slider("Etiket punto", 10, 20, 13, key="stamp_fs")
+            with c4:
+                stamp_pos = st.selectbox("Konum", ["TR", "TL", "BR", "BL"], index=0, key="stamp_pos")
+            with c5:
+                stamp_bold = st.checkbox("Kalın", value=True, key="stamp_bold")
+            c6, c7 = st.columns(2)
+            with c6:
+                pad_x = st.slider("Köşe yatay boşluk (px)", 0, 80, 20, step=2, key="pad_x")
+            with c7:
+                pad_y = st.slider("Köşe dikey boşluk (px)", 0, 80, 20, step=2, key="pad_y")
+            rename_files = st.checkbox("Bölünmüş dosya adını daireID.pdf yap",
+                                       value=True, key="rename_files")
+
+        shared_footer = st.checkbox(
+            "Tek PDF modunda alt yazıyı bir kez göm (Form XObject, daha küçük dosya)",
+            value=True, key="shared_footer",
+        )
+
+        with st.expander("⚙️ Performans", expanded=False):
+            workers = st.number_input(
+                "Paralel işçi sayısı (1 = seri)",
+                min_value=1, max_value=max(1, os.cpu_count() or 1), value=1, step=1,
+                key="workers",
+                help=f"Deneysel: işçiler sunucu sürecinden fork edilir. {PARALLEL_MIN_PAGES} sayfadan "
+                     "kısa PDF'ler her zaman seri işlenir.",
+            )
+            optimize_pages = st.checkbox(
+                "Bölünmüş PDF'leri küçült (kullanılmayan kaynakları at, akışları sıkıştır)",
+                value=True, key="optimize_pages",
+            )
+            fast_id = st.checkbox(
+                "Daire No'yu yalnız sayfanın üst bölgesinden oku (hızlı; bulunamazsa tam sayfa)",
+                value=False, key="fast_id",
+            )
+            use_ocr = st.checkbox(
+                "📷 Metin katmanı olmayan (taranmış) sayfalarda Daire No için OCR uygula",
+                value=False, key="use_ocr", disabled=not HAS_OCR,
+            )
+            if not HAS_OCR:
+                st.caption("OCR için easyocr veya pytesseract ile pdf2image (poppler) gerekir.")
+            cs = artifact_cache_stats()
+            st.caption(
+                f"Çıktı önbelleği: {cs['entries']} kayıt + {cs['ocr_entries']} OCR, {cs['bytes'] / 1024 / 1024:.1f} / "
+                f"{cs['max_bytes'] / 1024 / 1024:.0f} MB • isabet {cs['hits']} • ıska {cs['misses']} "
+                f"• atılan {cs['evictions']}"
+            )
+            if st.button("🧹 Çıktı önbelleğini temizle", key="clear_artifacts"):
+                clear_artifact_cache()
+                st.success("Önbellek temizlendi.")
+            st.caption(f"Modül yükleme: {APP_IMPORT_SECONDS * 1000:.0f} ms "
+                       "(ağır kütüphaneler ilk kullanımda yüklenir)")
+            if st.button("⏱️ Import süre raporu", key="import_report"):
+                with st.spinner("Temiz süreçlerde ölçülüyor..."):
+                    rows = import_time_report()
+                st.table([{"Modül": name, "Süre (ms)": "—" if sec is None else f"{sec * 1000:.0f}"}
+                          for name, sec in rows])
+
+        st.subheader("İşlem")
+        mode = st.radio(
+            "Ne yapmak istersiniz?",
+            ["Sadece sayfalara böl", "Sadece alt yazı uygula (tek PDF)", "Alt yazı uygula + sayfalara böl (ZIP)"],
+            index=2,
+            key="mode"
+        )
+        with st.expander("🔎 Ön kontrol (hızlı: yalnız Daire No taraması)", expanded=False):
+            pre_contacts = st.file_uploader(
+                "Rehber (opsiyonel, kapsama için) — XLSX/CSV", type=["xlsx", "csv"], key="pre_rehber"
+            )
+            if st.button("🔎 Ön kontrolü çalıştır", key="go_preflight"):
+                if not pdf_file:
+                    st.warning("Lütfen önce bir PDF yükleyin.")
+                else:
+                    contacts = None
+                    if pre_contacts:
+                        try:
+                            contacts = load_contacts_any(pre_contacts.getvalue(), pre_contacts.name)
+                        except Exception as e:
+                            st.error(f"Rehber okunamadı: {e}")
+                    with st.spinner("Daire numaraları taranıyor..."):
+                        pre = preflight_scan(pdf_file.getvalue(), contacts)
+                    if preflight_ok(pre):
+                        st.success(format_preflight(pre))
+                    else:
+                        st.warning(format_preflight(pre))
+                    for line in _preflight_details(pre):
+                        st.markdown(f"- {line}")
+
+        go = st.button("🚀 Başlat", key="go_a")
+
+        if go:
+            if not pdf_file:
+                st.warning("Lütfen önce bir PDF yükleyin.")
+                st.stop()
+
+            src = pdf_file.read()
+
             footer_kwargs = dict(
                 footer_text=footer_text,
                 font_size=font_size,
@@ -1242,485 +4052,770 @@ with tab_a:
                 pad_x=pad_x,
                 pad_y=pad_y,
             )
-            pages = add_footer_and_stamp_per_page(
-                src_bytes=src,
-                footer_kwargs=footer_kwargs,
-                stamp_on=stamp_on,
-                label_tpl=label_tpl,
-                stamp_opts=stamp_opts,
-                rename_files=rename_files,
-            )
-            with io.BytesIO() as zbuf:
-                with zipfile.ZipFile(zbuf, "w", zipfile.ZIP_DEFLATED) as z:
-                    for name, data in pages:
-                        z.writestr(name, data)
-                st.download_button("📥 Alt yazılı & bölünmüş (ZIP)",
-                                   zbuf.getvalue(),
-                                   file_name="alt_yazili_bolunmus.zip")
-
-# ---------------- TAB B: Apsiyon Gider Doldurucu ----------------
-with tab_b:
-    st.subheader("📊 Apsiyon Gider Doldurucu")
-
-    apsiyon_file = st.file_uploader(
-        "Apsiyon 'boş şablon' Excel dosyasını yükle (.xlsx)",
-        type=["xlsx"],
-        key="apsiyon_up",
-    )
 
-    colM1, colM2 = st.columns(2)
-    with colM1:
-        aps_mode = st.radio(
-            "Doldurma Şekli",
-            [
-                "Seçenek 1 (G1=Sıcak Su, G2=Su, G3=Isıtma)",
-                "Seçenek 2 (G1=Toplam, G2/G3 boş)",
-                "Seçenek 3 (G1=Sıcak Su)",
-                "Seçenek 4 (G1=Su)",
-                "Seçenek 5 (G1=Isıtma)",
-            ],
-            index=0,
-            key="aps_mode",
-        )
-    with colM2:
-        exp1 = st.text_input("Gider1 Açıklaması", value="Sıcak Su", key="aps_exp1")
-        exp2 = st.text_input("Gider2 Açıklaması", value="Soğuk Su", key="aps_exp2")
-        exp3 = st.text_input("Gider3 Açıklaması", value="Isıtma",    key="aps_exp3")
-
-    extra_amount = st.number_input(
-        "Her DAİRE için ek fark / düzeltme (TL, negatif de olabilir)",
-        value=0.0,
-        step=1.0,
-        format="%.2f",
-        key="extra_amount",
-    )
+            if mode == "Sadece sayfalara böl":
+                key = artifact_key(src, "split", optimize=optimize_pages)
+                label, fname = "📥 Bölünmüş sayfalar (ZIP)", "bolunmus_sayfalar.zip"
+                if not _serve_cached_artifact(key, label, fname):
+                    opt_report = new_optimize_report()
+                    zip_path, n_out = pages_zip_to_tempfile(iter_split_pages(src, optimize_pages, opt_report))
+                    _serve_artifact(key, zip_path, label, fname,
+                                    caption=_format_optimize_report(opt_report, optimize_pages))
+
+            elif mode == "Sadece alt yazı uygula (tek PDF)":
+                key = artifact_key(src, "footer", footer=footer_kwargs, shared_xobject=shared_footer)
+                label, fname = "📥 Alt yazılı PDF", "alt_yazili.pdf"
+                if not _serve_cached_artifact(key, label, fname, mime="application/pdf"):
+                    stamped = add_footer_to_pdf(src, shared_xobject=shared_footer, **footer_kwargs)
+                    artifact_cache_put_bytes(key, stamped)
+                    st.download_button(label, stamped, file_name=fname)
 
-    go_fill = st.button("📥 PDF’ten tutarları çek ve Excel’e yaz", key="go_fill")
-
-    if go_fill:
-        pdf_bytes = st.session_state.get("pdf_bytes")
-        if not pdf_bytes:
-            st.warning("Önce A sekmesinde fatura PDF’sini yükleyin (aynı PDF).")
-            st.stop()
-
-        if not apsiyon_file:
-            st.warning("Apsiyon Excel şablonunu yükleyin.")
-            st.stop()
-
-        # 1) PDF’ten daire bazlı tutarları oku
-        totals_map = parse_manas_pdf_totals(pdf_bytes)
-        if not totals_map:
-            st.error("PDF’ten tutar okunamadı. (Daire başlıkları veya tutarlar bulunamadı)")
-            st.stop()
-
-        # 2) Her dairenin TOPLAM'INA extra ekle (Seçenek 2'de mantıklı)
-        extra = float(extra_amount)
-        if extra != 0.0:
-            for did, vals in totals_map.items():
-                vals["toplam"] = vals.get("toplam", 0.0) + extra
-
-        # 3) PDF toplamını (artık dairelere eklenmiş haliyle) hesapla
-        pdf_total = sum(v.get("toplam", 0.0) for v in totals_map.values())
-        grand_total = pdf_total
-
-        st.info(
-            f"**Dairelere eklenmiş yeni PDF toplamı:** {pdf_total:,.2f} TL\n\n"
-            f"(Her daireye eklenen fark: {extra:,.2f} TL)"
+            else:
+                key = artifact_key(
+                    src, "footer_split",
+                    footer=footer_kwargs,
+                    stamp=(dict(label_tpl=label_tpl, **stamp_opts) if stamp_on else None),
+                    rename_files=rename_files,
+                    optimize=optimize_pages,
+                    ocr=use_ocr,
+                    fast_id=fast_id,
+                )
+                label, fname = "📥 Alt yazılı & bölünmüş (ZIP)", "alt_yazili_bolunmus.zip"
+                if not _serve_cached_artifact(key, label, fname):
+                    if use_ocr and (stamp_on or rename_files):
+                        with st.spinner("Metin katmanı olmayan sayfalar OCR'lanıyor..."):
+                            ocr_stats = ocr_missing_pages(
+                                src, region=DAIRE_SCAN_REGION if fast_id else None, workers=int(workers)
+                            )
+                        if ocr_stats["pages"]:
+                            st.caption(format_ocr_stats(ocr_stats))
+                    opt_report = new_optimize_report()
+                    pages = iter_footer_and_stamp_pages(
+                        src_bytes=src,
+                        footer_kwargs=footer_kwargs,
+                        stamp_on=stamp_on,
+                        label_tpl=label_tpl,
+                        stamp_opts=stamp_opts,
+                        rename_files=rename_files,
+                        workers=int(workers),
+                        optimize=optimize_pages,
+                        report=opt_report,
+                        fast_id=fast_id,
+                    )
+                    zip_path, n_out = pages_zip_to_tempfile(pages)
+                    if opt_report.get("parallel_error"):
+                        st.warning(f"Paralel işleme başlatılamadı, sayfalar seri işlendi: {opt_report['parallel_error']}")
+                    _serve_artifact(key, zip_path, label, fname,
+                                    caption=_format_optimize_report(opt_report, optimize_pages))
+                    rev = revision_diff(src)
+                    if rev:
+                        st.info(format_revision_diff(rev))
+                        if rev["flats_changed"]:
+                            with st.expander(f"📝 Sayfası değişen daireler ({len(rev['flats_changed'])})"):
+                                st.dataframe(rev["flats_changed"], hide_index=True, use_container_width=True)
+
+    # ---------------- TAB B: Apsiyon Gider Doldurucu ----------------
+    with tab_b:
+        st.subheader("📊 Apsiyon Gider Doldurucu")
+
+        apsiyon_file = st.file_uploader(
+            "Apsiyon 'boş şablon' Excel dosyasını yükle (.xlsx)",
+            type=["xlsx"],
+            key="apsiyon_up",
         )
 
-        # 4) Apsiyon şablonunu oku
-        try:
-            df_aps = load_apsiyon_template(apsiyon_file.read())
-        except Exception as e:
-            st.error(f"Excel okunamadı: {e}")
-            st.stop()
-
-        # 5) Daire satırlarına giderleri yaz
-        df_out = fill_expenses_to_apsiyon(df_aps, totals_map, aps_mode, exp1, exp2, exp3)
+        colM1, colM2 = st.columns(2)
+        with colM1:
+            aps_mode = st.radio(
+                "Doldurma Şekli",
+                APSIYON_MODES,
+                index=0,
+                key="aps_mode",
+            )
+        with colM2:
+            exp1 = st.text_input("Gider1 Açıklaması", value="Sıcak Su", key="aps_exp1")
+            exp2 = st.text_input("Gider2 Açıklaması", value="Soğuk Su", key="aps_exp2")
+            exp3 = st.text_input("Gider3 Açıklaması", value="Isıtma",    key="aps_exp3")
+
+        extra_amount = st.number_input(
+            "Her DAİRE için ek fark / düzeltme (TL, negatif de olabilir)",
+            value=0.0,
+            step=1.0,
+            format="%.2f",
+            key="extra_amount",
+        )
 
-        # 6) Özet bilgiyi hazırlayıp Excel’e göm
-        summary = {
-            "ek_fark_her_daire": extra,
-            "pdf_total_yeni": pdf_total,
-        }
+        aps_ocr = st.checkbox(
+            "📷 Metin katmanı olmayan (taranmış) sayfalara OCR uygula",
+            value=False, key="aps_ocr", disabled=not HAS_OCR,
+        )
+        aps_export = st.radio(
+            "Çıktı", APSIYON_EXPORTS, index=0, horizontal=True, key="aps_export",
+            help="Şablonu korumak, Apsiyon içe aktarımının beklediği biçim ve sayfaları bozmaz.",
+        )
 
-        out_bytes = export_excel_bytes(df_out, summary=summary)
+        colV1, colV2 = st.columns([1, 2])
+        with colV1:
+            validate_n = st.number_input(
+                "Hızlı doğrulama: ilk N sayfa", min_value=1, value=10, step=5, key="aps_validate_n",
+            )
+        with colV2:
+            st.write("")
+            go_validate = st.button("🔎 İlk N sayfayı doğrula (yanlış PDF'i erken yakala)", key="go_validate")
+
+        colP1, colP2, colP3 = st.columns([1, 1, 2])
+        with colP1:
+            aps_period = st.text_input(
+                "Dönem (YYYY-AA)", value="", key="aps_period",
+                placeholder=datetime.now().strftime("%Y-%m"),
+                help="Yalnız kayıtlı dönemden okurken veya döneme kaydederken gerekir.",
+            )
+        with colP2:
+            aps_site = st.text_input("Site (ops.)", value="", key="aps_site").strip()
+        with colP3:
+            aps_source = st.radio("Tutar kaynağı", APSIYON_SOURCES, horizontal=True, key="aps_source")
+            save_period = st.checkbox(
+                "💾 PDF’ten okunan tutarları bu döneme kaydet", value=False, key="aps_save_period",
+                disabled=aps_source != APSIYON_SOURCES[0],
+            )
+            overwrite_period = st.checkbox(
+                "Dönemde başka bir PDF’ten kayıt varsa üzerine yaz", value=False, key="aps_overwrite_period",
+                disabled=not save_period or aps_source != APSIYON_SOURCES[0],
+            )
 
-        st.success("Excel dolduruldu.")
-        st.download_button(
-            "📥 Doldurulmuş Apsiyon Excel",
-            out_bytes,
-            file_name="Apsiyon_Doldurulmus.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            key="dl_aps",
-        )
+        go_fill = st.button("📥 Tutarları çek ve Excel’e yaz", key="go_fill")
 
-# ---------------- TAB C: WhatsApp Gönderim Hazırlığı (sade) ----------------
-with tab_c:
-    st.markdown("""
-    <div style='background-color:#25D366;padding:10px 16px;border-radius:10px;display:flex;align-items:center;gap:10px;color:white;margin-bottom:15px;'>
-      <img src='https://upload.wikimedia.org/wikipedia/commons/6/6b/WhatsApp.svg' width='28'>
-      <h3 style='margin:0;'>WhatsApp Gönderim Hazırlığı</h3>
-    </div>
-    """, unsafe_allow_html=True)
+        if go_validate:
+            pdf_bytes = st.session_state.get("pdf_bytes")
+            if not pdf_bytes:
+                st.warning("Önce A sekmesinde fatura PDF’sini yükleyin (aynı PDF).")
+                st.stop()
+            n_check = min(int(validate_n), pdf_page_count(pdf_bytes))
+            totals_map, missing, dups = _stream_manas_totals(pdf_bytes, max_pages=n_check)
+            msg = _format_manas_scan(n_check, totals_map, missing, dups)
+            if not totals_map or len(missing) * 2 > n_check:
+                st.error(f"Bu PDF beklenen MANAS faturası gibi görünmüyor: {msg}")
+            elif missing or dups:
+                st.warning(msg)
+            else:
+                st.success(msg)
 
-    st.markdown("**Bu yöntemde ZIP gerekmez.** PDF’leri Google Drive’daki klasöre koyman yeterli.")
+        if go_fill:
+            from_db = aps_source == APSIYON_SOURCES[1]
+            pdf_bytes = st.session_state.get("pdf_bytes")
+            if not pdf_bytes and not from_db:
+                st.warning("Önce A sekmesinde fatura PDF’sini yükleyin (aynı PDF).")
+                st.stop()
 
-    if not _GDRIVE_OK:
-        st.error("Google Drive kütüphaneleri yüklü değil. Terminalde şunu kur:\n\n"
-                 "pip install google-api-python-client google-auth google-auth-oauthlib")
-    else:
-        folder_id = st.text_input(
-            "Drive Folder ID",
-            value=DEFAULT_DRIVE_FOLDER_ID,
-            help="Klasör ID: 1QTVqRbxim9OxsSOD33uvesQg2dUO2r2n"
-        )
+            if not apsiyon_file:
+                st.warning("Apsiyon Excel şablonunu yükleyin.")
+                st.stop()
 
-        rehber_up2 = st.file_uploader(
-            "Rehber (XLSX/CSV) — Apsiyon ham dosya",
-            type=["xlsx", "csv"], key="wa_rehber2"
-        )
+            period = None
+            if from_db or save_period:
+                try:
+                    period = normalize_period(aps_period)
+                except ValueError as e:
+                    st.error(str(e))
+                    st.stop()
+
+            if from_db:
+                # 1) Kayıtlı dönemden oku — PDF açılmaz
+                totals_map = load_period_totals(period, site=aps_site)
+                if not totals_map:
+                    st.error(f"{period} dönemi için kayıtlı tutar yok.")
+                    st.stop()
+                st.caption(f"{period}: {len(totals_map)} daire kayıtlı tutarlardan okundu.")
+            else:
+                # 1) PDF’ten daire bazlı tutarları oku (ops. taranmış sayfalar önce OCR'lanır)
+                if aps_ocr:
+                    with st.spinner("Metin katmanı olmayan sayfalar OCR'lanıyor..."):
+                        ocr_stats = ocr_missing_pages(pdf_bytes)
+                    if ocr_stats["pages"]:
+                        st.caption(format_ocr_stats(ocr_stats))
+                totals_map, missing, dups = _stream_manas_totals(pdf_bytes)
+                if missing or dups:
+                    st.caption(_format_manas_scan(pdf_page_count(pdf_bytes), totals_map, missing, dups))
+                if not totals_map:
+                    st.error("PDF’ten tutar okunamadı. (Daire başlıkları veya tutarlar bulunamadı)")
+                    st.stop()
+                if save_period:
+                    pdf_hash = pdf_content_hash(pdf_bytes)
+                    other = [h for h in period_pdf_hashes(period, site=aps_site) if h != pdf_hash]
+                    if other and not overwrite_period:
+                        st.warning(f"{period} dönemi başka bir PDF’ten kaydedilmiş; kayıt değiştirilmedi "
+                                   "(üzerine yazmak için kutuyu işaretleyin).")
+                    else:
+                        n_saved = save_period_totals(period, totals_map, site=aps_site, pdf_hash=pdf_hash)
+                        st.caption(f"💾 {n_saved} daire {period} dönemine kaydedildi.")
+                        if other:
+                            st.warning(f"{period} dönemindeki başka PDF’ten gelen kayıtların yerini aldı.")
+
+            # 1b) Mutabakat: kalemler = TOPLAM mı, sıfır tüketim, aykırı daireler (ek fark öncesi)
+            recon_df = reconcile_totals(totals_map)
+            flagged = recon_df[recon_df["durum"] != ""]
+            recon_msg = format_reconcile_summary(reconcile_summary(recon_df))
+            if len(flagged):
+                st.warning(recon_msg)
+                with st.expander(f"🧮 İşaretli daireler ({len(flagged)})"):
+                    st.dataframe(flagged, hide_index=True, use_container_width=True)
+            else:
+                st.caption(recon_msg)
+            st.download_button(
+                "🧮 Mutabakat / anomali raporu (Excel)",
+                anomaly_report_bytes(recon_df),
+                file_name="Mutabakat_Raporu.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key="dl_recon",
+            )
 
-        link_mode = st.radio(
-            "Link tipi",
-            ["Doğrudan indirme (önerilir)", "Görüntüleme linki (Drive görünümü)"],
-            horizontal=True
-        )
+            # 2) Her dairenin TOPLAM'INA extra ekle (Seçenek 2'de mantıklı)
+            extra = float(extra_amount)
+            if extra != 0.0:
+                for did, vals in totals_map.items():
+                    vals["toplam"] = vals.get("toplam", 0.0) + extra
 
-        drive_go = st.button("🗂️ Drive’dan PDF’leri çek, eşleştir ve CSV üret",
-                             use_container_width=True)
+            # 3) PDF toplamını (artık dairelere eklenmiş haliyle) hesapla
+            pdf_total = sum(v.get("toplam", 0.0) for v in totals_map.values())
 
-        if drive_go:
-            if not folder_id.strip():
-                st.error("Folder ID boş olamaz."); st.stop()
-            if not rehber_up2:
-                st.error("Rehber dosyası yükleyin."); st.stop()
+            st.info(
+                f"**Dairelere eklenmiş yeni PDF toplamı:** {pdf_total:,.2f} TL\n\n"
+                f"(Her daireye eklenen fark: {extra:,.2f} TL)"
+            )
 
-            # 1) Drive servisine bağlan (Secrets)
+            # 4) Apsiyon şablonunu oku
+            aps_stats = {}
+            tpl_bytes = apsiyon_file.getvalue()
             try:
-                service = get_drive_service_from_secrets()
+                df_aps = load_apsiyon_template(tpl_bytes, stats=aps_stats)
             except Exception as e:
-                st.error(f"Drive servisine bağlanılamadı: {e}")
+                st.error(f"Excel okunamadı: {e}")
                 st.stop()
+            st.caption(
+                f"Şablon okundu: {aps_stats['rows']} satır"
+                + (f", başlık {aps_stats['header_row'] + 1}. satırda" if aps_stats["header_row"] is not None else "")
+                + f" ({aps_stats['seconds']:.2f} sn)"
+            )
 
-            # 2) Klasördeki PDF'leri çek
-            try:
-                gfiles = list_pdfs_in_folder(service, folder_id.strip())
-            except Exception as e:
-                st.error(f"Klasör listelenemedi: {e}")
-                st.stop()
+            # 5) Daire satırlarına giderleri yaz
+            df_out = fill_expenses_to_apsiyon(df_aps, totals_map, aps_mode, exp1, exp2, exp3)
 
-            if not gfiles:
-                st.warning("Klasörde PDF bulunamadı."); st.stop()
-
-            # 3) PDF adlarından DaireID tahmini (A1-001.pdf gibi)
-            pdf_rows = []
-            for f in gfiles:
-                base = f.get("name", "")
-                m = (re.search(r"([A-Za-z]\d)\s*[-_]\s*(\d{1,3})", base)
-                     or re.search(r"([A-Za-z]\d)\s+(\d{1,3})", base)
-                     or re.search(r"([A-Za-z]\d).*?(\d{3})", base))
-                daire_id = None
-                if m:
-                    try:
-                        daire_id = f"{m.group(1).upper()}-{int(m.group(2)):03d}"
-                    except:
-                        daire_id = f"{m.group(1).upper()}-{m.group(2)}"
-                pdf_rows.append({"file_name": base,
-                                 "DaireID": daire_id,
-                                 "file_id": f["id"]})
-            pdf_df = pd.DataFrame(pdf_rows)
-
-            # 4) Rehberi oku
-            try:
-                rehber_df = load_contacts_any(rehber_up2.read(), rehber_up2.name)
-            except Exception as e:
-                st.error(f"Rehber okunamadı / eşlenemedi: {e}"); st.stop()
+            # 6) Özet bilgiyi hazırlayıp Excel’e göm
+            summary = {
+                "ek_fark_her_daire": extra,
+                "pdf_total_yeni": pdf_total,
+            }
 
-            # 5) Eşleştir
-            merged = pdf_df.merge(
-                rehber_df[["DaireID", "Telefon", "Ad Soyad / Unvan"]],
-                on="DaireID",
-                how="left"
+            out_bytes = None
+            if aps_export == APSIYON_EXPORTS[0]:
+                patch_stats = {}
+                try:
+                    out_bytes = patch_apsiyon_excel_bytes(
+                        tpl_bytes, df_aps, df_out, aps_stats["header_row"], aps_stats["columns"],
+                        summary=summary, stats=patch_stats,
+                    )
+                    st.caption(f"Şablona {patch_stats['cells']} hücre yazıldı ({patch_stats['seconds']:.2f} sn); "
+                               "biçim ve diğer sayfalar korundu.")
+                except Exception as e:
+                    st.warning(f"Şablon korunarak yazılamadı ({e}); tablo yeniden oluşturuluyor.")
+            if out_bytes is None:
+                out_bytes = export_excel_bytes(df_out, summary=summary)
+
+            st.success("Excel dolduruldu.")
+            st.download_button(
+                "📥 Doldurulmuş Apsiyon Excel",
+                out_bytes,
+                file_name="Apsiyon_Doldurulmus.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key="dl_aps",
             )
 
-            # 6) Dosyaları "linke sahip olan görüntüleyebilir" yap + link üret
-            link_kind = "download" if link_mode.startswith("Doğrudan") else "view"
+        with st.expander("🗂️ Toplu doldurma (çok site / dönem)"):
+            st.caption("Her PDF aynı adlı şablonla eşlenir (vadi_2025-10.pdf ↔ vadi_2025-10.xlsx); "
+                       "tek şablon yüklenirse tüm PDF'ler onu kullanır. Açıklamalar ve çıktı biçimi yukarıdan alınır.")
+            batch_pdfs = st.file_uploader("Fatura PDF'leri", type=["pdf"], accept_multiple_files=True, key="batch_pdfs")
+            batch_tpls = st.file_uploader("Apsiyon şablonları (.xlsx)", type=["xlsx"],
+                                          accept_multiple_files=True, key="batch_tpls")
+            if batch_pdfs:
+                tpl_by_name = {f.name: f for f in batch_tpls or []}
+                pairs = pair_batch_files([f.name for f in batch_pdfs], list(tpl_by_name))
+                plan = st.data_editor(
+                    [{"PDF": f.name, "Şablon": pairs[f.name], "Seçenek": aps_mode, "Ek fark": float(extra_amount)}
+                     for f in batch_pdfs],
+                    column_config={
+                        "PDF": st.column_config.TextColumn(disabled=True),
+                        "Şablon": st.column_config.SelectboxColumn(options=list(tpl_by_name)),
+                        "Seçenek": st.column_config.SelectboxColumn(options=APSIYON_MODES, required=True),
+                        "Ek fark": st.column_config.NumberColumn(format="%.2f", step=1.0),
+                    },
+                    hide_index=True, use_container_width=True, key="batch_plan",
+                )
+                batch_workers = st.number_input(
+                    "Aynı anda işlenecek iş sayısı",
+                    min_value=1, max_value=max(1, os.cpu_count() or 1), value=1, step=1,
+                    key="batch_workers",
+                    help="Deneysel: 1'den büyükse işçiler sunucu sürecinden fork edilir.",
+                )
+                if st.button("🚀 Tümünü doldur", key="go_batch"):
+                    pdf_by_name = {f.name: f for f in batch_pdfs}
+                    jobs = [{
+                        "name": os.path.splitext(row["PDF"])[0],
+                        "pdf_bytes": pdf_by_name[row["PDF"]].getvalue(),
+                        "template_bytes": tpl_by_name[row["Şablon"]].getvalue() if row["Şablon"] in tpl_by_name else None,
+                        "mode": row["Seçenek"] or aps_mode,
+                        "extra": row["Ek fark"] or 0.0,
+                        "exp1": exp1, "exp2": exp2, "exp3": exp3,
+                        "patch": aps_export == APSIYON_EXPORTS[0],
+                    } for row in plan]
+                    t0 = time.perf_counter()
+                    progress = st.progress(0.0, text=f"0/{len(jobs)} iş")
+                    done: List[Optional[Tuple[dict, Optional[bytes]]]] = [None] * len(jobs)
+                    batch_report: dict = {}
+                    for n, (k, res, data) in enumerate(
+                        iter_apsiyon_batch(jobs, workers=int(batch_workers), report=batch_report), start=1
+                    ):
+                        done[k] = (res, data)
+                        progress.progress(n / len(jobs), text=f"{n}/{len(jobs)} iş • son: {res['job']}")
+                    if batch_report.get("parallel_error"):
+                        st.warning(f"Paralel çalıştırma başlatılamadı, işler seri yürütüldü: "
+                                   f"{batch_report['parallel_error']}")
+                    rows = [r for r, _ in done]
+                    msg = format_apsiyon_batch(rows, time.perf_counter() - t0)
+                    if all(r["ok"] for r in rows) and not any(r["pdf_only"] + r["template_only"] for r in rows):
+                        st.success(msg)
+                    else:
+                        st.warning(msg)
+                    st.dataframe([{c: r.get(c) for c in _BATCH_COLS} for r in rows],
+                                 hide_index=True, use_container_width=True)
+                    st.download_button(
+                        "📦 Doldurulmuş şablonlar + özet (ZIP)",
+                        apsiyon_batch_archive(done),
+                        file_name="Apsiyon_Toplu.zip",
+                        mime="application/zip",
+                        key="dl_batch",
+                    )
+
+        with st.expander("📈 Dönem karşılaştırma (kayıtlı tutarlar)"):
+            periods = list_periods(site=aps_site)
+            if len(periods) < 2:
+                st.caption("Karşılaştırma için en az iki kayıtlı dönem gerekir.")
+            else:
+                names = [p[1] for p in periods]
+                colC1, colC2 = st.columns(2)
+                with colC1:
+                    cmp_cur = st.selectbox("Dönem", names, index=0, key="cmp_cur")
+                with colC2:
+                    cmp_prev = st.selectbox("Önceki dönem", names, index=1, key="cmp_prev")
+                df_cmp = compare_periods(cmp_prev, cmp_cur, site=aps_site)
+                st.dataframe(df_cmp, hide_index=True, use_container_width=True)
+                st.download_button(
+                    "⬇️ Karşılaştırmayı indir (CSV)",
+                    df_cmp.to_csv(index=False).encode("utf-8-sig"),
+                    file_name=f"donem_karsilastirma_{cmp_prev}_{cmp_cur}.csv",
+                    mime="text/csv",
+                    key="dl_cmp",
+                )
 
-            st.write("🔓 Dosyalar paylaşıma açılıyor ve linkler oluşturuluyor (dosya bazında)...")
-            for i, row in merged.iterrows():
-                fid = row.get("file_id")
-                if not fid:
-                    continue
-                try:
-                    ensure_anyone_with_link_permission(service, fid)
-                except Exception:
-                    pass
-                merged.at[i, "file_url"] = build_direct_file_link(fid, link_kind)
-
-            # 7) Önizleme + CSV
-            a1, a2, a3 = st.columns(3)
-            with a1:
-                st.metric("Toplam kayıt", len(merged))
-            with a2:
-                st.metric("DaireID bulunamadı", int(merged["DaireID"].isna().sum()))
-            with a3:
-                st.metric("Telefon eksik",
-                          int((merged["Telefon"].isna() | (merged["Telefon"] == "")).sum()))
-
-            st.markdown("**Eşleştirme Önizleme**")
-            st.dataframe(
-                merged.rename(columns={"Telefon": "phone", "Ad Soyad / Unvan": "name"}),
-                use_container_width=True, height=600
+    # ---------------- TAB C: WhatsApp Gönderim Hazırlığı (sade) ----------------
+    with tab_c:
+        st.markdown("""
+        <div style='background-color:#25D366;padding:10px 16px;border-radius:10px;display:flex;align-items:center;gap:10px;color:white;margin-bottom:15px;'>
+          <img src='https://upload.wikimedia.org/wikipedia/commons/6/6b/WhatsApp.svg' width='28'>
+          <h3 style='margin:0;'>WhatsApp Gönderim Hazırlığı</h3>
+        </div>
+        """, unsafe_allow_html=True)
+
+        st.markdown("**Bu yöntemde ZIP gerekmez.** PDF’leri Google Drive’daki klasöre koyman yeterli.")
+
+        if not _GDRIVE_OK:
+            st.error("Google Drive kütüphaneleri yüklü değil. Terminalde şunu kur:\n\n"
+                     "pip install google-api-python-client google-auth google-auth-oauthlib")
+        else:
+            folder_id = st.text_input(
+                "Drive Folder ID",
+                value=DEFAULT_DRIVE_FOLDER_ID,
+                help="Klasör ID: 1QTVqRbxim9OxsSOD33uvesQg2dUO2r2n"
             )
 
-            out_csv = merged.rename(columns={
-                "Telefon": "phone",
-                "Ad Soyad / Unvan": "name",
-                "DaireID": "daire_id",
-                "file_name": "file_name",
-                "file_url": "file_url",
-            })[["phone", "name", "daire_id", "file_name", "file_url"]]
-            b_csv = out_csv.to_csv(index=False).encode("utf-8-sig")
-            st.download_button(
-                "📥 WhatsApp_Recipients.csv (Drive linkli)",
-                b_csv,
-                file_name="WhatsApp_Recipients.csv",
-                mime="text/csv",
-                use_container_width=True
+            wa_site = st.text_input("Site (ops.)", value="", key="wa_site").strip()
+            rehber_up2 = st.file_uploader(
+                "Rehber (XLSX/CSV) — Apsiyon ham dosya",
+                type=["xlsx", "csv"], key="wa_rehber2",
+                help="Boş bırakılırsa kayıtlı rehber kullanılır; yüklenirse yalnız farklar kaydedilir."
+            )
+            rehber_src = contacts_source(wa_site)
+            if rehber_src:
+                st.caption(f"Kayıtlı rehber: {rehber_src[1] or '—'} • {rehber_src[2]} kişi • {rehber_src[3]} UTC")
+
+            link_mode = st.radio(
+                "Link tipi",
+                ["Doğrudan indirme (önerilir)", "Görüntüleme linki (Drive görünümü)"],
+                horizontal=True
             )
 
-# ---------------- TAB W: WhatsApp Gönder (Cloud API) ----------------
-with tab_w:
-    st.markdown("### 📲 WhatsApp Gönder (Meta Cloud API)")
-
-    st.info("Gönderim, onaylı bir **şablon mesaj** ile başlatılır. Bu ekranda sadece şablon gönderilir (ekstra metin / belge yok).")
-
-    colK1, colK2 = st.columns(2)
-    with colK1:
-        csv_up = st.file_uploader("WhatsApp_Recipients.csv yükle", type=["csv"], key="wa_send_csv")
-    with colK2:
-        preview_btn = st.button("Önizle", use_container_width=True, key="wa_preview")
-
-    # API Kimlikleri (secrets varsa otomatik doldur)
-    st.markdown("#### Cloud API Ayarları")
-    default_token = st.secrets.get("whatsapp", {}).get("token", "")
-    default_phone_id = st.secrets.get("whatsapp", {}).get("phone_number_id", "")
-    colA1, colA2 = st.columns(2)
-    with colA1:
-        wa_token = st.text_input("Access Token", value=default_token, type="password",
-                                 help="Meta for Developers → WhatsApp → System User token (mümkünse kalıcı).")
-    with colA2:
-        phone_number_id = st.text_input("Phone Number ID", value=default_phone_id,
-                                        help="WABA içindeki WhatsApp numaranızın ID’si")
-
-    st.markdown("#### Şablonla Başlat (zorunlu ilk mesaj)")
-    colT1, colT2, colT3 = st.columns(3)
-    with colT1:
-        template_name = st.text_input("Template adı", value="fatura_goruntule_btn")
-    with colT2:
-        template_lang = st.text_input("Dil (BCP-47)", value="tr")
-    with colT3:
-        header_document = st.checkbox(
-            "Şablon header'ı belge (document) kullansın",
-            value=False,
-            help="Şablonunuz 'HEADER: DOCUMENT' içeriyorsa işaretleyin. PDF linkini header’a koyacağız."
-        )
+            drive_go = st.button("🗂️ Drive’dan PDF’leri çek, eşleştir ve CSV üret",
+                                 use_container_width=True)
 
-    st.caption(
-        "Örnek şablon gövdesi (Meta'da oluşturup onaylat):\n"
-        "Merhaba {{1}},\n{{2}} dairenizin bildirimi hazırdır.\nButondan dosyayı görüntüleyebilirsiniz."
-    )
+            if drive_go:
+                import pandas as pd
+                if not folder_id.strip():
+                    st.error("Folder ID boş olamaz."); st.stop()
+                if not rehber_up2 and not rehber_src:
+                    st.error("Rehber dosyası yükleyin (bu site için kayıtlı rehber yok)."); st.stop()
 
-    go_send = st.button("🚀 Gönderimi Başlat", use_container_width=True, key="wa_send")
-
-    if preview_btn and csv_up:
-        df_prev = pd.read_csv(csv_up, dtype=str).fillna("")
-        st.dataframe(df_prev.head(50), use_container_width=True)
-        st.success(f"{len(df_prev)} alıcı yüklendi.")
-
-    if go_send:
-        if not csv_up:
-            st.error("Önce CSV yükleyin."); st.stop()
-        if not wa_token or not phone_number_id:
-            st.error("Access Token ve Phone Number ID gerekir."); st.stop()
-
-        df = pd.read_csv(csv_up, dtype=str).fillna("")
-        required_cols = {"phone", "name", "daire_id", "file_url"}
-        if not required_cols.issubset(set(df.columns)):
-            st.error("CSV kolonları eksik. Gerekli: phone, name, daire_id, file_url")
-            st.stop()
-
-        send_results = []
-        progress = st.progress(0)
-        total = len(df)
-        success_cnt = 0
-        fail_cnt = 0
-
-        for i, row in df.iterrows():
-            to = _ok_number(row.get("phone", ""))
-            name = row.get("name", "")
-            did = row.get("daire_id", "")
-            furl = row.get("file_url", "")
-
-            # 1) Şablon mesaj
-            try:
-                r1 = send_template(
-                    wa_token, phone_number_id, to,
-                    template_name, template_lang,
-                    name, did, furl,
-                    header_doc=header_document
-                )
-                if r1.ok:
-                    success = True
-                    info = "template OK"
+                # 1) Drive servisine bağlan (Secrets)
+                try:
+                    service = get_drive_service_from_secrets()
+                except Exception as e:
+                    st.error(f"Drive servisine bağlanılamadı: {e}")
+                    st.stop()
 
-                    # Mesaj panelinde de görünsün diye DB'ye kayıt (şablon metnini özet olarak yazalım)
+                # 2) Klasördeki PDF'leri çek
+                try:
+                    gfiles = list_pdfs_in_folder(service, folder_id.strip())
+                except Exception as e:
+                    st.error(f"Klasör listelenemedi: {e}")
+                    st.stop()
+
+                if not gfiles:
+                    st.warning("Klasörde PDF bulunamadı."); st.stop()
+
+                # 3) PDF adlarından DaireID tahmini (A1-001.pdf gibi)
+                pdf_rows = []
+                for f in gfiles:
+                    base = f.get("name", "")
+                    m = (re.search(r"([A-Za-z]\d)\s*[-_]\s*(\d{1,3})", base)
+                         or re.search(r"([A-Za-z]\d)\s+(\d{1,3})", base)
+                         or re.search(r"([A-Za-z]\d).*?(\d{3})", base))
+                    daire_id = None
+                    if m:
+                        try:
+                            daire_id = f"{m.group(1).upper()}-{int(m.group(2)):03d}"
+                        except:
+                            daire_id = f"{m.group(1).upper()}-{m.group(2)}"
+                    pdf_rows.append({"file_name": base,
+                                     "DaireID": daire_id,
+                                     "file_id": f["id"]})
+                pdf_df = pd.DataFrame(pdf_rows)
+
+                # 4) Rehber: yeni dosya yüklendiyse yalnız farkı kaydet (aynı dosya yeniden ayrıştırılmaz)
+                if rehber_up2:
+                    rehber_bytes = rehber_up2.getvalue()
+                    rehber_hash = hashlib.sha256(rehber_bytes).hexdigest()
+                    if rehber_src and rehber_src[0] == rehber_hash:
+                        st.info("Rehber değişmemiş; kayıtlı rehber kullanıldı.")
+                    else:
+                        try:
+                            rehber_df = load_contacts_any(rehber_bytes, rehber_up2.name)
+                        except Exception as e:
+                            st.error(f"Rehber okunamadı / eşlenemedi: {e}"); st.stop()
+                        delta = save_contacts(rehber_df, site=wa_site, file_hash=rehber_hash,
+                                              file_name=rehber_up2.name)
+                        st.success(f"Rehber kaydedildi: {delta['rows']} kişi • {delta['added']} eklendi • "
+                                   f"{delta['changed']} değişti • {delta['removed']} silindi")
+
+                # 5) Eşleştir (kayıtlı rehberle DB'de)
+                merged = join_contacts(pdf_df, site=wa_site)
+
+                # 6) Dosyaları "linke sahip olan görüntüleyebilir" yap + link üret
+                link_kind = "download" if link_mode.startswith("Doğrudan") else "view"
+
+                st.write("🔓 Dosyalar paylaşıma açılıyor ve linkler oluşturuluyor (dosya bazında)...")
+                for i, row in merged.iterrows():
+                    fid = row.get("file_id")
+                    if not fid:
+                        continue
                     try:
-                        resp_json = r1.json()
-                        msg_id = ""
-                        if isinstance(resp_json, dict):
-                            msgs = resp_json.get("messages")
-                            if msgs and isinstance(msgs, list):
-                                msg_id = msgs[0].get("id", "")
-                        log_text = f"[ŞABLON:{template_name}] {did} → {furl}"
-                        save_outgoing(wa_chat_id=to, phone=to, text=log_text, wa_message_id=msg_id, raw_json=json.dumps(resp_json, ensure_ascii=False))
+                        ensure_anyone_with_link_permission(service, fid)
                     except Exception:
-                        # JSON parse vs patlarsa log'u boş da olsa kaydedelim
-                        save_outgoing(wa_chat_id=to, phone=to, text=f"[ŞABLON:{template_name}] {did} → {furl}")
-                else:
-                    success = False
-                    info = f"template ERR {r1.status_code}: {r1.text}"
-            except Exception as e:
-                success = False
-                info = f"template EXC: {e}"
+                        pass
+                    merged.at[i, "file_url"] = build_direct_file_link(fid, link_kind)
+
+                # 7) Önizleme + CSV
+                a1, a2, a3 = st.columns(3)
+                with a1:
+                    st.metric("Toplam kayıt", len(merged))
+                with a2:
+                    st.metric("DaireID bulunamadı", int(merged["DaireID"].isna().sum()))
+                with a3:
+                    st.metric("Telefon eksik",
+                              int((merged["Telefon"].isna() | (merged["Telefon"] == "")).sum()))
+
+                st.markdown("**Eşleştirme Önizleme**")
+                st.dataframe(
+                    merged.rename(columns={"Telefon": "phone", "Ad Soyad / Unvan": "name"}),
+                    use_container_width=True, height=600
+                )
 
-            send_results.append({"to": to, "step": "template", "ok": success, "info": info})
-            success_cnt += 1 if success else 0
-            fail_cnt += 0 if success else 1
+                out_csv = merged.rename(columns={
+                    "Telefon": "phone",
+                    "Ad Soyad / Unvan": "name",
+                    "DaireID": "daire_id",
+                    "file_name": "file_name",
+                    "file_url": "file_url",
+                })[["phone", "name", "daire_id", "file_name", "file_url"]]
+                b_csv = out_csv.to_csv(index=False).encode("utf-8-sig")
+                st.download_button(
+                    "📥 WhatsApp_Recipients.csv (Drive linkli)",
+                    b_csv,
+                    file_name="WhatsApp_Recipients.csv",
+                    mime="text/csv",
+                    use_container_width=True
+                )
 
-            progress.progress((i+1) / total)
-            time.sleep(0.4)
+    # ---------------- TAB W: WhatsApp Gönder (Cloud API) ----------------
+    with tab_w:
+        st.markdown("### 📲 WhatsApp Gönder (Meta Cloud API)")
+
+        st.info("Gönderim, onaylı bir **şablon mesaj** ile başlatılır. Bu ekranda sadece şablon gönderilir (ekstra metin / belge yok).")
+
+        colK1, colK2 = st.columns(2)
+        with colK1:
+            csv_up = st.file_uploader("WhatsApp_Recipients.csv yükle", type=["csv"], key="wa_send_csv")
+        with colK2:
+            preview_btn = st.button("Önizle", use_container_width=True, key="wa_preview")
+
+        # API Kimlikleri (secrets varsa otomatik doldur)
+        st.markdown("#### Cloud API Ayarları")
+        default_token = st.secrets.get("whatsapp", {}).get("token", "")
+        default_phone_id = st.secrets.get("whatsapp", {}).get("phone_number_id", "")
+        colA1, colA2 = st.columns(2)
+        with colA1:
+            wa_token = st.text_input("Access Token", value=default_token, type="password",
+                                     help="Meta for Developers → WhatsApp → System User token (mümkünse kalıcı).")
+        with colA2:
+            phone_number_id = st.text_input("Phone Number ID", value=default_phone_id,
+                                            help="WABA içindeki WhatsApp numaranızın ID’si")
+
+        st.markdown("#### Şablonla Başlat (zorunlu ilk mesaj)")
+        colT1, colT2, colT3 = st.columns(3)
+        with colT1:
+            template_name = st.text_input("Template adı", value="fatura_goruntule_btn")
+        with colT2:
+            template_lang = st.text_input("Dil (BCP-47)", value="tr")
+        with colT3:
+            header_document = st.checkbox(
+                "Şablon header'ı belge (document) kullansın",
+                value=False,
+                help="Şablonunuz 'HEADER: DOCUMENT' içeriyorsa işaretleyin. PDF linkini header’a koyacağız."
+            )
 
-        st.success(f"Gönderim bitti. Başarılı: {success_cnt}, Hatalı: {fail_cnt}")
-        st.dataframe(pd.DataFrame(send_results), use_container_width=True)
+        st.caption(
+            "Örnek şablon gövdesi (Meta'da oluşturup onaylat):\n"
+            "Merhaba {{1}},\n{{2}} dairenizin bildirimi hazırdır.\nButondan dosyayı görüntüleyebilirsiniz."
+        )
 
-# ---------------- TAB PANEL: WhatsApp Mesaj Paneli ----------------
-with tab_panel:
-    st.subheader("💬 WhatsApp Kat Maliki Mesaj Paneli")
+        go_send = st.button("🚀 Gönderimi Başlat", use_container_width=True, key="wa_send")
+
+        if preview_btn and csv_up:
+            import pandas as pd
+            df_prev = pd.read_csv(csv_up, dtype=str).fillna("")
+            st.dataframe(df_prev.head(50), use_container_width=True)
+            st.success(f"{len(df_prev)} alıcı yüklendi.")
+            if "phone" in df_prev.columns:
+                n_bad = int((~normalize_phones(df_prev["phone"])["valid"]).sum())
+                if n_bad:
+                    st.warning(f"{n_bad} numara geçersiz; gönderimde atlanacak.")
+
+        if go_send:
+            import pandas as pd
+            if not csv_up:
+                st.error("Önce CSV yükleyin."); st.stop()
+            if not wa_token or not phone_number_id:
+                st.error("Access Token ve Phone Number ID gerekir."); st.stop()
+
+            df = pd.read_csv(csv_up, dtype=str).fillna("")
+            required_cols = {"phone", "name", "daire_id", "file_url"}
+            if not required_cols.issubset(set(df.columns)):
+                st.error("CSV kolonları eksik. Gerekli: phone, name, daire_id, file_url")
+                st.stop()
 
-    st.markdown(
-        "Bu ekranda Cloud API numarasına gelen mesajları görebilir ve **panel üzerinden cevap yazabilirsiniz**. "
-        "Mesajlar `whatsapp_messages.db` dosyasında tutulur."
-    )
+            # numaralar tek seferde E.164'e çevrilir; geçersizlere istek atılmaz
+            phones = normalize_phones(df["phone"])
+            df["phone"], df["phone_ok"] = phones["e164"], phones["valid"]
+
+            send_results = []
+            progress = st.progress(0)
+            total = len(df)
+            success_cnt = 0
+            fail_cnt = 0
+
+            for i, row in df.iterrows():
+                to = row["phone"]
+                if not row["phone_ok"]:
+                    send_results.append({"to": to, "step": "template", "ok": False, "info": "geçersiz numara"})
+                    fail_cnt += 1
+                    progress.progress((i+1) / total)
+                    continue
+                name = row.get("name", "")
+                did = row.get("daire_id", "")
+                furl = row.get("file_url", "")
 
-    # API kimlikleri (secrets'tan otomatik çek, istersen değiştir)
-    st.markdown("#### Cloud API Ayarları (cevap göndermek için)")
-    default_token_p = st.secrets.get("whatsapp", {}).get("token", "")
-    default_phone_id_p = st.secrets.get("whatsapp", {}).get("phone_number_id", "")
-    colP1, colP2 = st.columns(2)
-    with colP1:
-        wa_token_p = st.text_input("Access Token", value=default_token_p, type="password", key="panel_token")
-    with colP2:
-        phone_number_id_p = st.text_input("Phone Number ID", value=default_phone_id_p, key="panel_phone_id")
+                # 1) Şablon mesaj
+                try:
+                    r1 = send_template(
+                        wa_token, phone_number_id, to,
+                        template_name, template_lang,
+                        name, did, furl,
+                        header_doc=header_document
+                    )
+                    if r1.ok:
+                        success = True
+                        info = "template OK"
+
+                        # Mesaj panelinde de görünsün diye DB'ye kayıt (şablon metnini özet olarak yazalım)
+                        try:
+                            resp_json = r1.json()
+                            msg_id = ""
+                            if isinstance(resp_json, dict):
+                                msgs = resp_json.get("messages")
+                                if msgs and isinstance(msgs, list):
+                                    msg_id = msgs[0].get("id", "")
+                            log_text = f"[ŞABLON:{template_name}] {did} → {furl}"
+                            save_outgoing(wa_chat_id=to, phone=to, text=log_text, wa_message_id=msg_id, raw_json=json.dumps(resp_json, ensure_ascii=False))
+                        except Exception:
+                            # JSON parse vs patlarsa log'u boş da olsa kaydedelim
+                            save_outgoing(wa_chat_id=to, phone=to, text=f"[ŞABLON:{template_name}] {did} → {furl}")
+                    else:
+                        success = False
+                        info = f"template ERR {r1.status_code}: {r1.text}"
+                except Exception as e:
+                    success = False
+                    info = f"template EXC: {e}"
 
-    chats = get_chats()
+                send_results.append({"to": to, "step": "template", "ok": success, "info": info})
+                success_cnt += 1 if success else 0
+                fail_cnt += 0 if success else 1
 
-    if not chats:
-        st.info("Henüz hiç mesaj yok. Webhook çalıştığında / gönderim yaptığında burada sohbetler listelenecek.")
-    else:
-        cols = st.columns([1, 2])
-
-        with cols[0]:
-            st.markdown("**Sohbetler (Numaralar)**")
-            chat_labels = []
-            for wa_chat_id, last_ts, last_in_msg, last_out_msg in chats:
-                last_msg = (last_in_msg or last_out_msg or "").replace("\n", " ")
-                label = f"{wa_chat_id} | {last_ts} | {last_msg[:30]}"
-                chat_labels.append(label)
-
-            selected = st.radio(
-                "Sohbet seç:",
-                options=list(range(len(chats))),
-                format_func=lambda i: chat_labels[i],
-                key="panel_selected_chat_idx"
-            )
-            selected_chat_id = chats[selected][0]
+                progress.progress((i+1) / total)
+                time.sleep(0.4)
 
-        with cols[1]:
-            st.markdown(f"**Sohbet Detayı: {selected_chat_id}**")
-            conv = get_conversation(selected_chat_id)
+            st.success(f"Gönderim bitti. Başarılı: {success_cnt}, Hatalı: {fail_cnt}")
+            st.dataframe(pd.DataFrame(send_results), use_container_width=True)
 
-            if not conv:
-                st.write("Bu numara için kayıtlı mesaj yok.")
-            else:
-                for direction, sender_name, phone, message, ts in conv:
-                    if direction == "in":
-                        st.markdown(
-                            f"""
-                            <div style="text-align:left; border-radius:8px; padding:8px; margin:4px; background-color:#f0f0f0;">
-                            <b>{(sender_name or phone or 'Kat Maliki')} - {ts}</b><br>{message}
-                            </div>
-                            """,
-                            unsafe_allow_html=True,
-                        )
-                    else:
-                        st.markdown(
-                            f"""
-                            <div style="text-align:right; border-radius:8px; padding:8px; margin:4px; background-color:#d2f8d2;">
-                            <b>Yönetim - {ts}</b><br>{message}
-                            </div>
-                            """,
-                            unsafe_allow_html=True,
-                        )
-
-                st.markdown("---")
-                st.subheader("Cevap Yaz")
-
-                # son mesajdaki telefon bilgisi varsa onu kullan, yoksa wa_chat_id'yi kullan
-                default_phone = conv[-1][2] if conv and conv[-1][2] else selected_chat_id
-                reply_text = st.text_area("Mesajınız", height=100, key="reply_box_panel")
-                col_send1, col_send2 = st.columns([1, 4])
-
-                with col_send1:
-                    send_btn_panel = st.button("Gönder", key="panel_send_btn")
-
-                if send_btn_panel:
-                    if not reply_text.strip():
-                        st.warning("Boş mesaj gönderemezsiniz.")
-                    elif not wa_token_p or not phone_number_id_p:
-                        st.error("Cevap gönderebilmek için Access Token ve Phone Number ID girin.")
-                    else:
-                        to_phone = default_phone
-                        try:
-                            resp = send_text(wa_token_p, phone_number_id_p, to_phone, reply_text.strip())
-                            if resp.status_code < 300:
-                                st.success("Mesaj gönderildi.")
-                                try:
-                                    resp_json = resp.json()
-                                    msg_id = ""
-                                    if isinstance(resp_json, dict):
-                                        msgs = resp_json.get("messages")
-                                        if msgs and isinstance(msgs, list):
-                                            msg_id = msgs[0].get("id", "")
-                                    save_outgoing(
-                                        wa_chat_id=selected_chat_id,
-                                        phone=to_phone,
-                                        text=reply_text.strip(),
-                                        wa_message_id=msg_id,
-                                        raw_json=json.dumps(resp_json, ensure_ascii=False)
-                                    )
-                                except Exception:
-                                    save_outgoing(
-                                        wa_chat_id=selected_chat_id,
-                                        phone=to_phone,
-                                        text=reply_text.strip()
-                                    )
-                                st.rerun()
-                            else:
-                                st.error(f"Mesaj gönderilemedi: {resp.status_code} - {resp.text}")
-                        except Exception as e:
-                            st.error(f"Mesaj gönderirken hata oluştu: {e}")
+    # ---------------- TAB PANEL: WhatsApp Mesaj Paneli ----------------
+    with tab_panel:
+        st.subheader("💬 WhatsApp Kat Maliki Mesaj Paneli")
+
+        st.markdown(
+            "Bu ekranda Cloud API numarasına gelen mesajları görebilir ve **panel üzerinden cevap yazabilirsiniz**. "
+            "Mesajlar `whatsapp_messages.db` dosyasında tutulur."
+        )
+
+        # API kimlikleri (secrets'tan otomatik çek, istersen değiştir)
+        st.markdown("#### Cloud API Ayarları (cevap göndermek için)")
+        default_token_p = st.secrets.get("whatsapp", {}).get("token", "")
+        default_phone_id_p = st.secrets.get("whatsapp", {}).get("phone_number_id", "")
+        colP1, colP2 = st.columns(2)
+        with colP1:
+            wa_token_p = st.text_input("Access Token", value=default_token_p, type="password", key="panel_token")
+        with colP2:
+            phone_number_id_p = st.text_input("Phone Number ID", value=default_phone_id_p, key="panel_phone_id")
 
-    if st.button("🔄 Listeyi yenile", key="panel_refresh_btn"):
-        st.rerun()
+        chats = get_chats()
+
+        if not chats:
+            st.info("Henüz hiç mesaj yok. Webhook çalıştığında / gönderim yaptığında burada sohbetler listelenecek.")
+        else:
+            cols = st.columns([1, 2])
+
+            with cols[0]:
+                st.markdown("**Sohbetler (Numaralar)**")
+                chat_labels = []
+                for wa_chat_id, last_ts, last_in_msg, last_out_msg in chats:
+                    last_msg = (last_in_msg or last_out_msg or "").replace("\n", " ")
+                    label = f"{wa_chat_id} | {last_ts} | {last_msg[:30]}"
+                    chat_labels.append(label)
+
+                selected = st.radio(
+                    "Sohbet seç:",
+                    options=list(range(len(chats))),
+                    format_func=lambda i: chat_labels[i],
+                    key="panel_selected_chat_idx"
+                )
+                selected_chat_id = chats[selected][0]
+
+            with cols[1]:
+                st.markdown(f"**Sohbet Detayı: {selected_chat_id}**")
+                conv = get_conversation(selected_chat_id)
+
+                if not conv:
+                    st.write("Bu numara için kayıtlı mesaj yok.")
+                else:
+                    for direction, sender_name, phone, message, ts in conv:
+                        if direction == "in":
+                            st.markdown(
+                                f"""
+                                <div style="text-align:left; border-radius:8px; padding:8px; margin:4px; background-color:#f0f0f0;">
+                                <b>{(sender_name or phone or 'Kat Maliki')} - {ts}</b><br>{message}
+                                </div>
+                                """,
+                                unsafe_allow_html=True,
+                            )
+                        else:
+                            st.markdown(
+                                f"""
+                                <div style="text-align:right; border-radius:8px; padding:8px; margin:4px; background-color:#d2f8d2;">
+                                <b>Yönetim - {ts}</b><br>{message}
+                                </div>
+                                """,
+                                unsafe_allow_html=True,
+                            )
+
+                    st.markdown("---")
+                    st.subheader("Cevap Yaz")
+
+                    # son mesajdaki telefon bilgisi varsa onu kullan, yoksa wa_chat_id'yi kullan
+                    default_phone = conv[-1][2] if conv and conv[-1][2] else selected_chat_id
+                    reply_text = st.text_area("Mesajınız", height=100, key="reply_box_panel")
+                    col_send1, col_send2 = st.columns([1, 4])
+
+                    with col_send1:
+                        send_btn_panel = st.button("Gönder", key="panel_send_btn")
+
+                    if send_btn_panel:
+                        if not reply_text.strip():
+                            st.warning("Boş mesaj gönderemezsiniz.")
+                        elif not wa_token_p or not phone_number_id_p:
+                            st.error("Cevap gönderebilmek için Access Token ve Phone Number ID girin.")
+                        else:
+                            to_phone = default_phone
+                            try:
+                                resp = send_text(wa_token_p, phone_number_id_p, to_phone, reply_text.strip())
+                                if resp.status_code < 300:
+                                    st.success("Mesaj gönderildi.")
+                                    try:
+                                        resp_json = resp.json()
+                                        msg_id = ""
+                                        if isinstance(resp_json, dict):
+                                            msgs = resp_json.get("messages")
+                                            if msgs and isinstance(msgs, list):
+                                                msg_id = msgs[0].get("id", "")
+                                        save_outgoing(
+                                            wa_chat_id=selected_chat_id,
+                                            phone=to_phone,
+                                            text=reply_text.strip(),
+                                            wa_message_id=msg_id,
+                                            raw_json=json.dumps(resp_json, ensure_ascii=False)
+                                        )
+                                    except Exception:
+                                        save_outgoing(
+                                            wa_chat_id=selected_chat_id,
+                                            phone=to_phone,
+                                            text=reply_text.strip()
+                                        )
+                                    st.rerun()
+                                else:
+                                    st.error(f"Mesaj gönderilemedi: {resp.status_code} - {resp.text}")
+                            except Exception as e:
+                                st.error(f"Mesaj gönderirken hata oluştu: {e}")
+
+        if st.button("🔄 Listeyi yenile", key="panel_refresh_btn"):
+            st.rerun()
+
+
+APP_IMPORT_SECONDS = time.perf_counter() - _APP_IMPORT_T0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+# fatura_batch.py
+# === Atlas Vadi Fatura — başsız (tarayıcısız) toplu çalıştırıcı ===
+#
+# Girdi klasöründeki her fatura PDF'i bir iş sayılır; aynı klasördeki tek .xlsx
+# (veya --template) o işin Apsiyon şablonudur. Örnek yerleşim:
+#
+#   girdi/
+#     vadi/2025-10/fatura.pdf   vadi/2025-10/apsiyon.xlsx
+#     park/2025-10/fatura.pdf   park/2025-10/apsiyon.xlsx
+#
+#   python fatura_batch.py girdi -o cikti --jobs 4 --stamp
+#
+# Her iş için cikti/<site>/<dönem>/<pdf adı>/ altına:
+#   alt_yazili_bolunmus.zip, totals.json, mutabakat.xlsx, Apsiyon_Doldurulmus.xlsx
+#   (+ degisiklikler.json: önceki revizyona göre değişen sayfalar/daireler)
+# ve cikti/ozet.json yazılır. --save-db ile tutarlar dönem DB'sine de kaydedilir; site ve
+# dönem iş yolundan çıkarılır (vadi/2025-10/... => site "vadi", dönem "2025-10").
+# --preflight yalnız DaireID tarar (on_kontrol.json); --contacts ile rehber kapsaması da raporlanır,
+# --contacts-db ile dosya yerine işin sitesi için kayıtlı rehber (Tab C) kullanılır.
+# --bench-phones N telefon normalizasyonunun mikro ölçümünü yazdırır.
+# Sıcak yolda Streamlit çağrısı yoktur (app.main() çalışmaz).
+import argparse, json, os, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load_app():
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    import app
+    return app
+
+
+def discover_jobs(input_dir: str, template: Optional[str] = None) -> List[dict]:
+    jobs = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        pdfs = sorted(f for f in files if f.lower().endswith(".pdf"))
+        if not pdfs:
+            continue
+        xlsxs = sorted(f for f in files if f.lower().endswith(".xlsx") and not f.startswith("~$"))
+        tpl = template or (os.path.join(root, xlsxs[0]) if len(xlsxs) == 1 else None)
+        for f in pdfs:
+            rel = os.path.relpath(os.path.join(root, os.path.splitext(f)[0]), input_dir)
+            jobs.append({"name": rel.replace(os.sep, "/"), "pdf": os.path.join(root, f), "template": tpl})
+    return jobs
+
+
+def job_site_period(app, name: str, period: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    """İş yolundaki ilk dönem klasörü (YYYY-AA) dönemdir, öncesindeki klasörler site."""
+    parts = name.split("/")[:-1]
+    for k, part in enumerate(parts):
+        try:
+            found = app.normalize_period(part)
+        except ValueError:
+            continue
+        return "/".join(parts[:k]), period or found
+    return (parts[0] if parts else ""), period
+
+
+def run_job(job: dict, opts: dict) -> dict:
+    app = _load_app()
+    t0 = time.perf_counter()
+    out_dir = os.path.join(opts["output"], job["name"])
+    os.makedirs(out_dir, exist_ok=True)
+    res = {"job": job["name"], "pdf": job["pdf"], "template": job["template"]}
+    try:
+        with open(job["pdf"], "rb") as fh:
+            src = fh.read()
+
+        if opts["ocr"]:
+            ocr_stats = app.ocr_missing_pages(src, workers=opts["workers"])
+            res["ocr"] = {k: ocr_stats[k] for k in ("pages", "cached", "ocr", "ids", "errors")}
+
+        if opts["split"]:
+            report = app.new_optimize_report()
+            pages = app.iter_footer_and_stamp_pages(
+                src_bytes=src,
+                footer_kwargs=opts["footer_kwargs"],
+                stamp_on=opts["stamp_on"],
+                label_tpl=opts["label_tpl"],
+                stamp_opts=opts["stamp_opts"],
+                rename_files=opts["rename_files"],
+                workers=opts["workers"],
+                optimize=opts["optimize"],
+                report=report,
+            )
+            res["pages"] = app.write_pages_zip(pages, os.path.join(out_dir, "alt_yazili_bolunmus.zip"))
+            res["zip_bytes"] = report["bytes_after"]
+            res["reused_pages"] = report["reused"]
+            if report.get("parallel_error"):
+                res["parallel_error"] = report["parallel_error"]
+
+        # Sayfa metinleri yukarıdaki adımdan depoda; yeniden çıkarılmaz.
+        totals = app.parse_manas_pdf_totals(src)
+        if totals:
+            recon = app.reconcile_totals(totals)
+            with open(os.path.join(out_dir, "mutabakat.xlsx"), "wb") as fh:
+                fh.write(app.anomaly_report_bytes(recon))
+            res["mutabakat"] = app.reconcile_summary(recon)
+        if opts["save_db"] and totals:
+            site, period = job_site_period(app, job["name"], opts["period"])
+            if period is None:
+                raise ValueError("dönem bulunamadı; klasör adı YYYY-AA olmalı ya da --period verin")
+            n_saved = app.save_period_totals(period, totals, site=site, pdf_hash=app.pdf_content_hash(src))
+            res["db"] = {"site": site, "period": period, "rows": n_saved}
+
+        # Önceki revizyon (ör. düzeltilmiş fatura) varsa değişen sayfa/daireler
+        rev = app.revision_diff(src)
+        if rev:
+            with open(os.path.join(out_dir, "degisiklikler.json"), "w", encoding="utf-8") as fh:
+                json.dump(rev, fh, ensure_ascii=False, indent=2)
+            res["revision"] = {k: rev[k] for k in ("unchanged_pages", "changed_pages", "flats_added", "flats_removed")}
+
+        with_extra = app.add_extra_to_totals(totals, opts["extra"])
+        with open(os.path.join(out_dir, "totals.json"), "w", encoding="utf-8") as fh:
+            json.dump(with_extra, fh, ensure_ascii=False, indent=2, sort_keys=True)
+        res["daire"] = len(totals)
+        res["pdf_total"] = round(sum(v.get("toplam", 0.0) for v in with_extra.values()), 2)
+
+        if job["template"] and totals:
+            with open(job["template"], "rb") as fh:
+                tpl_bytes = fh.read()
+            aps, out_bytes = app.fill_apsiyon_job({
+                "name": job["name"], "totals": totals, "template_bytes": tpl_bytes,
+                "mode": opts["aps_mode"], "extra": opts["extra"],
+                "exp1": opts["exp1"], "exp2": opts["exp2"], "exp3": opts["exp3"],
+                "patch": opts["aps_patch"],
+            })
+            if not aps["ok"]:
+                raise RuntimeError(f"Apsiyon: {aps['error']}")
+            with open(os.path.join(out_dir, "Apsiyon_Doldurulmus.xlsx"), "wb") as fh:
+                fh.write(out_bytes)
+            res["apsiyon_rows"] = aps["rows"]
+            res["apsiyon_parse_s"] = aps["template_s"]
+            if "cells" in aps:
+                res["apsiyon_cells"] = aps["cells"]
+        res["ok"] = True
+    except Exception as e:
+        res["ok"] = False
+        res["error"] = f"{type(e).__name__}: {e}"
+    res["seconds"] = round(time.perf_counter() - t0, 3)
+    return res
+
+
+def run_preflight(job: dict, opts: dict) -> dict:
+    """Yalnız DaireID taraması (--preflight): alt yazı, bölme ve tutar çıkarma yapılmaz."""
+    app = _load_app()
+    t0 = time.perf_counter()
+    out_dir = os.path.join(opts["output"], job["name"])
+    os.makedirs(out_dir, exist_ok=True)
+    res = {"job": job["name"], "pdf": job["pdf"]}
+    try:
+        contacts = opts["contacts"]
+        if opts["contacts_db"]:
+            site, _ = job_site_period(app, job["name"])
+            contacts = app.load_contacts_db(site)
+            if contacts.empty:
+                raise ValueError(f"site {site!r} için kayıtlı rehber yok")
+        with open(job["pdf"], "rb") as fh:
+            pre = app.preflight_scan(fh.read(), contacts)
+        with open(os.path.join(out_dir, "on_kontrol.json"), "w", encoding="utf-8") as fh:
+            json.dump(pre, fh, ensure_ascii=False, indent=2)
+        res["preflight"] = pre
+        res["clean"] = app.preflight_ok(pre)
+        res["ok"] = True
+    except Exception as e:
+        res["ok"] = False
+        res["error"] = f"{type(e).__name__}: {e}"
+    res["seconds"] = round(time.perf_counter() - t0, 3)
+    return res
+
+
+def _run_job_star(args):
+    fn, job, opts = args
+    return fn(job, opts)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        description="Fatura PDF'lerini toplu işler: alt yazı + bölme (ZIP), Manas tutarları, Apsiyon doldurma."
+    )
+    p.add_argument("input_dir", nargs="?", help="PDF (+ Apsiyon .xlsx) içeren klasör; alt klasörler taranır")
+    p.add_argument("-o", "--output", default="cikti", help="Çıktı klasörü (varsayılan: cikti)")
+    p.add_argument("-j", "--jobs", type=int, default=1, help="Aynı anda işlenecek iş (site/dönem) sayısı")
+    p.add_argument("-w", "--workers", type=int, default=None,
+                   help="İş başına sayfa işçisi (yalnız --jobs 1 iken; varsayılan otomatik)")
+
+    g = p.add_argument_group("Alt yazı")
+    g.add_argument("--footer-file", help="Alt yazı metni (.txt, UTF-8); verilmezse arayüzdeki varsayılan metin")
+    g.add_argument("--font-size", type=int, default=11)
+    g.add_argument("--leading", type=int, default=14)
+    g.add_argument("--align", choices=["left", "center"], default="left")
+    g.add_argument("--bottom-margin", type=int, default=48)
+    g.add_argument("--box-height", type=int, default=180)
+    g.add_argument("--no-bold-rules", action="store_true", help="Başlıkları otomatik kalın yapma")
+    g.add_argument("--no-split", action="store_true", help="ZIP üretme; sadece tutar/Apsiyon")
+    g.add_argument("--no-optimize", action="store_true", help="Bölünmüş PDF'leri küçültme")
+    g.add_argument("--ocr", action="store_true",
+                   help="Metin katmanı olmayan sayfaları OCR'la (easyocr/pytesseract + pdf2image)")
+
+    g = p.add_argument_group("Daire etiketi")
+    g.add_argument("--stamp", action="store_true", help="Daire numarasını köşeye yaz")
+    g.add_argument("--label-tpl", default="Daire: {daire_id}")
+    g.add_argument("--stamp-font-size", type=int, default=13)
+    g.add_argument("--stamp-pos", choices=["TR", "TL", "BR", "BL"], default="TR")
+    g.add_argument("--no-rename", action="store_true", help="Dosya adlarını daireID.pdf yapma")
+
+    g = p.add_argument_group("Apsiyon")
+    g.add_argument("--template", help="Tüm işler için ortak Apsiyon şablonu (.xlsx)")
+    g.add_argument("--aps-mode", type=int, choices=range(1, 6), default=1, help="Doldurma şekli (Seçenek 1-5)")
+    g.add_argument("--exp1", default="Sıcak Su")
+    g.add_argument("--exp2", default="Soğuk Su")
+    g.add_argument("--exp3", default="Isıtma")
+    g.add_argument("--extra", type=float, default=0.0, help="Her daire toplamına eklenecek fark (TL)")
+    g.add_argument("--rebuild-excel", action="store_true",
+                   help="Şablonu yamalamak yerine Excel'i tablodan yeniden oluştur (biçim/ek sayfalar düşer)")
+
+    g = p.add_argument_group("Dönem DB'si")
+    g.add_argument("--save-db", action="store_true", help="Tutarları dönem DB'sine kaydet (FATURA_DB_PATH)")
+    g.add_argument("--period", help="Dönem (YYYY-AA); verilmezse iş yolundaki klasör adından")
+
+    g = p.add_argument_group("Ön kontrol")
+    g.add_argument("--preflight", action="store_true",
+                   help="Yalnız DaireID tara (eksik/tekrar eden, sayfa sayısı); tam işlem yapma")
+    g.add_argument("--contacts", help="Rehber (XLSX/CSV); --preflight ile rehber kapsamasını da raporla")
+    g.add_argument("--contacts-db", action="store_true",
+                   help="--contacts yerine işin sitesi için kayıtlı rehberi kullan (site iş yolundan)")
+
+    p.add_argument("--import-report", action="store_true",
+                   help="Soğuk başlangıç import sürelerini ölç, yazdır ve çık")
+    p.add_argument("--bench-phones", type=int, metavar="N",
+                   help="N sentetik numarayla telefon normalizasyonunu ölç (satır satır / vektörel) ve çık")
+    return p
+
+
+def print_import_report(app) -> None:
+    for name, sec in app.import_time_report():
+        print(f"{name:28s} {'—' if sec is None else f'{sec * 1000:8.0f} ms'}")
+
+
+def print_phone_bench(app, n: int) -> None:
+    r = app.bench_phone_normalization(n)
+    print(f"{r['rows']:,} numara ({r['valid']:,} geçerli)")
+    print(f"satır satır : {r['row_s'] * 1000:9.1f} ms")
+    print(f"vektörel    : {r['vector_s'] * 1000:9.1f} ms  (x{r['speedup']})")
+    print("sonuçlar aynı" if r["same"] else "UYARI: sonuçlar farklı!")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.import_report:
+        print_import_report(_load_app())
+        return 0
+    if args.bench_phones:
+        print_phone_bench(_load_app(), args.bench_phones)
+        return 0
+    if not args.input_dir:
+        parser.error("input_dir gerekli")
+    if args.contacts_db and args.contacts:
+        parser.error("--contacts ve --contacts-db birlikte kullanılamaz")
+    input_dir = os.path.abspath(args.input_dir)
+    output = os.path.abspath(args.output)
+    template = os.path.abspath(args.template) if args.template else None
+    contacts_path = os.path.abspath(args.contacts) if args.contacts else None
+    footer_text = None
+    if args.footer_file:
+        with open(args.footer_file, "r", encoding="utf-8") as fh:
+            footer_text = fh.read()
+
+    app = _load_app()
+    jobs = discover_jobs(input_dir, template)
+    if not jobs:
+        print(f"PDF bulunamadı: {input_dir}", file=sys.stderr)
+        return 2
+
+    n_jobs = max(1, min(args.jobs, len(jobs)))
+    if n_jobs > 1:
+        workers = 1  # iç içe process pool kurulamaz; paralel işlerde sayfalar seri işlenir
+    else:
+        workers = args.workers or app.DEFAULT_WORKERS
+    opts = {
+        "output": output,
+        "split": not args.no_split,
+        "optimize": not args.no_optimize,
+        "ocr": args.ocr,
+        "workers": workers,
+        "footer_kwargs": dict(
+            footer_text=footer_text if footer_text is not None else app.DEFAULT_FOOTER_TEXT,
+            font_size=args.font_size,
+            leading=args.leading,
+            align=args.align,
+            bottom_margin=args.bottom_margin,
+            box_height=args.box_height,
+            bold_rules=not args.no_bold_rules,
+        ),
+        "stamp_on": args.stamp,
+        "label_tpl": args.label_tpl,
+        "stamp_opts": dict(font_size=args.stamp_font_size, bold=True, position=args.stamp_pos, pad_x=20, pad_y=20),
+        "rename_files": not args.no_rename,
+        "aps_mode": app.APSIYON_MODES[args.aps_mode - 1],
+        "exp1": args.exp1, "exp2": args.exp2, "exp3": args.exp3,
+        "extra": args.extra,
+        "aps_patch": not args.rebuild_excel,
+        "save_db": args.save_db,
+        "period": app.normalize_period(args.period) if args.period else None,
+        "contacts": None,
+        "contacts_db": args.contacts_db,
+    }
+    if contacts_path:
+        with open(contacts_path, "rb") as fh:
+            opts["contacts"] = app.load_contacts_any(fh.read(), os.path.basename(contacts_path))
+    runner = run_preflight if args.preflight else run_job
+    os.makedirs(output, exist_ok=True)
+
+    t0 = time.perf_counter()
+    if n_jobs == 1:
+        results = [runner(j, opts) for j in jobs]
+    else:
+        import multiprocessing
+        ctx = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=ctx) as ex:
+            results = list(ex.map(_run_job_star, [(runner, j, opts) for j in jobs]))
+    elapsed = time.perf_counter() - t0
+
+    for r in results:
+        if not r["ok"]:
+            status, detail = "HATA", r["error"]
+        elif args.preflight:
+            status, detail = ("OK " if r["clean"] else "UYARI"), app.format_preflight(r["preflight"])
+        else:
+            status = "OK "
+            detail = f"{r.get('pages', '-')} sayfa, {r.get('daire', 0)} daire, toplam {r.get('pdf_total', 0):,.2f} TL"
+            if "apsiyon_rows" in r:
+                detail += f", Apsiyon {r['apsiyon_rows']} satır ({r['apsiyon_parse_s']:.2f} sn okuma)"
+        print(f"[{status}] {r['job']}: {detail} ({r['seconds']:.2f} sn)")
+    print(f"{len(results)} iş, {elapsed:.2f} sn, {n_jobs} paralel")
+
+    with open(os.path.join(output, "ozet.json"), "w", encoding="utf-8") as fh:
+        json.dump({"seconds": round(elapsed, 3), "jobs": results}, fh, ensure_ascii=False, indent=2)
+    return 0 if all(r["ok"] and r.get("clean", True) for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())